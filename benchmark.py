@@ -0,0 +1,628 @@
+import os
+import sys
+import re
+import io
+import json
+import time
+import tempfile
+import threading
+import tracemalloc
+import configparser
+from argparse import ArgumentParser
+import psycopg2
+from psycopg2.extras import execute_values
+import numpy as np
+import pandas as pd
+import pulp
+import fpl_synthetic
+import fpl_optimise
+import fpl_solver
+import fpl_utils
+import fpl_features
+import fpl_prediction
+import fpl_seasons
+import fpl_simulation
+import fpl_planner
+import fpl_staging
+import fpl_stubs
+import fpl_service
+import import_data
+import populate_tables
+
+"""Benchmarks of the pipeline stages on synthetic data, e.g. python benchmark.py populate --players 700.
+python benchmark.py suite times every stage of the pipeline on synthetic seasons, against a local
+stand-in of the API and the Postgres of the config file (the database stages are skipped without it):
+    python benchmark.py suite --players 700 --seasons 3 --save baseline.json
+    python benchmark.py suite --players 700 --seasons 3 --baseline baseline.json
+"""
+
+BENCH_SCHEMA = 'bench_stg'
+BENCH_MAIN_SCHEMA = 'bench_main'
+BENCH_SCHEMAS = {'stg_2021': BENCH_SCHEMA, 'fpl_2021': BENCH_MAIN_SCHEMA, 'backup': 'bench_backup'}
+SUITE_STAGES = ['import', 'populate', 'features', 'ema', 'seasons', 'predict', 'query', 'lineup',
+                'simulate', 'transfers', 'planner', 'service']
+
+def timed(f, *args, repeat=3, **kwargs):
+    """Return the best wall time of repeat calls to f and the result of the last call"""
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = f(*args, **kwargs)
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+def create_stage_schema(cur, schema=BENCH_SCHEMA):
+    """Create the staging tables from the DDL in a scratch schema"""
+    with io.open(populate_tables.DDL_FILE, encoding='utf-8') as f:
+        ddl = f.read()
+    cur.execute(f"DROP SCHEMA IF EXISTS {schema} CASCADE")
+    cur.execute(f"CREATE SCHEMA {schema}")
+    for statement in re.findall(r'CREATE TABLE stg_2021\.stg_\w+\s*\(.*?\n\);', ddl, re.DOTALL):
+        cur.execute(statement.replace('stg_2021.', schema + '.'))
+
+def write_player_files(stage_dir):
+    """The staged element-summaries as the player_id_N.json files of the previous import"""
+    for element, summary in fpl_staging.read_summaries(stage_dir):
+        with io.open(os.path.join(stage_dir, 'player_id_{}.json'.format(element)), 'w') as outfile:
+            json.dump(summary, outfile)
+
+def traced_peak(f, *args):
+    """Peak of the Python allocations (MB) during f(*args)"""
+    tracemalloc.start()
+    try:
+        f(*args)
+        return tracemalloc.get_traced_memory()[1] / 1e6
+    finally:
+        tracemalloc.stop()
+
+def legacy_player_history(cur, stage_dir, stg_schema):
+    """The previous loader: one execute_values per player file and one per player's future fixtures"""
+    for player_file in os.listdir(stage_dir):
+        m = re.search(r'player_id_[0-9]+.json', player_file)
+        if m:
+            with io.open(os.path.join(stage_dir,player_file), encoding='utf-8') as f:
+                player = json.loads(f.read())
+            history = player['history']
+            try:
+                columns = history[0].keys()
+            except IndexError:  # No history for this player
+                continue
+            values =  [list(x.values()) for x in history]
+            query = "INSERT INTO {}.stg_player_history ({}) VALUES %s".format(stg_schema, ','.join(columns))
+            execute_values(cur, query, values)
+            fixtures = player['fixtures']
+            if len(fixtures) > 0:
+                included_fixtures = [d['fixture'] for d in history]
+                future_fixtures = []
+                for f in fixtures:
+                    if f['id'] not in included_fixtures:
+                        future_fixtures.append({
+                                  'element': history[0]['element'],
+                                  'fixture': f['id'],
+                                  'round': f['event'],
+                                  'opponent_team': f['team_a'] if f['is_home'] else f['team_h'],
+                                  'kickoff_time': f['kickoff_time'],
+                                  'was_home': f['is_home']})
+                columns = future_fixtures[0].keys()
+                values = [list(x.values()) for x in future_fixtures]
+                query = "INSERT INTO {}.stg_player_history ({}) VALUES %s".format(stg_schema, ','.join(columns))
+                execute_values(cur, query, values)
+
+def copy_player_history(cur, stage_dir, stg_schema):
+    populate_tables.copy_rows(cur, f'{stg_schema}.stg_player_history',
+                              populate_tables.ddl_columns('stg_player_history'),
+                              populate_tables.player_history_rows(stage_dir))
+
+def bench_populate(conn, n_players):
+    """stg_player_history: execute_values per player file vs a single COPY streamed from the
+    staged element-summaries"""
+    with tempfile.TemporaryDirectory() as stage_dir, conn.cursor() as cur:
+        fpl_synthetic.write_stage_dir(stage_dir, n_players=n_players)
+        write_player_files(stage_dir)
+        create_stage_schema(cur)
+
+        def run(loader):
+            cur.execute(f"TRUNCATE TABLE {BENCH_SCHEMA}.stg_player_history")
+            loader(cur, stage_dir, BENCH_SCHEMA)
+            cur.execute(f"SELECT md5(string_agg(t::text, ',' ORDER BY element, fixture)) "
+                        f"FROM {BENCH_SCHEMA}.stg_player_history t")
+            return cur.fetchone()[0]
+
+        legacy_time, legacy_hash = timed(run, legacy_player_history)
+        copy_time, copy_hash = timed(run, copy_player_history)
+        legacy_peak, copy_peak = traced_peak(run, legacy_player_history), traced_peak(run, copy_player_history)
+        cur.execute(f"DROP SCHEMA {BENCH_SCHEMA} CASCADE")
+    conn.commit()
+    assert legacy_hash == copy_hash, 'COPY loader gives a different stg_player_history'
+    print("stg_player_history, {} players: execute_values {:.2f}s, COPY {:.2f}s ({:.1f}x)".format(
+        n_players, legacy_time, copy_time, legacy_time / copy_time))
+    print("Peak Python memory: execute_values {:.1f} MB, COPY {:.1f} MB ({} parser)".format(
+        legacy_peak, copy_peak, 'orjson' if fpl_staging.orjson is not None else 'json'))
+
+LEGACY_PREDICTION_QUERY = """with ranked_value as (
+    select element, round, value,
+    row_number() over (partition by element order by round desc) as rn
+    from {main_schema}.player_history where value is not null)
+  select p.*, ph."position", ph.web_name, ph.name_own_team, rv.value/10.0 as now_cost
+   from {main_schema}.prediction p join {main_schema}.player_history ph
+    on ph."element" = p."element" and  ph.round = p.round
+    left join ranked_value rv on ph."element" = rv.element
+    where rv.rn=1"""
+
+def create_main_schema(cur, n_players, n_seasons, horizon=6, schema=BENCH_MAIN_SCHEMA):
+    """player_history of n_seasons synthetic seasons (prices rise by 0.1 each season and are missing
+    for the last horizon rounds, which are not played yet) and a prediction of those rounds"""
+    with io.open(populate_tables.DDL_FILE, encoding='utf-8') as f:
+        ddl = f.read()
+    cur.execute(f"DROP SCHEMA IF EXISTS {schema} CASCADE")
+    cur.execute(f"CREATE SCHEMA {schema}")
+    for statement in re.findall(r'CREATE TABLE fpl_2021\.(?:player_history|prediction|fixture_index)\s*\(.*?\n\);',
+                                ddl, re.DOTALL):
+        cur.execute(statement.replace('fpl_2021.', schema + '.'))
+    df = fpl_synthetic.player_history_frame(n_players=n_players, n_seasons=n_seasons,
+                                            n_played=n_seasons * 38 - horizon)
+    df['fixture'] = df['round']
+    df['value'] = (df['value'] + (df['round'] - 1) // 38).where(df['finished'])
+    df['web_name'] = 'Player ' + df['element'].astype(str)
+    df['team'] = df['element'] % 20 + 1
+    df['name_own_team'] = np.array(fpl_synthetic.TEAM_NAMES)[df['team'] - 1]
+    for c in ['minutes', 'total_points', 'bps', 'value']:
+        df[c] = df[c].astype('Int64')
+
+    def copy(table, frame):
+        buf = io.StringIO()
+        frame.to_csv(buf, index=False, header=False, na_rep='\\N')
+        buf.seek(0)
+        cur.copy_expert("COPY {}.{} ({}) FROM STDIN WITH (FORMAT csv, NULL '\\N')".format(
+            schema, table, ','.join(frame.columns)), buf)
+
+    copy('player_history', df[['element', 'fixture', 'round', 'minutes', 'total_points', 'bps', 'value',
+                               'was_home', 'position', 'web_name', 'team', 'name_own_team', 'finished']])
+    copy('fixture_index', df[['team', 'round']].drop_duplicates().assign(n_fixtures=1))
+    prediction = df.loc[~df['finished'], ['element', 'round']]
+    prediction['points'] = np.random.default_rng(0).uniform(0, 8, len(prediction)).round(2)
+    prediction['points_cumulative'] = prediction.groupby('element')['points'].cumsum().round(2)
+    copy('prediction', prediction)
+    return len(df)
+
+def plan_nodes(plan):
+    """The node types and index names of an EXPLAIN (FORMAT JSON) plan, depth first"""
+    nodes = [(plan['Node Type'], plan.get('Index Name'))]
+    for child in plan.get('Plans', []):
+        nodes += plan_nodes(child)
+    return nodes
+
+def explain(cur, sql):
+    """Server-side execution time and plan nodes of sql"""
+    cur.execute('EXPLAIN (ANALYZE, FORMAT JSON) ' + sql)
+    result = cur.fetchone()[0][0]
+    return result['Execution Time'] / 1000, plan_nodes(result['Plan'])
+
+def bench_query(conn, n_players, n_seasons):
+    """The prediction query of fpl_optimise.load_predictions on n_seasons of synthetic player_history:
+    the previous row_number() query without indexes vs sql/DQL_predictions.sql with the indexes of
+    sql/DDL_create_indexes.sql.
+    Both must return the same rows, and the plan must read the latest prices from the partial index
+    """
+    conn.autocommit = True  # For VACUUM
+    with conn.cursor() as cur:
+        n_rows = create_main_schema(cur, n_players, n_seasons)
+        legacy_sql = LEGACY_PREDICTION_QUERY.replace('{main_schema}', BENCH_MAIN_SCHEMA)
+        sql = populate_tables.read_sql('sql/DQL_predictions.sql', main_schema=BENCH_MAIN_SCHEMA)
+        cur.execute(f"VACUUM ANALYZE {BENCH_MAIN_SCHEMA}.player_history")
+        cur.execute(f"ANALYZE {BENCH_MAIN_SCHEMA}.prediction")
+        legacy_time = min(explain(cur, legacy_sql)[0] for _ in range(3))
+        cur.execute(populate_tables.read_sql('sql/DDL_create_indexes.sql', main_schema=BENCH_MAIN_SCHEMA))
+        cur.execute(f"VACUUM ANALYZE {BENCH_MAIN_SCHEMA}.player_history")
+        query_time = min(explain(cur, sql)[0] for _ in range(3))
+        nodes = explain(cur, sql)[1]
+        sort = ['element', 'round']
+        expected = pd.read_sql(legacy_sql, conn).sort_values(sort).reset_index(drop=True)
+        result = pd.read_sql(sql, conn).sort_values(sort).reset_index(drop=True)
+        cur.execute(f"DROP SCHEMA {BENCH_MAIN_SCHEMA} CASCADE")
+    conn.autocommit = False
+    assert (result.pop('n_fixtures') == 1).all()  # No blank or double gameweeks in the synthetic seasons
+    pd.testing.assert_frame_equal(result, expected)
+    print("Prediction query, {} player_history rows: row_number() {:.1f}ms, latest value per player {:.1f}ms ({:.1f}x)".format(
+        n_rows, 1000 * legacy_time, 1000 * query_time, legacy_time / query_time))
+    print("Plan: " + ', '.join(node + (' ' + index if index else '') for node, index in nodes))
+    assert ('Index Only Scan', 'player_history_latest_idx') in nodes, 'Latest prices are not read from the partial index'
+    assert 'WindowAgg' not in [node for node, _ in nodes], 'The prediction query ranks all of player_history again'
+
+def legacy_EMA(df, column, span, min_periods, threshold_minutes):
+    """The previous fpl_utils.EMA: a groupby().apply(ewm), a groupby().ffill() and a groupby().shift()
+    (transform instead of apply, which pandas 2 returns with the group keys in the index)"""
+    df['EMA_column']=(df[df.minutes>threshold_minutes].groupby('element')[column]
+                 .transform(lambda x: x.ewm(span=span,min_periods=min_periods,ignore_na=True)
+                 .mean()))
+    df['EMA_column']=df.groupby('element').ffill()['EMA_column']
+    df['EMA_column']=df.groupby('element').shift(1)['EMA_column']
+    return df['EMA_column']
+
+def bench_ema(n_players, n_seasons):
+    """The six EMA features of fpl_prediction.py: one EMA call per column vs EMA_features"""
+    df = fpl_synthetic.player_history_frame(n_players=n_players, n_seasons=n_seasons)
+    columns = ['influence', 'creativity', 'threat', 'ict_index', 'bps', 'total_points']
+
+    def legacy():
+        return {c: legacy_EMA(df, c, span=2, min_periods=2, threshold_minutes=30).copy()
+                for c in columns}
+
+    legacy_time, expected = timed(legacy)
+    engine_time, result = timed(fpl_utils.EMA_features, df, columns, span=2, min_periods=2,
+                                threshold_minutes=30)
+    for c in columns:
+        np.testing.assert_array_equal(result['EMA_' + c].values, expected[c].values)
+    print("EMA features, {} rows: groupby/apply {:.2f}s, EMA_features {:.3f}s ({:.0f}x)".format(
+        len(df), legacy_time, engine_time, legacy_time / engine_time))
+
+def random_squads(n_squads, seed=0):
+    """Points and positions of n_squads squads of 2 GKP, 5 DEF, 5 MID and 3 FWD"""
+    rng = np.random.default_rng(seed)
+    positions = np.repeat(fpl_optimise.POSITIONS, [2, 5, 5, 3])
+    points = np.round(rng.gamma(2.0, 3.0, size=(n_squads, len(positions))), 1)
+    return points, positions
+
+def legacy_select_lineup(points, positions):
+    """The previous lineup selection: one CBC solve with fixed position counts per formation"""
+    max_score = 0
+    for formation in fpl_optimise.POSSIBLE_FORMATIONS:
+        fpl_problem = pulp.LpProblem('FPL', pulp.LpMaximize)
+        x = [pulp.LpVariable('x_{}'.format(i), cat=pulp.LpBinary) for i in range(len(points))]
+        fpl_problem += pulp.lpSum(p * v for p, v in zip(points, x))
+        for pos, n in zip(fpl_optimise.POSITIONS, fpl_optimise.formation_counts(formation)):
+            fpl_problem += pulp.lpSum(v for v, p in zip(x, positions) if p == pos) == n
+        fpl_problem.solve(pulp.PULP_CBC_CMD(msg=0))
+        score = pulp.value(fpl_problem.objective)
+        if score >= max_score:
+            max_score, best_formation = score, formation
+    return best_formation, max_score
+
+def bench_lineup(n_squads):
+    """Lineup selection: a CBC solve per formation vs a single MILP vs enumeration in NumPy.
+    The three must agree on the highest score of every squad
+    """
+    points, positions = random_squads(n_squads)
+    legacy_time, legacy = timed(lambda: [legacy_select_lineup(p, positions) for p in points], repeat=1)
+    milp_time, milp = timed(lambda: [fpl_optimise.select_lineup_milp(p, positions) for p in points], repeat=1)
+    enum_time, enum = timed(lambda: [fpl_optimise.select_lineup(p, positions) for p in points])
+    batch_time, batch = timed(fpl_optimise.formation_scores, points, positions)
+    for (_, legacy_score), (milp_selected, _, milp_score), (selected, formation, score), scores in zip(
+            legacy, milp, enum, batch):
+        assert abs(legacy_score - score) < 1e-6 and abs(milp_score - score) < 1e-6
+        assert abs(scores.max() - score) < 1e-9 and milp_selected.sum() == selected.sum() == 11
+        assert formation in fpl_optimise.POSSIBLE_FORMATIONS
+    print("Lineup of {} squads: CBC per formation {:.2f}s, one MILP {:.2f}s, enumeration {:.4f}s "
+          "({:.0f}x), all squads at once {:.5f}s".format(n_squads, legacy_time, milp_time, enum_time,
+                                                         legacy_time / enum_time, batch_time))
+
+def bench_simulate(n_players, n_squads, n_samples=fpl_simulation.N_SAMPLES):
+    """Simulation of every player at once, and quantile lineups of n_squads squads from the simulations.
+    The simulated quantiles must match the normal ones, and with no spread the quantile lineup must
+    be the expected-points lineup
+    """
+    rng = np.random.default_rng(0)
+    mean, std = rng.gamma(2.0, 3.0, n_players), rng.uniform(0.5, 4.0, n_players)
+    simulate_time, samples = timed(fpl_simulation.simulate, mean, std, n_samples)
+    for q in [0.1, 0.5, 0.9]:
+        np.testing.assert_allclose(np.quantile(samples, q, axis=0), fpl_simulation.quantile_points(mean, std, q),
+                                   atol=0.15 * std.max())
+    points, positions = random_squads(n_squads)
+    std = rng.uniform(0.5, 4.0, points.shape)
+
+    def lineups(quantile):
+        return [fpl_optimise.select_lineup_quantile(fpl_simulation.simulate(p, s, n_samples), positions, quantile)
+                for p, s in zip(points, std)]
+
+    lineup_time, _ = timed(lineups, 0.2, repeat=1)
+    for p, (selected, formation, score, _) in zip(points, [fpl_optimise.select_lineup_quantile(
+            fpl_simulation.simulate(p, np.zeros(len(p)), 10), positions, 0.5) for p in points]):
+        assert abs(score - fpl_optimise.select_lineup(p, positions)[2]) < 1e-3
+    print("Simulation of {} players, {} samples: {:.3f}s; 20% quantile lineup of {} squads: {:.3f}s per squad".format(
+        n_players, n_samples, simulate_time, n_squads, lineup_time / n_squads))
+    assert simulate_time < 1.0, 'Simulating the players takes more than a second'
+
+def synthetic_players(n_players, seed=0):
+    """available_players of fpl_optimise.suggest_transfers for n_players random players"""
+    rng = np.random.default_rng(seed)
+    df = fpl_synthetic.player_history_frame(n_players=n_players, n_rounds=1, seed=seed)
+    return pd.DataFrame({'element': df['element'], 'position': df['position'],
+                         'name_own_team': rng.choice(fpl_synthetic.TEAM_NAMES, n_players),
+                         'now_cost': np.round(rng.uniform(4, 13, n_players), 1),
+                         'points_cumulative': np.round(rng.gamma(2.0, 8.0, n_players), 1)})
+
+def legacy_transfer_model(available_players, lineup, budget, formation, n_transfers):
+    """The previous transfer MILP: sums of Python lists and a club constraint for every player"""
+    available_players=pd.concat([available_players,pd.get_dummies(\
+        available_players[['position', 'name_own_team']])],axis=1)
+    fpl_problem = pulp.LpProblem('FPL', pulp.LpMaximize)
+    players=available_players.element
+    x = pulp.LpVariable.dict('x % s', players, lowBound=0, upBound=1,cat=pulp.LpInteger)
+    player_points = dict(zip(available_players.element, np.array(available_players.points_cumulative)))
+    fpl_problem += sum([player_points[i] * x[i] for i in players])
+    constraints = dict(zip(fpl_optimise.POSITIONS, fpl_optimise.formation_counts(formation)))
+    player_cost = dict(zip(available_players.element, available_players.now_cost))
+    fpl_problem += sum([player_cost[i] * x[i] for i in players]) <= float(budget)
+    for pos in fpl_optimise.POSITIONS:
+        in_position = available_players[available_players['position_' + pos]==1]['element'].values
+        fpl_problem += sum([x[i] for i in in_position]) == constraints[pos]
+    fpl_problem += sum([x[i] for i in players]) == 11
+    fpl_problem += sum([x[i] for i in lineup]) == 11 - n_transfers
+    for t in available_players.name_own_team:
+        player_team = dict(
+            zip(available_players.element, available_players['name_own_team_' + str(t)]))
+        fpl_problem += sum([player_team[i] * x[i] for i in players]) <= 3
+    return fpl_problem, x
+
+def bench_transfers(n_players, n_transfers=2):
+    """Transfer MILP: model build and CBC solve timed separately, previous vs array-based model"""
+    available_players = synthetic_players(n_players)
+    distinct_clubs = available_players.drop_duplicates('name_own_team')
+    lineup = np.concatenate([distinct_clubs[distinct_clubs['position'] == pos]['element'].values[:n]
+                             for pos, n in zip(fpl_optimise.POSITIONS, [1, 4, 4, 2])])
+    budget = available_players.set_index('element').loc[lineup, 'now_cost'].sum() + 1.0
+    args = (available_players, lineup, budget, '1-4-4-2', n_transfers)
+    results = {}
+    for name, build in [('previous', legacy_transfer_model), ('array-based', fpl_optimise.transfer_model)]:
+        build_time, (fpl_problem, _) = timed(build, *args)
+        solve_time, _ = timed(fpl_problem.solve, pulp.PULP_CBC_CMD(msg=0))
+        results[name] = pulp.value(fpl_problem.objective)
+        print("Transfer model, {} players, {}: {} constraints, build {:.3f}s, solve {:.3f}s".format(
+            n_players, name, len(fpl_problem.constraints), build_time, solve_time))
+    assert abs(results['previous'] - results['array-based']) < 1e-6, results
+
+def bench_solvers(n_players, n_squads):
+    """The lineup and transfer MILPs with each available solver backend: time per solve from
+    fpl_solver.solve_log. All backends must find the same optimum
+    """
+    points, positions = random_squads(n_squads)
+    available_players = synthetic_players(n_players)
+    lineup = available_players.groupby('position').head(3)['element'].values[:11]
+    budget = available_players.set_index('element').loc[lineup, 'now_cost'].sum() + 1.0
+    objectives = {}
+    for backend in fpl_solver.available_backends():
+        fpl_solver.solve_log.clear()
+        scores = [fpl_optimise.select_lineup_milp(p, positions, backend=backend)[2] for p in points]
+        fpl_problem, _ = fpl_optimise.transfer_model(available_players, lineup, budget, '1-4-4-2', 2)
+        fpl_solver.solve(fpl_problem, backend)
+        objectives[backend] = np.append(scores, pulp.value(fpl_problem.objective))
+        times = [r['time'] for r in fpl_solver.solve_log]
+        print("{}: lineup MILP {:.1f}ms per solve, transfer MILP ({} players) {:.1f}ms".format(
+            backend, 1000 * np.mean(times[:-1]), n_players, 1000 * times[-1]))
+    for backend, objective in objectives.items():
+        np.testing.assert_allclose(objective, objectives['cbc'], atol=1e-6, err_msg=backend)
+
+def create_schemas(cur, schemas=BENCH_SCHEMAS):
+    """All tables of the DDL in scratch schemas"""
+    with io.open(populate_tables.DDL_FILE, encoding='utf-8') as f:
+        ddl = f.read()
+    for schema in schemas.values():
+        cur.execute(f"DROP SCHEMA IF EXISTS {schema} CASCADE")
+        cur.execute(f"CREATE SCHEMA {schema}")
+    created = set()
+    for statement, table in re.findall(r'(CREATE TABLE (\w+\.\w+)\s*\(.*?\n\);)', ddl, re.DOTALL):
+        if table not in created:  # backup.player_history is in the DDL twice
+            cur.execute(re.sub(r'\b({})\.'.format('|'.join(schemas)),
+                               lambda m: schemas[m.group(1)] + '.', statement))
+            created.add(table)
+
+def bench_service(conn, source_dir, df_prediction, prediction, team_id=1, n_requests=20):
+    """The what-if service on the bench schema, with the picks of team_id from a stand-in of the FPL API.
+    Its answers must be those of fpl_optimise, the picks must be fetched once and the predictions read
+    again after the prediction table is rewritten (see test_fpl_service.py for the tests without a
+    database). Returns the best time of a /lineup request
+    """
+    squad = fpl_stubs.cheapest_squad(df_prediction)
+    gameweek = int(df_prediction['round'].min() - 1)
+    picks = {(team_id, gameweek): {'picks': [{'element': e} for e in squad], 'entry_history': {'bank': 10}}}
+    stub, base_url = fpl_stubs.serve_directory(source_dir, picks)
+    store = fpl_service.PredictionStore(lambda: conn, BENCH_MAIN_SCHEMA, check_interval=0)
+    server = fpl_service.make_server(fpl_service.Service(store, base_url, picks_ttl=60), port=0, verbose=False)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = 'http://127.0.0.1:{}'.format(server.server_address[1])
+    session = import_data.make_session()
+    try:
+        answer = session.get(url + '/transfers', params={'team_id': team_id, 'n_transfers': 2, 'n_round': 3}).json()
+        expected = fpl_optimise.optimise_team(df_prediction, squad, 1.0, 2, 3)
+        assert answer['formation'] == expected['formation']
+        assert abs(answer['new_points'] - expected['new_points']) < 1e-6
+        assert sorted(p['element'] for p in answer['new_team']) == sorted(expected['new_team'].element)
+        sell = ','.join(str(p['element']) for p in answer['lineup'][-2:])
+        lineup_time, answer = timed(lambda: session.get(url + '/lineup', params={
+            'team_id': team_id, 'n_round': 1, 'sell': sell}).json(), repeat=n_requests)
+        assert len(answer['lineup']) == 11 and len(answer['sold']) == 2 and answer['bank'] > 1.0
+        assert [p for p in stub.paths if 'picks' in p] == ['/entry/{}/event/{}/picks/'.format(team_id, gameweek)]
+        # A new prediction is picked up by the next request
+        run_id = session.get(url + '/status').json()['prediction_run']
+        fpl_prediction.write_predictions(conn, BENCH_MAIN_SCHEMA, prediction.assign(points_cumulative=0.0))
+        status = session.get(url + '/status').json()
+        assert status['prediction_run'] == run_id + 1 and status['loads'] == 2
+        assert session.get(url + '/lineup', params={'team_id': team_id}).json()['points'] == 0
+    finally:
+        server.shutdown()
+        stub.shutdown()
+    return lineup_time
+
+def run_suite(conn, n_players, n_seasons, n_played=10, n_squads=100, workers=1):
+    """Time each stage of the pipeline on n_seasons synthetic seasons (the last one is the current
+    season with n_played rounds played). The database stages are skipped when conn is None.
+    Returns the seconds per stage; stages that are repeated report their best time
+    """
+    times = {}
+    with tempfile.TemporaryDirectory() as base_dir:
+        start = time.perf_counter()
+        # Two postponed matches give four teams a blank and a double gameweek in the horizon
+        source_dir, season_dirs = fpl_synthetic.write_seasons(os.path.join(base_dir, 'source'), n_seasons,
+                                                              n_players, n_played, n_postponed=2)
+        print("Generated {} seasons of {} players in {:.1f}s".format(n_seasons, n_players,
+                                                                   time.perf_counter() - start))
+        stage_dir = os.path.join(base_dir, 'stage')
+        os.makedirs(stage_dir)
+        server, base_url = fpl_stubs.serve_directory(source_dir)
+        times['import'], _ = timed(import_data.run_import, stage_dir, base_url=base_url)
+        server.shutdown()
+        df = fpl_synthetic.stage_player_history(stage_dir)
+        fixture_index = fpl_synthetic.stage_fixture_index(stage_dir)
+
+        if conn is not None:
+            with conn.cursor() as cur:
+                create_schemas(cur)
+            conn.commit()
+            times['populate'], _ = timed(populate_tables.run_populate, conn, stage_dir, BENCH_SCHEMA,
+                                         BENCH_MAIN_SCHEMA, BENCH_SCHEMAS['backup'], repeat=1)
+            times['features'], _ = timed(fpl_features.load_features, conn, BENCH_MAIN_SCHEMA,
+                                         fpl_prediction.COLUMNS, rebuild=True,
+                                         backup_schema=BENCH_SCHEMAS['backup'], repeat=1)
+            # The frame of the generator must match what populate_tables made of its files
+            columns = ['element', 'fixture', 'round', 'minutes', 'total_points', 'value', 'position',
+                       'name_own_team', 'strength_opponent_team', 'finished']
+            loaded = pd.read_sql(f"select {','.join(columns)} from {BENCH_MAIN_SCHEMA}.player_history "
+                                 "order by element, fixture", conn)
+            pd.testing.assert_frame_equal(
+                loaded, df[columns].sort_values(['element', 'fixture']).reset_index(drop=True),
+                check_dtype=False)
+            loaded = pd.read_sql("select team, round, n_fixtures, opponents, opponent_strength::float8, "
+                                 f"difficulty::float8 from {BENCH_MAIN_SCHEMA}.fixture_index order by team, round",
+                                 conn)
+            pd.testing.assert_frame_equal(loaded, fixture_index, check_dtype=False)
+
+        times['ema'], features = timed(fpl_utils.EMA_features, df, fpl_features.EMA_COLUMNS,
+                                       **fpl_features.EMA_PARAMS)
+        df = pd.concat([df, features], axis=1)
+        history = None
+        if season_dirs:
+            times['seasons'], history = timed(
+                fpl_seasons.load_history, None, season_dirs, os.path.join(base_dir, 'seasons'),
+                columns=['element', 'fixture', 'round', 'minutes', 'total_points', 'position']
+                + fpl_prediction.FEATURES, repeat=1)
+        times['predict'], prediction = timed(fpl_prediction.predict, df, fpl_prediction.FEATURES,
+                                             os.path.join(base_dir, 'models'), workers=workers,
+                                             history=history, fixture_index=fixture_index, repeat=1)
+        df_prediction = fpl_optimise.prediction_frame(df, prediction)
+        if conn is not None:
+            fpl_prediction.write_predictions(conn, BENCH_MAIN_SCHEMA, prediction)
+            times['query'], loaded = timed(fpl_optimise.load_predictions, conn, BENCH_MAIN_SCHEMA)
+            pd.testing.assert_frame_equal(loaded, df_prediction, check_dtype=False)
+            times['service'] = bench_service(conn, source_dir, df_prediction, prediction)
+            with conn.cursor() as cur:
+                for schema in BENCH_SCHEMAS.values():
+                    cur.execute(f"DROP SCHEMA {schema} CASCADE")
+            conn.commit()
+
+    points, positions = random_squads(n_squads)
+    times['lineup'], _ = timed(lambda: [fpl_optimise.select_lineup(p, positions) for p in points])
+    next_round = df_prediction[df_prediction['next_fixture'] == 1]
+    times['simulate'], _ = timed(fpl_simulation.simulate, next_round['points_cumulative'],
+                                 next_round['points_std_cumulative'])
+    squad = fpl_stubs.cheapest_squad(df_prediction)
+    times['transfers'], _ = timed(fpl_optimise.optimise_team, df_prediction, squad, 1.0, 2, 3)
+    times['planner'], _ = timed(fpl_planner.plan_transfers, df_prediction, squad, 1.0,
+                                horizon=min(6, 38 - n_played), repeat=1)
+    return times
+
+def compare(times, baseline, tolerance):
+    """Print the time of each stage next to the baseline. Returns the stages that are more than
+    tolerance times slower than the baseline
+    """
+    regressions = []
+    for stage in SUITE_STAGES:
+        if stage not in times:
+            continue
+        line = "{:<10} {:8.3f}s".format(stage, times[stage])
+        if baseline.get(stage):
+            ratio = times[stage] / baseline[stage]
+            line += "   baseline {:8.3f}s  {:5.2f}x".format(baseline[stage], ratio)
+            if ratio > tolerance:
+                line += "  REGRESSION"
+                regressions.append(stage)
+        print(line)
+    return regressions
+
+def suite(args):
+    """Run the suite, compare with --baseline and write the times to --save.
+    Returns 1 if a stage regressed
+    """
+    conn = None
+    config = configparser.ConfigParser()
+    config.read('../config/fpl-bot.ini')
+    if config.has_section('DATABASE'):
+        try:
+            conn = psycopg2.connect(
+                host=config.get('DATABASE', 'HOST'),
+                database=config.get('DATABASE', 'DB'),
+                user=config.get('DATABASE', 'USER'),
+                password=config.get('DATABASE', 'PASSWORD'))
+        except psycopg2.OperationalError as e:
+            print("No database, skipping the populate, features and query stages: {}".format(e))
+    params = {'players': args.players, 'seasons': args.seasons, 'played': args.played,
+              'squads': args.squads, 'workers': args.workers}
+    times = run_suite(conn, args.players, args.seasons, args.played, args.squads, args.workers)
+    if conn is not None:
+        conn.close()
+
+    baseline = {}
+    if args.baseline:
+        with io.open(args.baseline, encoding='utf-8') as f:
+            saved = json.load(f)
+        if saved['params'] != params:
+            print("Note: the baseline was measured with {}".format(saved['params']))
+        baseline = saved['times']
+    regressions = compare(times, baseline, args.tolerance)
+    if args.save:
+        with io.open(args.save, 'w', encoding='utf-8') as f:
+            json.dump({'params': params, 'times': times}, f, indent=2)
+    if regressions:
+        print("Slower than {}x the baseline: {}".format(args.tolerance, ', '.join(regressions)))
+        return 1
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument("stage", choices=['suite', 'populate', 'query', 'ema', 'lineup', 'simulate', 'transfers',
+                                          'solvers'],
+                        help="Stage to benchmark, or the whole pipeline (suite)")
+    parser.add_argument("-p", "--players", type=int, dest="players", default=700,
+                        help="Number of synthetic players")
+    parser.add_argument("-s", "--seasons", type=int, dest="seasons", default=5,
+                        help="Number of synthetic seasons")
+    parser.add_argument("-n", "--squads", type=int, dest="squads", default=100,
+                        help="Number of random squads for the lineup benchmark")
+    parser.add_argument("--played", type=int, dest="played", default=10,
+                        help="Suite: number of rounds played in the current season")
+    parser.add_argument("-w", "--workers", type=int, dest="workers", default=1,
+                        help="Suite: number of processes for the per-position models")
+    parser.add_argument("--baseline", dest="baseline",
+                        help="Suite: JSON file of an earlier --save to compare each stage with")
+    parser.add_argument("--save", dest="save", help="Suite: write the times of the stages to this JSON file")
+    parser.add_argument("--tolerance", type=float, dest="tolerance", default=1.25,
+                        help="Suite: a stage regressed if it is this many times slower than the baseline")
+    args = parser.parse_args()
+
+    if args.stage == 'suite':
+        return suite(args)
+
+    if args.stage == 'ema':
+        return bench_ema(args.players, args.seasons)
+    if args.stage == 'lineup':
+        return bench_lineup(args.squads)
+    if args.stage == 'simulate':
+        return bench_simulate(args.players, args.squads)
+    if args.stage == 'transfers':
+        return bench_transfers(args.players)
+    if args.stage == 'solvers':
+        return bench_solvers(args.players, args.squads)
+
+    config = configparser.ConfigParser()
+    config.read('../config/fpl-bot.ini')
+    conn = psycopg2.connect(
+        host=config.get('DATABASE', 'HOST'),
+        database=config.get('DATABASE', 'DB'),
+        user=config.get('DATABASE', 'USER'),
+        password=config.get('DATABASE', 'PASSWORD'))
+    if args.stage == 'populate':
+        bench_populate(conn, args.players)
+    if args.stage == 'query':
+        bench_query(conn, args.players, args.seasons)
+    conn.close()
+
+if __name__ == '__main__':
+    sys.exit(main())
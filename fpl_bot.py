@@ -0,0 +1,179 @@
+# -*- coding: utf-8 -*-
+import sys
+import time
+import importlib
+import traceback
+import configparser
+from argparse import ArgumentParser
+import fpl_metrics
+
+"""
+The whole pipeline in one process: import -> populate -> predict -> optimise, with the frames of the
+prediction passed to the optimiser in memory instead of reading them back from Postgres.
+With --daemon the pipeline is repeated every --interval seconds in the same process, so pandas, numpy
+and pulp are only imported once and the feature store and models stay warm.
+
+The functions of the scripts can also be used from here without running anything, e.g.
+    import fpl_bot
+    df_prediction = fpl_bot.load_predictions(conn, 'fpl')
+    mask, formation, score = fpl_bot.select_lineup(points, positions)
+Modules are only imported when one of their functions is first used.
+"""
+
+API = {
+    'load_predictions': 'fpl_optimise',
+    'prediction_frame': 'fpl_optimise',
+    'get_picks': 'fpl_optimise',
+    'select_lineup': 'fpl_optimise',
+    'select_lineup_quantile': 'fpl_optimise',
+    'suggest_transfers': 'fpl_optimise',
+    'optimise_team': 'fpl_optimise',
+    'print_result': 'fpl_optimise',
+    'run_batch': 'fpl_optimise',
+    'plan_transfers': 'fpl_planner',
+    'predict': 'fpl_prediction',
+    'round_predictions': 'fpl_prediction',
+    'load_fixture_index': 'fpl_prediction',
+    'run_prediction': 'fpl_prediction',
+    'run_populate': 'populate_tables',
+    'run_import': 'import_data',
+    'load_history': 'fpl_seasons',
+    'EMA_features': 'fpl_utils',
+    'solve': 'fpl_solver',
+    'simulate': 'fpl_simulation',
+}
+STAGES = ['import', 'populate', 'predict', 'optimise']
+
+def __getattr__(name):
+    if name in API:
+        return getattr(importlib.import_module(API[name]), name)
+    raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
+
+def __dir__():
+    return sorted(list(globals()) + list(API))
+
+def read_config(path='../config/fpl-bot.ini'):
+    config = configparser.ConfigParser()
+    config.read(path)
+    return config
+
+def connect(config):
+    import psycopg2
+    return psycopg2.connect(
+        host=config.get('DATABASE', 'HOST'),
+        database=config.get('DATABASE', 'DB'),
+        user=config.get('DATABASE', 'USER'),
+        password=config.get('DATABASE', 'PASSWORD'))
+
+def run_pipeline(config, stages=STAGES, team_ids=(), n_transfers=(1,), n_round=(1,), workers=4,
+                 base_url=None, solver=None, incremental=False, conn=None, quantile=None):
+    """Run the stages in order in this process. The prediction of the predict stage is handed to the
+    optimise stage as a frame; without the predict stage it is read from the prediction table.
+    Returns the frames and results of the stages that ran
+    """
+    import pandas as pd
+    import fpl_optimise
+    base_url = base_url or fpl_optimise.FPL_API
+    stage_dir = config.get('FILES', 'STAGE_DIR')
+    main_schema = config.get('DATABASE', 'MAIN_SCHEMA')
+    out = {}
+    timings = []
+    if 'import' in stages:
+        import import_data
+        with fpl_metrics.stage('import') as record:
+            out['import'] = import_data.run_import(stage_dir, workers=max(workers, 8), base_url=base_url,
+                                                   incremental=incremental)
+        timings.append(record)
+    if 'populate' in stages:
+        import populate_tables
+        with fpl_metrics.stage('populate') as record:
+            populate_tables.run_populate(conn, stage_dir, config.get('DATABASE', 'STAGE_SCHEMA'), main_schema,
+                                         config.get('DATABASE', 'BACKUP_SCHEMA'), incremental=incremental)
+        timings.append(record)
+    if 'predict' in stages:
+        import fpl_prediction
+        import fpl_seasons
+        with fpl_metrics.stage('predict') as record:
+            df, df_prediction = fpl_prediction.run_prediction(conn, main_schema, stage_dir,
+                                                              fpl_seasons.training_seasons(config),
+                                                              workers=workers,
+                                                              backup_schema=config.get('DATABASE', 'BACKUP_SCHEMA'))
+            out['predictions'] = fpl_optimise.prediction_frame(df, df_prediction)
+        timings.append(record)
+    if 'optimise' in stages and team_ids:
+        with fpl_metrics.stage('optimise') as record:
+            if 'predictions' not in out:
+                out['predictions'] = fpl_optimise.load_predictions(conn, main_schema)
+            df_prediction = out['predictions']
+            if len(team_ids) * len(n_transfers) * len(n_round) > 1:
+                out['optimise'] = fpl_optimise.run_batch(df_prediction, team_ids, n_transfers, n_round,
+                                                         workers=workers, backend=solver, base_url=base_url,
+                                                         quantile=quantile)
+                print(pd.DataFrame(out['optimise']).drop(
+                    columns=['transfers_out', 'transfers_in', 'time'], errors='ignore').to_string(index=False))
+            else:
+                previous_round = int(df_prediction['round'].min() - 1)
+                my_team_list, money_bank = fpl_optimise.get_picks(team_ids[0], previous_round, base_url)
+                out['optimise'] = fpl_optimise.optimise_team(df_prediction, my_team_list, money_bank,
+                                                             n_transfers[0], n_round[0], solver, quantile)
+                fpl_optimise.print_result(out['optimise'], df_prediction, money_bank, n_round[0])
+        timings.append(record)
+    print(', '.join("{}: {:.2f}s".format(r['stage'], r['time']) for r in timings))
+    return out
+
+def main():
+    import fpl_solver
+    import fpl_simulation
+    parser = ArgumentParser()
+    parser.add_argument("-s", "--stages", nargs='+', choices=STAGES, dest="stages", default=STAGES,
+                        help="Stages to run, in pipeline order")
+    parser.add_argument("-i", "--team_id", type=int, nargs='+', dest="team_id", default=[],
+                        help="Team ID(s) to optimise (the optimise stage is skipped without one)")
+    parser.add_argument("-t", "--n_transfers", type=int, nargs='+', dest="n_transfers", default=[1],
+                        help="Number(s) of transfers to suggest")
+    parser.add_argument("-r", "--n_round", type=int, nargs='+', dest="n_round", default=[1],
+                        help="Number(s) of rounds (game weeks) ahead to predict")
+    parser.add_argument("--solver", choices=fpl_solver.BACKENDS, dest="solver",
+                        help="MILP solver (default: the first available of highs, ortools, cbc)")
+    parser.add_argument("-q", "--quantile", type=fpl_simulation.quantile_value, dest="quantile",
+                        help="Maximise this quantile of the simulated points instead of the expected points")
+    parser.add_argument("-w", "--workers", type=int, dest="workers", default=4,
+                        help="Number of processes for the models and batch mode, at least 8 requests for the import")
+    parser.add_argument("--base_url", dest="base_url",
+                        help="API base url, e.g. a local stub server")
+    parser.add_argument("--incremental", action="store_true", dest="incremental",
+                        help="Only download and upsert what changed since the last run")
+    parser.add_argument("--daemon", action="store_true", dest="daemon",
+                        help="Keep running the pipeline every --interval seconds")
+    parser.add_argument("--interval", type=float, dest="interval", default=3600,
+                        help="Seconds between the runs of the daemon")
+    fpl_metrics.add_arguments(parser)
+    args = parser.parse_args()
+    stages = [s for s in STAGES if s in args.stages]
+
+    config = read_config()
+    conn = connect(config)
+    while True:
+        start = time.perf_counter()
+        fpl_metrics.start_run_from_args('fpl_bot', args)  # One report per run of the pipeline
+        try:
+            run_pipeline(config, stages, args.team_id, args.n_transfers, args.n_round, args.workers,
+                         args.base_url, args.solver, args.incremental, conn, args.quantile)
+        except Exception:
+            fpl_metrics.run['error'] = traceback.format_exc()
+            fpl_metrics.finish_run(args.report_dir)
+            if not args.daemon:
+                raise
+            traceback.print_exc()  # Keep the daemon alive, with a new connection for the next run
+            conn.close()
+            conn = connect(config)
+        else:
+            fpl_metrics.finish_run(args.report_dir)
+        print("Pipeline: {:.2f}s".format(time.perf_counter() - start))
+        if not args.daemon:
+            break
+        time.sleep(max(args.interval - (time.perf_counter() - start), 0))
+    conn.close()
+
+if __name__ == '__main__':
+    sys.exit(main())
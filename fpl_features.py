@@ -0,0 +1,122 @@
+import numpy as np
+import pandas as pd
+import fpl_utils
+import populate_tables
+import fpl_metrics
+
+"""
+Feature store for the prediction: the EMA features of finished matches are kept in
+{main_schema}.player_features and the EMA state of each player in {main_schema}.feature_state,
+so each run only computes features for the rounds finished since the last run.
+Players whose past matches were corrected or deleted by an incremental refresh of player_history
+(populate_tables.populate_main_incremental) are computed again from their whole history.
+Rebuild the store (fpl_prediction.py --rebuild_features) after changing EMA_COLUMNS or EMA_PARAMS,
+or when past rows of player_history have been corrected otherwise.
+"""
+
+EMA_COLUMNS = ['influence', 'creativity', 'threat', 'ict_index', 'bps', 'total_points']
+EMA_PARAMS = {'span': 2, 'min_periods': 2, 'threshold_minutes': 30}
+EMA_FEATURES = ['EMA_' + c for c in EMA_COLUMNS]
+STATE_COLUMNS = ['element', 'feature', 'weighted_avg', 'old_wt', 'nobs', 'last_value']
+
+def read_state(conn, main_schema):
+    return pd.read_sql(f"select {','.join(STATE_COLUMNS)} from {main_schema}.feature_state", conn)
+
+def write_rows(cur, table, df):
+    """COPY df into table, with NaN as NULL"""
+    rows = df.astype(object).where(df.notnull(), None).to_dict('records')
+    populate_tables.copy_rows(cur, table, [c.lower() for c in df.columns],
+                              ({k.lower(): v for k, v in row.items()} for row in rows))
+
+def invalidate_features(cur, main_schema, backup_schema, rebuild=False):
+    """Remove the stored features and state of the players with changes in
+    {backup_schema}.player_history_changes since the last call: a stored match updated or deleted,
+    or a match before their last stored one, so that their EMAs are computed from the start again.
+    The refresh runs up to now are then marked as done (all of them with rebuild, which empties the
+    store). Returns the number of players removed
+    """
+    cur.execute(f"select coalesce(max(run_id), 0) from {main_schema}.feature_refresh")
+    last_run = cur.fetchone()[0]
+    cur.execute(f"select coalesce(max(run_id), 0) from {backup_schema}.refresh_run")
+    current_run = cur.fetchone()[0]
+    elements = []
+    if not rebuild and current_run > last_run:
+        cur.execute(f"""select distinct c.element from {backup_schema}.player_history_changes c
+            where c.run_id > %s and c.run_id <= %s and exists (
+              select 1 from {main_schema}.player_features pf
+                left join {main_schema}.player_history ph on ph.element = pf.element and ph.fixture = pf.fixture
+              where pf.element = c.element and (pf.fixture = c.fixture or ph.round >= c.round))""",
+                    (last_run, current_run))
+        elements = [row[0] for row in cur.fetchall()]
+    if elements:
+        cur.execute(f"delete from {main_schema}.player_features where element = any(%s)", (elements,))
+        cur.execute(f"delete from {main_schema}.feature_state where element = any(%s)", (elements,))
+    if current_run > last_run:
+        cur.execute(f"delete from {main_schema}.feature_refresh")
+        cur.execute(f"insert into {main_schema}.feature_refresh (run_id) values (%s)", (current_run,))
+    return len(elements)
+
+def update_features(conn, main_schema, rebuild=False, backup_schema=None):
+    """Compute the EMA features of finished matches that are not in the store yet, continuing
+    from the stored state of each player, and save features and state.
+    With rebuild, the store is emptied and recomputed from the whole player_history. With
+    backup_schema, the players with corrected past matches are computed again first (see
+    invalidate_features).
+    Returns the state after the update.
+    """
+    with conn.cursor() as cur:
+        if rebuild:
+            cur.execute(f"truncate table {main_schema}.player_features")
+            cur.execute(f"truncate table {main_schema}.feature_state")
+        if backup_schema is not None:
+            n_invalidated = invalidate_features(cur, main_schema, backup_schema, rebuild)
+            fpl_metrics.count('invalidated_players', n_invalidated)
+            if n_invalidated:
+                print("Features of {} players with corrected matches are computed again".format(n_invalidated))
+        state = read_state(conn, main_schema)
+        new = pd.read_sql(f"""select ph.element, ph.fixture, ph.minutes, {','.join(EMA_COLUMNS)}
+            from {main_schema}.player_history ph
+            where ph.finished and not exists (select 1 from {main_schema}.player_features pf
+              where pf.element = ph.element and pf.fixture = ph.fixture)
+            order by ph.element, ph.round""", conn)
+        fpl_metrics.count('read_sql_rows', len(state) + len(new))
+        if len(new) == 0:
+            conn.commit()
+            return state
+        features, new_state = fpl_utils.EMA_features(new, EMA_COLUMNS, state=state,
+                                                     return_state=True, **EMA_PARAMS)
+        write_rows(cur, f'{main_schema}.player_features',
+                   pd.concat([new[['element', 'fixture']], features], axis=1))
+        cur.execute(f"delete from {main_schema}.feature_state where element = any(%s)",
+                    (new_state['element'].unique().tolist(),))
+        write_rows(cur, f'{main_schema}.feature_state', new_state[STATE_COLUMNS])
+    conn.commit()
+    return pd.concat([state[~state['element'].isin(new_state['element'])], new_state],
+                     ignore_index=True)
+
+def load_features(conn, main_schema, columns, rebuild=False, backup_schema=None):
+    """Return the player_history columns in columns together with the EMA features, sorted on
+    element, round. Finished matches are read from the store (after updating it); the features
+    of matches not yet played are computed from the stored state.
+    """
+    with fpl_metrics.stage('update_features'):
+        state = update_features(conn, main_schema, rebuild=rebuild, backup_schema=backup_schema)
+    columns = list(dict.fromkeys(['element', 'fixture', 'round', 'finished'] + list(columns)))
+    select = ','.join('ph.' + c for c in columns)
+    with fpl_metrics.stage('read_features'):
+        df = pd.read_sql(f"""select {select}, {','.join('pf.' + c.lower() for c in EMA_FEATURES)}
+            from {main_schema}.player_history ph
+            left join {main_schema}.player_features pf
+              on pf.element = ph.element and pf.fixture = ph.fixture
+            order by ph.element, ph.round""", conn)
+        fpl_metrics.count('read_sql_rows', len(df))
+    df = df.rename(columns={c.lower(): c for c in EMA_FEATURES})
+    unfinished = ~df['finished'].astype(bool)
+    if unfinished.any():
+        # Not played yet, so the EMAs of each player are carried forward from the state
+        future = pd.DataFrame({'element': df.loc[unfinished, 'element'].to_numpy(), 'minutes': np.nan})
+        for c in EMA_COLUMNS:
+            future[c] = np.nan
+        df.loc[unfinished, EMA_FEATURES] = fpl_utils.EMA_features(
+            future, EMA_COLUMNS, state=state, **EMA_PARAMS).values
+    return df
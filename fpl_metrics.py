@@ -0,0 +1,182 @@
+import os
+import io
+import re
+import sys
+import json
+import time
+import cProfile
+import threading
+import resource
+import tracemalloc
+from contextlib import contextmanager
+from datetime import datetime
+from argparse import ArgumentParser
+
+"""
+Instrumentation of the pipeline: stages, counters and a JSON run report.
+
+    with fpl_metrics.stage('features') as record:   # or @fpl_metrics.stage('features') on a function
+        ...
+        fpl_metrics.count('read_sql_rows', len(df))
+
+Stages nest (their path is e.g. 'predict/features'). Each stage records its wall and CPU time, the
+peak RSS of the process at its end, the counters incremented inside it and, with trace_memory, the
+peak of the Python allocations (tracemalloc, which slows the run down). With a profile directory
+every top-level stage is also profiled with cProfile (python -m pstats <file>).
+Work done in process pools is timed in the stage around the pool, but it is not profiled.
+Compare reports with python fpl_metrics.py reports/fpl_bot_*.json
+"""
+
+run = {}
+_local = threading.local()
+
+def _frames():
+    """The open stages of this thread: the threads of a server (fpl_service) each nest their own"""
+    if not hasattr(_local, 'stack'):
+        _local.stack = []
+    return _local.stack
+
+def start_run(name, profile_dir=None, trace_memory=False):
+    """Forget the stages and counters of the previous run and start a new one"""
+    run.clear()
+    del _frames()[:]
+    run.update({'name': name, 'run_id': datetime.now().strftime('%Y%m%d_%H%M%S'),
+                'started': datetime.now().isoformat(timespec='seconds'), 'argv': sys.argv[1:],
+                'stages': [], 'counters': {}, 'solves': [], 'profile_dir': profile_dir,
+                'trace_memory': trace_memory, '_start': time.perf_counter(), '_cpu': time.process_time()})
+    if trace_memory and not tracemalloc.is_tracing():
+        tracemalloc.start()
+
+def start_run_from_args(name, args):
+    """start_run with the options of add_arguments"""
+    profile_dir = None
+    if args.profile:
+        profile_dir = os.path.join(args.report_dir or '.', 'profiles')
+    start_run(name, profile_dir, args.trace_memory)
+
+def add_arguments(parser):
+    parser.add_argument("--report_dir", dest="report_dir",
+                        help="Write a JSON report of the run (time, counters and memory of each stage) to this directory")
+    parser.add_argument("--profile", action="store_true", dest="profile",
+                        help="Write a cProfile dump of each stage to REPORT_DIR/profiles")
+    parser.add_argument("--trace_memory", action="store_true", dest="trace_memory",
+                        help="Record the peak Python memory of each stage (slower)")
+
+def peak_rss_mb(who=resource.RUSAGE_SELF):
+    return resource.getrusage(who).ru_maxrss / 1024  # kB on Linux
+
+def current_stage():
+    stack = _frames()
+    return stack[-1]['path'] if stack else None
+
+@contextmanager
+def stage(name, **info):
+    """Time the block as a stage of the current run. Yields its record, which is filled in
+    when the block ends (and can take extra fields)"""
+    stack = _frames()
+    path = '/'.join([current_stage(), name]) if stack else name
+    record = {'stage': path, **info, 'counters': {}}
+    if 'stages' in run:
+        run['stages'].append(record)
+    frame = {'path': path, 'record': record, 'peak': 0}
+    if tracemalloc.is_tracing():
+        if stack:
+            stack[-1]['peak'] = max(stack[-1]['peak'], tracemalloc.get_traced_memory()[1])
+        if hasattr(tracemalloc, 'reset_peak'):  # Python 3.9+; before, a stage's peak includes the earlier stages
+            tracemalloc.reset_peak()
+    profiler = None
+    if run.get('profile_dir') and not stack:
+        profiler = cProfile.Profile()
+    stack.append(frame)
+    start, cpu = time.perf_counter(), time.process_time()
+    if profiler is not None:
+        profiler.enable()
+    try:
+        yield record
+    finally:
+        if profiler is not None:
+            profiler.disable()
+        record['time'] = time.perf_counter() - start
+        record['cpu'] = time.process_time() - cpu
+        record['peak_rss_mb'] = peak_rss_mb()
+        stack.pop()
+        if tracemalloc.is_tracing():
+            frame['peak'] = max(frame['peak'], tracemalloc.get_traced_memory()[1])
+            record['peak_traced_mb'] = frame['peak'] / 1e6
+            if stack:
+                stack[-1]['peak'] = max(stack[-1]['peak'], frame['peak'])
+        if profiler is not None:
+            os.makedirs(run['profile_dir'], exist_ok=True)
+            profiler.dump_stats(os.path.join(run['profile_dir'], '{}_{}_{}.prof'.format(
+                run['name'], run['run_id'], re.sub(r'\W+', '_', path))))
+
+def count(name, n=1):
+    """Add n to a counter of the run and of the open stages"""
+    if 'counters' in run:
+        run['counters'][name] = run['counters'].get(name, 0) + n
+    for frame in _frames():
+        counters = frame['record']['counters']
+        counters[name] = counters.get(name, 0) + n
+
+def add_solve(entry):
+    """Record a MILP solve (see fpl_solver.solve) in the run and the open stages"""
+    if 'solves' in run:
+        run['solves'].append(entry)
+    count('solves')
+    count('solve_time', entry['time'])
+
+def note(**info):
+    """Add fields to the record of the current stage"""
+    stack = _frames()
+    if stack:
+        stack[-1]['record'].update(info)
+
+def report():
+    """The run so far: its stages, counters, peak memory and MILP solves"""
+    out = {k: v for k, v in run.items() if not k.startswith('_') and k not in ('profile_dir', 'trace_memory')}
+    out['time'] = time.perf_counter() - run['_start']
+    out['cpu'] = time.process_time() - run['_cpu']
+    out['peak_rss_mb'] = peak_rss_mb()
+    out['children_peak_rss_mb'] = peak_rss_mb(resource.RUSAGE_CHILDREN)
+    return out
+
+def write_report(report_dir):
+    """Write the report of the run to report_dir/{name}_{run_id}.json and return its path"""
+    os.makedirs(report_dir, exist_ok=True)
+    path = os.path.join(report_dir, '{}_{}.json'.format(run['name'], run['run_id']))
+    with io.open(path, 'w', encoding='utf-8') as f:
+        json.dump(report(), f, indent=2, default=str)
+    return path
+
+def finish_run(report_dir):
+    """Write the report if report_dir is given"""
+    if report_dir:
+        print("Run report: {}".format(write_report(report_dir)))
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument("reports", nargs='+', help="JSON run reports, e.g. reports/fpl_bot_*.json")
+    parser.add_argument("-k", "--key", dest="key", default='time', choices=['time', 'cpu', 'peak_rss_mb'],
+                        help="Value to compare")
+    args = parser.parse_args()
+
+    runs = []
+    for path in args.reports:
+        with io.open(path, encoding='utf-8') as f:
+            runs.append(json.load(f))
+    stages = list(dict.fromkeys(s['stage'] for r in runs for s in r['stages']))
+    width = max([len(s) for s in stages] + [5])
+    print(' ' * width + ''.join('{:>17}'.format(r['run_id']) for r in runs))
+    for name in stages + ['total']:
+        values = []
+        for r in runs:
+            if name == 'total':
+                values.append(r.get(args.key))
+            else:
+                values.append(sum(s.get(args.key, 0) for s in r['stages'] if s['stage'] == name)
+                              if any(s['stage'] == name for s in r['stages']) else None)
+        print('{:<{}}'.format(name, width) + ''.join(
+            '{:>17}'.format('-' if v is None else '{:.3f}'.format(v)) for v in values))
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,100 @@
+import os
+import io
+import pickle
+import hashlib
+import numpy as np
+
+"""Prediction models and the on-disk cache of fitted models"""
+
+class IncrementalRidge:
+    """The estimator of Pipeline([StandardScaler(), Ridge(alpha)]) computed in closed form from
+    running sufficient statistics (count, means and centred co-moments), so that partial_fit
+    with new rows gives the same model as refitting on all rows.
+    """
+    def __init__(self, alpha=0.5):
+        self.alpha = alpha
+        self.n = 0
+
+    def fit(self, X, y):
+        self.n = 0
+        return self.partial_fit(X, y)
+
+    def partial_fit(self, X, y):
+        X = np.asarray(X, dtype='float64')
+        y = np.asarray(y, dtype='float64')
+        n_b = len(y)
+        if n_b == 0:
+            return self
+        mean_x_b = X.mean(axis=0)
+        mean_y_b = y.mean()
+        Xc = X - mean_x_b
+        yc = y - mean_y_b
+        M2_b = Xc.T @ Xc
+        Sxy_b = Xc.T @ yc
+        if self.n == 0:
+            self.n, self.mean_x, self.mean_y, self.M2, self.Sxy = n_b, mean_x_b, mean_y_b, M2_b, Sxy_b
+        else:
+            # Chan et al.'s pairwise update of means and co-moments
+            n = self.n + n_b
+            dx = mean_x_b - self.mean_x
+            dy = mean_y_b - self.mean_y
+            factor = self.n * n_b / n
+            self.M2 = self.M2 + M2_b + factor * np.outer(dx, dx)
+            self.Sxy = self.Sxy + Sxy_b + factor * dx * dy
+            self.mean_x = self.mean_x + dx * n_b / n
+            self.mean_y = self.mean_y + dy * n_b / n
+            self.n = n
+        self._solve()
+        return self
+
+    def _solve(self):
+        scale = np.sqrt(np.diag(self.M2) / self.n)
+        scale[scale < 10 * np.finfo(scale.dtype).eps] = 1.0  # As StandardScaler for constant features
+        self.scale_ = scale
+        gram = self.M2 / np.outer(scale, scale)
+        self.coef_ = np.linalg.solve(gram + self.alpha * np.eye(len(scale)), self.Sxy / scale)
+        self.intercept_ = self.mean_y
+
+    def predict(self, X):
+        X = np.asarray(X, dtype='float64')
+        return self.intercept_ + ((X - self.mean_x) / self.scale_) @ self.coef_
+
+
+def fingerprint(features, X, y):
+    h = hashlib.sha1(repr(features).encode())
+    h.update(np.ascontiguousarray(X, dtype='float64').tobytes())
+    h.update(np.ascontiguousarray(y, dtype='float64').tobytes())
+    return h.hexdigest()
+
+def fit_cached(model_dir, name, make_model, features, X, y, rounds):
+    """Return a fitted model for (X, y) and how it was obtained, using the model cached in
+    model_dir under name: 'cached' if it was fitted on the same data and features, 'updated'
+    (partial_fit with the new rows only) if the data only gained rows after the last round it
+    was fitted on, and otherwise 'fitted' from scratch with make_model().
+    X, y and rounds must be in a deterministic order, e.g. sorted on element, fixture.
+    """
+    path = os.path.join(model_dir, name + '.pkl')
+    try:
+        with io.open(path, 'rb') as f:
+            cached = pickle.load(f)
+    except (FileNotFoundError, EOFError, pickle.UnpicklingError):
+        cached = None
+    spec = repr(sorted(vars(make_model()).items()))  # Model class parameters, e.g. alpha
+    status = 'fitted'
+    if cached is not None and cached['features'] == features and cached['spec'] == spec:
+        if cached['fingerprint'] == fingerprint(features, X, y):
+            return cached['model'], 'cached'
+        old = rounds <= cached['max_round']
+        if (old.sum() == cached['n_rows'] and hasattr(cached['model'], 'partial_fit')
+                and cached['fingerprint'] == fingerprint(features, X[old], y[old])):
+            model = cached['model'].partial_fit(X[~old], y[~old])
+            status = 'updated'
+    if status == 'fitted':
+        model = make_model().fit(X, y)
+    max_round = rounds.max() if len(rounds) else -1
+    os.makedirs(model_dir, exist_ok=True)
+    with io.open(path + '.tmp', 'wb') as outfile:
+        pickle.dump({'model': model, 'features': features, 'spec': spec, 'max_round': max_round,
+                     'n_rows': len(y), 'fingerprint': fingerprint(features, X, y)}, outfile)
+    os.replace(path + '.tmp', path)
+    return model, status
@@ -1,201 +1,430 @@
+import io
+import sys
+import json
+import time
+import itertools
 from argparse import ArgumentParser
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 import pandas as pd
 import numpy as np
 import requests
 import pulp
 import configparser
 import psycopg2
+import fpl_solver
+import fpl_metrics
+import fpl_simulation
+import import_data
+import populate_tables
 pd.options.mode.chained_assignment = None  # default='warn'
 pd.set_option('display.precision', 1)
 
 """Optimise team and suggest transfers based on predictions"""
 
-parser = ArgumentParser()
-parser.add_argument("-i", "--team_id", type=int, dest="team_id", help="Team ID, e.g. 5977880")
-parser.add_argument("-t", "--n_transfers", type=int, dest="n_transfers", help="Number of transfers to suggest")
-parser.add_argument("-r", "--n_round", type=int, dest="n_round", help="Number of rounds (game weeks) ahead to predict")
-args = parser.parse_args()
-
-team_id = args.team_id
-n_transfers = args.n_transfers
-n_round = args.n_round
-
-config = configparser.ConfigParser()
-config.read('../config/fpl-bot.ini')
-stage_dir = config.get('FILES', 'STAGE_DIR')
-main_schema = config.get('DATABASE', 'MAIN_SCHEMA')
-
-conn = psycopg2.connect(
-    host=config.get('DATABASE', 'HOST'),
-    database=config.get('DATABASE', 'DB'),
-    user=config.get('DATABASE', 'USER'),
-    password=config.get('DATABASE', 'PASSWORD'))
-
-# Get prediction data together with the latest cost for each player
-sql = f"""with ranked_value as (
-           select element, round, value,
-           row_number() over (partition by element order by round desc) as rn 
-           from {main_schema}.player_history where value is not null)
-         select p.*, ph."position", ph.web_name, ph.name_own_team, rv.value/10.0 as now_cost
-          from {main_schema}.prediction p join {main_schema}.player_history ph
-           on ph."element" = p."element" and  ph.round = p.round
-           left join ranked_value rv on ph."element" = rv.element
-           where rv.rn=1;"""
-df_prediction = pd.read_sql(sql, conn)
-conn.close()
-
-
-## Optimize team *************************************
-previous_round = int(df_prediction['round'].min() - 1) # The gameweek must be completely finished
-
-team_picks=requests.get('https://fantasy.premierleague.com/api/entry/'+str(team_id)+ \
-    '/event/'+str(previous_round)+'/picks/').json()
-df_team=pd.DataFrame(team_picks['picks'])
-my_team_list=list(df_team.element)
-#my_team_list=[400, 247, 28, 267, 40, 276, 433, 253, 22, 45, 280, 445, 149, 142, 427] #If testing
-money_bank = team_picks['entry_history']['bank']/10.
-
-df_prediction['next_fixture'] = df_prediction.groupby(by=['element'])['round'].transform(lambda x: x.rank())
-
-# Should perhaps only use 1 round ahead here? Or compare several rounds ahead?
-my_team=df_prediction[(df_prediction.element.isin(my_team_list)) & \
-     (df_prediction.next_fixture==n_round)]
-my_team=pd.concat([my_team,pd.get_dummies(my_team[['position', 'name_own_team']])],axis=1)
-my_team['points_cumulative']=my_team['points_cumulative'].fillna(0)
-
-#Okay then optimize:
-print('Finding the optimal formation (without making transfers):')
-possible_formations=['1-4-4-2','1-4-3-3','1-4-5-1','1-3-5-2','1-3-4-3', \
+FPL_API = 'https://fantasy.premierleague.com/api'
+POSITIONS = ['GKP', 'DEF', 'MID', 'FWD']
+# Number of players of each position in the starting 11
+FORMATION_RANGES = {'GKP': (1, 1), 'DEF': (3, 5), 'MID': (2, 5), 'FWD': (1, 3)}
+POSSIBLE_FORMATIONS = ['1-4-4-2','1-4-3-3','1-4-5-1','1-3-5-2','1-3-4-3', \
     '1-5-4-1','1-5-3-2','1-5-2-3']
-max_score=0
-for i, formation in enumerate(possible_formations):
-    #### Initialise the problem and define the objective function
+MAX_PER_CLUB = 3
+SHOW_COLUMNS = ['element','web_name','name_own_team','position','now_cost','points_cumulative']
+sort_order = {'GKP': 0, 'DEF': 1, 'MID': 2, 'FWD': 3}
+
+def rounds_ahead(rounds):
+    """1 for the first predicted round, 2 for the one after it and so on. The predictions have a row
+    for every round (0 points in blank gameweeks), so this is the same round for all players"""
+    rounds = np.asarray(rounds)
+    return np.searchsorted(np.unique(rounds), rounds) + 1
+
+def load_predictions(conn, main_schema):
+    """Get prediction data together with the latest cost for each player and the number of
+    fixtures of the player's team in each round"""
+    sql = populate_tables.read_sql('sql/DQL_predictions.sql', main_schema=main_schema)
+    df_prediction = pd.read_sql(sql, conn).sort_values(['element', 'round'], kind='stable').reset_index(drop=True)
+    df_prediction['next_fixture'] = rounds_ahead(df_prediction['round'])
+    return df_prediction
+
+def prediction_run(conn, main_schema):
+    """The id of the latest write of the prediction table, None if it was never written"""
+    with conn.cursor() as cur:
+        cur.execute(f"select max(run_id) from {main_schema}.prediction_run")
+        return cur.fetchone()[0]
+
+def prediction_frame(df, df_prediction):
+    """The frame of load_predictions from the player_history frame and the predictions of
+    fpl_prediction.run_prediction in memory, instead of reading the prediction table back
+    """
+    latest = (df[df['value'].notnull()].sort_values('round', kind='stable')
+              .groupby('element')[['position', 'web_name', 'name_own_team', 'value']].last())
+    latest['now_cost'] = latest.pop('value') / 10.0
+    predictions = df_prediction[['element', 'round', 'points', 'points_cumulative', 'points_std',
+                                 'points_std_cumulative', 'n_fixtures']]
+    predictions['round'] = predictions['round'].astype('int64')
+    df_prediction = (predictions.merge(latest.reset_index(), on='element')
+                     .sort_values(['element', 'round'], kind='stable').reset_index(drop=True))
+    df_prediction = df_prediction[['element', 'round', 'points', 'points_cumulative', 'points_std',
+                                   'points_std_cumulative', 'position', 'web_name', 'name_own_team', 'now_cost',
+                                   'n_fixtures']]
+    df_prediction['next_fixture'] = rounds_ahead(df_prediction['round'])
+    return df_prediction
+
+def get_picks(team_id, event, base_url=FPL_API, session=None):
+    """The 15 elements picked by team_id in gameweek event and the money in the bank"""
+    response=(session or requests).get(base_url+'/entry/'+str(team_id)+ \
+        '/event/'+str(event)+'/picks/')
+    response.raise_for_status()  # e.g. an unknown team id
+    team_picks=response.json()
+    df_team=pd.DataFrame(team_picks['picks'])
+    money_bank = team_picks['entry_history']['bank']/10.
+    return list(df_team.element), money_bank
+
+def formation_counts(formation):
+    """'1-4-4-2' -> [1, 4, 4, 2]"""
+    return [int(i) for i in formation.split('-')]
+
+def formation_scores(points, positions, formations=POSSIBLE_FORMATIONS):
+    """The highest total points of each formation, i.e. the sum of the best n players of each
+    position (-inf if the squad has too few players for it). points may have leading dimensions,
+    e.g. one row per simulation, giving scores of shape points.shape[:-1] + (len(formations),)
+    """
+    points = np.asarray(points, dtype='float64')
+    positions = np.asarray(positions)
+    counts = np.array([formation_counts(f) for f in formations])
+    scores = np.zeros(points.shape[:-1] + (len(formations),))
+    for p, pos in enumerate(POSITIONS):
+        best = -np.sort(-points[..., positions == pos], axis=-1)
+        prefix = np.concatenate([np.zeros(points.shape[:-1] + (1,)), np.cumsum(best, axis=-1)], axis=-1)
+        n = best.shape[-1]
+        scores += np.where(counts[:, p] <= n, prefix[..., np.minimum(counts[:, p], n)], -np.inf)
+    return scores
+
+def select_lineup(points, positions, formations=POSSIBLE_FORMATIONS):
+    """Exact lineup selection without a solver: the best players of each position for every formation.
+    Returns a boolean mask of the selected players, the formation and the predicted points
+    (for equal scores the last formation, as the previous loop over formations)
+    """
+    points = np.asarray(points, dtype='float64')
+    positions = np.asarray(positions)
+    scores = formation_scores(points, positions, formations)
+    best = len(scores) - 1 - int(np.argmax(scores[::-1]))
+    selected = np.zeros(len(points), dtype=bool)
+    for pos, n in zip(POSITIONS, formation_counts(formations[best])):
+        rows = np.flatnonzero(positions == pos)
+        selected[rows[np.argsort(-points[rows], kind='stable')[:n]]] = True
+    return selected, formations[best], scores[best]
+
+def lineup_matrix(positions, formations=POSSIBLE_FORMATIONS):
+    """Every lineup of the squad in each formation: a boolean array with a row per lineup and a
+    column per player, and the index in formations of each row"""
+    positions = np.asarray(positions)
+    lineups, formation_index = [], []
+    for i, formation in enumerate(formations):
+        choices = [itertools.combinations(np.flatnonzero(positions == pos), n)
+                   for pos, n in zip(POSITIONS, formation_counts(formation))]
+        for players in itertools.product(*choices):
+            lineup = np.zeros(len(positions), dtype=bool)
+            lineup[list(itertools.chain(*players))] = True
+            lineups.append(lineup)
+            formation_index.append(i)
+    return np.array(lineups).reshape(-1, len(positions)), np.array(formation_index, dtype='int64')
+
+def select_lineup_quantile(samples, positions, quantile, formations=POSSIBLE_FORMATIONS):
+    """The lineup with the highest quantile of its total points over the samples (rows) of the
+    points of the squad (see fpl_simulation.simulate), by scoring every lineup on every sample.
+    Returns a boolean mask of the selected players, the formation, its quantile and the highest
+    quantile of each formation (-inf if the squad has too few players for it)
+    """
+    lineups, formation_index = lineup_matrix(positions, formations)
+    if len(lineups) == 0:
+        raise ValueError('No lineup of the squad fits any formation')
+    scores = np.full(len(formations), -np.inf)
+    totals = lineups.astype(samples.dtype) @ samples.T  # Points of every lineup (rows) in every sample
+    quantiles = fpl_simulation.sample_quantile(totals, quantile)
+    np.maximum.at(scores, formation_index, quantiles)
+    best = int(np.argmax(quantiles))
+    return lineups[best], formations[formation_index[best]], float(quantiles[best]), scores
+
+def lp_sum(variables, coefficients=None):
+    """sum(coefficients * variables) as one LpAffineExpression built from the (variable, coefficient)
+    pairs, instead of adding up the terms one by one as sum() and lpSum do"""
+    if coefficients is None:
+        return pulp.LpAffineExpression([(x, 1) for x in variables])
+    return pulp.LpAffineExpression([(x, float(c)) for x, c in zip(variables, coefficients) if c != 0])
+
+def variable_array(name, shape, cat=pulp.LpBinary, lowBound=None, upBound=None):
+    """A numpy array of variables named name_i_j..., to be sliced with masks"""
+    variables = np.empty(shape, dtype=object)
+    for index in np.ndindex(*variables.shape):
+        variables[index] = pulp.LpVariable('_'.join([name] + [str(i) for i in index]),
+                                           lowBound=lowBound, upBound=upBound, cat=cat)
+    return variables
+
+def select_lineup_milp(points, positions, ranges=FORMATION_RANGES, backend=None):
+    """The same selection as one MILP: pick 11 players within the range of each position.
+    Returns a boolean mask of the selected players, the formation and the predicted points
+    (ValueError if the squad has too few players for any formation)
+    """
+    points = np.asarray(points, dtype='float64')
+    positions = np.asarray(positions)
+    fpl_problem = pulp.LpProblem('Lineup', pulp.LpMaximize)
+    x = variable_array('x', len(points))
+    fpl_problem += lp_sum(x, points)
+    for pos, (low, high) in ranges.items():
+        fpl_problem += lp_sum(x[positions == pos]) >= low
+        fpl_problem += lp_sum(x[positions == pos]) <= high
+    fpl_problem += lp_sum(x) == 11
+    fpl_solver.solve(fpl_problem, backend)
+    if fpl_problem.sol_status not in (pulp.LpSolutionOptimal, pulp.LpSolutionIntegerFeasible):
+        raise ValueError('No lineup of the squad fits any formation')
+    selected = np.array([v.varValue > 0.5 for v in x])
+    formation = '-'.join(str(int((positions[selected] == pos).sum())) for pos in POSITIONS)
+    return selected, formation, float(points[selected].sum())
+
+def transfer_model(available_players, lineup, budget, formation, n_transfers):
+    """The MILP for the best 11 of available_players in formation within budget, keeping
+    11-n_transfers of the elements in lineup, at most MAX_PER_CLUB per club.
+    Returns the problem and the variable of each row of available_players
+    """
     fpl_problem = pulp.LpProblem('FPL', pulp.LpMaximize)
-    players=my_team.element
-    # create a dictionary of pulp variables with keys from names
-    x = pulp.LpVariable.dict('x % s', players, lowBound=0, upBound=1,cat=pulp.LpInteger)
-    # player score data
-    player_points = dict(zip(my_team.element, np.array(my_team.points_cumulative)))
-    # objective function
-    fpl_problem += sum([player_points[i] * x[i] for i in players])
-    #### Set and apply constraints
-    position_names = ['GKP', 'DEF', 'MID', 'FWD']
-    position_constraints = [int(i) for i in formation.split('-')]
-    constraints = dict(zip(position_names, position_constraints))
-    #constraints['total_cost'] = 100 #Not needed here?
-    constraints['total_players'] = 11 #Select 11 out of 15
-    player_cost = dict(zip(my_team.element, my_team.now_cost))
-    player_gkp=my_team[my_team.position_GKP==1]['element'].values
-    player_def=my_team[my_team.position_DEF==1]['element'].values
-    player_mid=my_team[my_team.position_MID==1]['element'].values
-    player_fwd=my_team[my_team.position_FWD==1]['element'].values
-
-    #apply the constraints
-    #fpl_problem += sum([player_cost[i] * x[i] for i in players]) <= float(constraints['total_cost'])
-    fpl_problem += sum([x[i] for i in player_gkp]) == constraints['GKP']
-    fpl_problem += sum([x[i] for i in player_def]) == constraints['DEF']
-    fpl_problem += sum([x[i] for i in player_mid]) == constraints['MID']
-    fpl_problem += sum([x[i] for i in player_fwd]) == constraints['FWD']
-    fpl_problem += sum([x[i] for i in players]) == constraints['total_players']
-    #print(fpl_problem)
-
-    ####Solve
-    fpl_problem.solve(pulp.PULP_CBC_CMD(msg=0))
-    #print("Status:", pulp.LpStatus[fpl_problem.status])
-    #for v in fpl_problem.variables(): print(v.name, "=", v.varValue)
+    x = variable_array('x', len(available_players))
+    fpl_problem += lp_sum(x, available_players.points_cumulative.values)
+    fpl_problem += lp_sum(x, available_players.now_cost.values) <= float(budget)
+    positions = available_players.position.values
+    for pos, n in zip(POSITIONS, formation_counts(formation)):
+        fpl_problem += lp_sum(x[positions == pos]) == n
+    fpl_problem += lp_sum(x) == 11 #Select 11 out of all available (skip the bench)
+    fpl_problem += lp_sum(x[available_players.element.isin(lineup).values]) == 11 - n_transfers
+    #Ok? But what about the bench? Remove or what?
+    clubs = available_players.name_own_team.values
+    for club in np.unique(clubs):  # One constraint per club, not one per player
+        fpl_problem += lp_sum(x[clubs == club]) <= MAX_PER_CLUB
+    return fpl_problem, x
+
+def suggest_transfers(df_prediction, optimal_my_team, money_bank, formation, n_transfers, n_round,
+                      backend=None, quantile=None, n_samples=fpl_simulation.N_SAMPLES):
+    """Best 11 players of all available players in formation, keeping 11-n_transfers of optimal_my_team.
+    With a quantile, the MILP maximises the sum of the quantiles of the players' points (the quantile
+    of a sum is not linear), and the predicted points are the simulated quantile of the new team.
+    Returns the new team and the predicted points
+    """
+    available_players=df_prediction[(df_prediction.next_fixture==n_round) & \
+        (df_prediction.points_cumulative.notnull())].reset_index(drop=True)
+    objective_players = available_players
+    if quantile is not None:
+        objective_players = available_players.assign(points_cumulative=fpl_simulation.quantile_points(
+            available_players.points_cumulative, available_players.points_std_cumulative, quantile))
+
+    available_budget = optimal_my_team.now_cost.sum() + money_bank
+    fpl_problem, x = transfer_model(objective_players, optimal_my_team.element.values, available_budget,
+                                    formation, n_transfers)
+    fpl_solver.solve(fpl_problem, backend)
+    if fpl_problem.sol_status not in (pulp.LpSolutionOptimal, pulp.LpSolutionIntegerFeasible):
+        # e.g. a lineup of fewer than 11 players, or too little money to replace the players sold
+        raise ValueError('No team found with {} transfer(s) in formation {}: {}'.format(
+            n_transfers, formation, pulp.LpStatus[fpl_problem.status]))
     maximised_points=pulp.value(fpl_problem.objective)
-    print("{} round(s) ahead with formation {}, the optimal team predicts {:.1f} points".format(n_round,\
-         formation,maximised_points))
-    if maximised_points>=max_score:
-        max_score=maximised_points
-        best_formation=formation
-        foo=[[int(v.name[2:]), v.varValue] for v in fpl_problem.variables()]
-        chosen_players=[v[0] for v in foo if v[1]==1]
-        optimal_my_team=my_team[my_team.element.isin(chosen_players)][['element','web_name',\
-            'name_own_team','position','now_cost','points_cumulative']]
-        bench_my_team=my_team[~my_team.element.isin(chosen_players)][['element','web_name',\
-            'name_own_team','position','now_cost','points_cumulative']]
+    chosen = np.array([v.varValue > 0.5 for v in x])
+    new_team=available_players[chosen][SHOW_COLUMNS]
+    if quantile is not None:
+        samples = fpl_simulation.simulate(available_players.points_cumulative[chosen],
+                                          available_players.points_std_cumulative[chosen], n_samples)
+        maximised_points = float(np.quantile(samples.sum(axis=1), quantile))
+    return new_team, maximised_points
 
-sort_order = {'GKP': 0, 'DEF': 1, 'MID': 2, 'FWD': 3}
-print("{} round(s) ahead with formation {}, the optimal team predicts {:.1f} points (the highest score)\n".format(n_round, \
-    best_formation,max_score))
-print('Optimal team (without making any transfers):')
-print(optimal_my_team.drop('element',axis=1).sort_values(by=['position'], key=lambda x: x.map(sort_order)).to_string(index=False))
-print("\nBench:\n", bench_my_team.drop('element',axis=1).sort_values(by=['position'], key=lambda x: x.map(sort_order)).to_string(index=False))
-
-### Find optimal transfers
-# Note: There are some issues with blank GWs, the points should perhaps be set to zero where there are no matches
-available_players=df_prediction[(df_prediction.next_fixture==n_round) & \
-    (df_prediction.points_cumulative.notnull())].reset_index(drop=True)
-available_players=pd.concat([available_players,pd.get_dummies(\
-    available_players[['position', 'name_own_team']])],axis=1)
-available_players.loc[available_players['element'].isin(my_team.element),'my_team']=1
-
-team_value = optimal_my_team.now_cost.sum()
-available_budget = team_value + money_bank
-print("\nTeam value (11 players): {:,.1f}\nMoney in bank: {}".format(team_value, money_bank))
-
-fpl_problem = pulp.LpProblem('FPL', pulp.LpMaximize)
-players=available_players.element
-# create a dictionary of pulp variables with keys from names
-x = pulp.LpVariable.dict('x % s', players, lowBound=0, upBound=1,cat=pulp.LpInteger)
-# player score data
-player_points = dict(zip(available_players.element, np.array(available_players.points_cumulative)))
-# objective function
-fpl_problem += sum([player_points[i] * x[i] for i in players])
-
-#### Set and apply constraints
-formation=best_formation
-position_names = ['GKP', 'DEF', 'MID', 'FWD']
-position_constraints = [int(i) for i in formation.split('-')]
-constraints = dict(zip(position_names, position_constraints))
-constraints['total_cost'] = available_budget
-constraints['team'] = 3
-constraints['total_players'] = 11 #Select 11 out of all available (skip the bench)
-constraints['players_previous_team'] = 11-n_transfers
-
-player_cost = dict(zip(available_players.element, available_players.now_cost))
-player_gkp=available_players[available_players.position_GKP==1]['element'].values
-player_def=available_players[available_players.position_DEF==1]['element'].values
-player_mid=available_players[available_players.position_MID==1]['element'].values
-player_fwd=available_players[available_players.position_FWD==1]['element'].values
-
-#apply the constraints
-fpl_problem += sum([player_cost[i] * x[i] for i in players]) <= float(constraints['total_cost'])
-fpl_problem += sum([x[i] for i in player_gkp]) == constraints['GKP']
-fpl_problem += sum([x[i] for i in player_def]) == constraints['DEF']
-fpl_problem += sum([x[i] for i in player_mid]) == constraints['MID']
-fpl_problem += sum([x[i] for i in player_fwd]) == constraints['FWD']
-fpl_problem += sum([x[i] for i in players]) == constraints['total_players'] #Choose 11 players
-fpl_problem += sum([x[i] for i in optimal_my_team.element.values]) == constraints['players_previous_team']
-#Ok? But what about the bench? Remove or what?
-
-# Try to fix team constraint
-for t in available_players.name_own_team:
-    player_team = dict(
-        zip(available_players.element, available_players['name_own_team_' + str(t)]))
-    fpl_problem += sum([player_team[i] * x[i] for i in players]) <= constraints['team']
-# What about cost?
-
-###Solve
-fpl_problem.solve(pulp.PULP_CBC_CMD(msg=0))
-#print("Status:", pulp.LpStatus[fpl_problem.status])
-#for v in fpl_problem.variables(): print(v.name, "=", v.varValue)
-maximised_points=pulp.value(fpl_problem.objective)
-
-foo=[[int(v.name[2:]), v.varValue] for v in fpl_problem.variables()]
-chosen_players=[v[0] for v in foo if v[1]==1]
-new_team=available_players[available_players.element.isin(chosen_players)][['element','web_name',\
-    'name_own_team','position','now_cost','points_cumulative']]
-
-set1=set(optimal_my_team.element.values) #Original team
-set2=set(new_team.element.values)
-players_out=df_prediction[(df_prediction.element.isin(set1.difference(set2))) & \
-    (df_prediction.next_fixture==n_round)]
-players_in=df_prediction[(df_prediction.element.isin(set2.difference(set1))) & \
-    (df_prediction.next_fixture==n_round)]
-print("\nSuggested transfers (using formation {}):\n Out:\n {}\n\n In:\n {}".format(best_formation, players_out[['web_name', 'name_own_team', 'position', 'now_cost', 'points_cumulative']].to_string(index=False), players_in[['web_name', 'name_own_team', 'position', 'now_cost', 'points_cumulative']].to_string(index=False)))
-
-print("\n{} round(s) ahead with formation {}, the optimal team predicts {:.1f} points with the following team:".\
-    format(n_round, formation,maximised_points))
-print(new_team.drop('element',axis=1).sort_values(by=['position'], key=lambda x: x.map(sort_order)).to_string(index=False))
+def best_lineup(my_team, quantile=None, n_samples=fpl_simulation.N_SAMPLES):
+    """The lineup of the squad my_team (its rows of one round) with the highest expected points, or
+    quantile of the simulated points. Returns the mask of the selected rows, the formation, its points
+    and the points of each formation
+    """
+    # All formations are scored at once from the best players of each position (no solver needed)
+    if quantile is None:
+        scores = formation_scores(my_team.points_cumulative, my_team.position)
+        selected, formation, points = select_lineup(my_team.points_cumulative, my_team.position)
+        return selected, formation, points, scores
+    samples = fpl_simulation.simulate(my_team.points_cumulative, my_team.points_std_cumulative, n_samples)
+    return select_lineup_quantile(samples, my_team.position.values, quantile)
+
+def optimise_team(df_prediction, my_team_list, money_bank, n_transfers, n_round, backend=None,
+                  quantile=None, n_samples=fpl_simulation.N_SAMPLES):
+    """The best lineup of the squad my_team_list for the predicted points n_round rounds ahead and the
+    best team after n_transfers transfers. Returns a dict with the score of each formation, the lineup,
+    bench, new team (dataframes) and predicted points.
+    The predicted points are expected points, or with a quantile (e.g. 0.2 for a cautious team) that
+    quantile of the points over n_samples simulations of the squad
+    """
+    # Should perhaps only use 1 round ahead here? Or compare several rounds ahead?
+    my_team=df_prediction[(df_prediction.element.isin(my_team_list)) & \
+         (df_prediction.next_fixture==n_round)]
+    my_team['points_cumulative']=my_team['points_cumulative'].fillna(0)
+
+    with fpl_metrics.stage('lineup'):
+        selected, best_formation, max_score, scores = best_lineup(my_team, quantile, n_samples)
+        optimal_my_team=my_team[selected][SHOW_COLUMNS]
+
+    ### Find optimal transfers
+    with fpl_metrics.stage('transfers'):
+        new_team, maximised_points = suggest_transfers(df_prediction, optimal_my_team, money_bank,
+                                                       best_formation, n_transfers, n_round, backend,
+                                                       quantile, n_samples)
+    return {'formation_scores': dict(zip(POSSIBLE_FORMATIONS, scores)), 'formation': best_formation,
+            'points': max_score, 'lineup': optimal_my_team, 'bench': my_team[~selected][SHOW_COLUMNS],
+            'new_team': new_team, 'new_points': maximised_points, 'quantile': quantile}
+
+def print_result(result, df_prediction, money_bank, n_round):
+    best_formation = result['formation']
+    optimal_my_team, new_team = result['lineup'], result['new_team']
+    # Expected points, or e.g. "points (20% quantile)"
+    points = 'points' if result.get('quantile') is None else 'points ({:.0%} quantile)'.format(result['quantile'])
+    print('Finding the optimal formation (without making transfers):')
+    for formation, score in result['formation_scores'].items():
+        print("{} round(s) ahead with formation {}, the optimal team predicts {:.1f} {}".format(n_round,\
+             formation,score,points))
+    print("{} round(s) ahead with formation {}, the optimal team predicts {:.1f} {} (the highest score)\n".format(n_round, \
+        best_formation,result['points'],points))
+    print('Optimal team (without making any transfers):')
+    print(optimal_my_team.drop('element',axis=1).sort_values(by=['position'], key=lambda x: x.map(sort_order)).to_string(index=False))
+    print("\nBench:\n", result['bench'].drop('element',axis=1).sort_values(by=['position'], key=lambda x: x.map(sort_order)).to_string(index=False))
+
+    team_value = optimal_my_team.now_cost.sum()
+    print("\nTeam value (11 players): {:,.1f}\nMoney in bank: {}".format(team_value, money_bank))
+    set1=set(optimal_my_team.element.values) #Original team
+    set2=set(new_team.element.values)
+    players_out=df_prediction[(df_prediction.element.isin(set1.difference(set2))) & \
+        (df_prediction.next_fixture==n_round)]
+    players_in=df_prediction[(df_prediction.element.isin(set2.difference(set1))) & \
+        (df_prediction.next_fixture==n_round)]
+    print("\nSuggested transfers (using formation {}):\n Out:\n {}\n\n In:\n {}".format(best_formation, players_out[['web_name', 'name_own_team', 'position', 'now_cost', 'points_cumulative']].to_string(index=False), players_in[['web_name', 'name_own_team', 'position', 'now_cost', 'points_cumulative']].to_string(index=False)))
+
+    print("\n{} round(s) ahead with formation {}, the optimal team predicts {:.1f} {} with the following team:".\
+        format(n_round, best_formation,result['new_points'],points))
+    print(new_team.drop('element',axis=1).sort_values(by=['position'], key=lambda x: x.map(sort_order)).to_string(index=False))
+
+## Batch mode: many teams and scenarios with the predictions loaded once *****************
+_batch_prediction = None
+
+def _init_batch_worker(df_prediction):
+    global _batch_prediction
+    _batch_prediction = df_prediction  # Sent once to each worker process instead of with every job
+
+def batch_job(team_id, my_team_list, money_bank, n_transfers, n_round, backend=None, quantile=None):
+    """One scenario of the batch, as a flat record"""
+    record = {'team_id': team_id, 'n_transfers': n_transfers, 'n_round': n_round}
+    start = time.perf_counter()
+    try:
+        result = optimise_team(_batch_prediction, my_team_list, money_bank, n_transfers, n_round, backend,
+                               quantile)
+    except Exception as e:  # One failing team (e.g. incomplete predictions) should not stop the batch
+        record['error'] = repr(e)
+        return record
+    lineup, new_team = set(result['lineup'].element), set(result['new_team'].element)
+    record.update({'formation': result['formation'], 'points': float(result['points']),
+                   'new_points': result['new_points'],
+                   'transfers_out': sorted(int(e) for e in lineup - new_team),
+                   'transfers_in': sorted(int(e) for e in new_team - lineup),
+                   'time': time.perf_counter() - start})
+    return record
+
+def run_batch(df_prediction, team_ids, transfers_grid, rounds_grid, workers=4, backend=None,
+              base_url=FPL_API, quantile=None):
+    """Optimise every team in team_ids for every number of transfers and rounds ahead in the grids.
+    The picks are fetched concurrently, the scenarios are solved in a process pool (in this process
+    if workers=1). Returns a list of records, one per team and scenario
+    """
+    previous_round = int(df_prediction['round'].min() - 1) # The gameweek must be completely finished
+    session = import_data.make_session(max_workers=8)
+    def picks(team_id):
+        try:
+            return get_picks(team_id, previous_round, base_url, session)
+        except (requests.RequestException, KeyError, ValueError) as e:
+            return e
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        team_picks = dict(zip(team_ids, executor.map(picks, team_ids)))
+    records, jobs = [], []
+    for team_id in team_ids:
+        if isinstance(team_picks[team_id], Exception):
+            records.append({'team_id': team_id, 'error': repr(team_picks[team_id])})
+            continue
+        jobs += [(team_id,) + team_picks[team_id] + (n_transfers, n_round, backend, quantile)
+                 for n_transfers in transfers_grid for n_round in rounds_grid]
+    if workers > 1:
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_batch_worker,
+                                 initargs=(df_prediction,)) as executor:
+            records += executor.map(batch_job, *zip(*jobs), chunksize=max(len(jobs) // (4 * workers), 1))
+    else:
+        _init_batch_worker(df_prediction)
+        records += [batch_job(*job) for job in jobs]
+    return records
+
+def write_batch(records, path):
+    """Write the batch results as JSON, or as a table if path ends with .csv"""
+    if path.endswith('.csv'):
+        pd.DataFrame(records).to_csv(path, index=False)
+    else:
+        with io.open(path, 'w', encoding='utf-8') as outfile:
+            json.dump(records, outfile, indent=1)
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument("-i", "--team_id", type=int, nargs='+', dest="team_id", help="Team ID(s), e.g. 5977880")
+    parser.add_argument("-t", "--n_transfers", type=int, nargs='+', dest="n_transfers", help="Number(s) of transfers to suggest")
+    parser.add_argument("-r", "--n_round", type=int, nargs='+', dest="n_round", help="Number(s) of rounds (game weeks) ahead to predict")
+    parser.add_argument("--solver", choices=fpl_solver.BACKENDS, dest="solver",
+                        help="MILP solver (default: the first available of highs, ortools, cbc)")
+    parser.add_argument("-w", "--workers", type=int, dest="workers", default=4,
+                        help="Number of processes in batch mode (1 = no pool)")
+    parser.add_argument("-o", "--output", dest="output",
+                        help="Batch mode: write the results of all teams and scenarios to this .json or .csv file")
+    parser.add_argument("--base_url", dest="base_url", default=FPL_API,
+                        help="API base url, e.g. a local stub server")
+    parser.add_argument("-q", "--quantile", type=fpl_simulation.quantile_value, dest="quantile",
+                        help="Maximise this quantile of the simulated points instead of the expected points, e.g. 0.2")
+    parser.add_argument("--samples", type=int, dest="samples", default=fpl_simulation.N_SAMPLES,
+                        help="Number of simulations of the squad for --quantile")
+    fpl_metrics.add_arguments(parser)
+    args = parser.parse_args()
+
+    config = configparser.ConfigParser()
+    config.read('../config/fpl-bot.ini')
+    main_schema = config.get('DATABASE', 'MAIN_SCHEMA')
+    fpl_metrics.start_run_from_args('fpl_optimise', args)
+
+    conn = psycopg2.connect(
+        host=config.get('DATABASE', 'HOST'),
+        database=config.get('DATABASE', 'DB'),
+        user=config.get('DATABASE', 'USER'),
+        password=config.get('DATABASE', 'PASSWORD'))
+    with fpl_metrics.stage('load_predictions'):
+        df_prediction = load_predictions(conn, main_schema)
+        fpl_metrics.count('read_sql_rows', len(df_prediction))
+    conn.close()
+
+    # Several teams or scenarios: batch mode, with a summary table instead of the teams
+    if args.output or len(args.team_id) * len(args.n_transfers) * len(args.n_round) > 1:
+        with fpl_metrics.stage('batch') as record:
+            records = run_batch(df_prediction, args.team_id, args.n_transfers, args.n_round,
+                                workers=args.workers, backend=args.solver, base_url=args.base_url,
+                                quantile=args.quantile)
+            fpl_metrics.count('scenarios', len(records))
+        summary = pd.DataFrame(records)
+        print(summary.drop(columns=['transfers_out', 'transfers_in', 'time'], errors='ignore').to_string(index=False))
+        print("{} scenarios in {:.2f}s".format(len(records), record['time']))
+        if args.output:
+            write_batch(records, args.output)
+        fpl_metrics.finish_run(args.report_dir)
+        return
+
+    ## Optimize team *************************************
+    team_id, n_transfers, n_round = args.team_id[0], args.n_transfers[0], args.n_round[0]
+    previous_round = int(df_prediction['round'].min() - 1) # The gameweek must be completely finished
+    with fpl_metrics.stage('get_picks'):
+        my_team_list, money_bank = get_picks(team_id, previous_round, args.base_url)
+    #my_team_list=[400, 247, 28, 267, 40, 276, 433, 253, 22, 45, 280, 445, 149, 142, 427] #If testing
+    with fpl_metrics.stage('optimise'):
+        result = optimise_team(df_prediction, my_team_list, money_bank, n_transfers, n_round, args.solver,
+                               args.quantile, args.samples)
+    print_result(result, df_prediction, money_bank, n_round)
+    fpl_metrics.finish_run(args.report_dir)
+
+if __name__ == '__main__':
+    sys.exit(main())
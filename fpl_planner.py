@@ -0,0 +1,261 @@
+import os
+import io
+import sys
+import json
+from argparse import ArgumentParser
+import configparser
+import numpy as np
+import pandas as pd
+import psycopg2
+import pulp
+import fpl_optimise
+import fpl_solver
+import fpl_metrics
+pd.options.mode.chained_assignment = None  # default='warn'
+
+"""
+Plan transfers, lineups and captains over the next gameweeks in one MILP, using the predicted
+points of each round in {main_schema}.prediction. Only the first gameweek of a plan is meant to be
+played: next gameweek the plan is made again over a horizon one round further (rolling horizon),
+starting from the previous plan stored in STAGE_DIR/plans.
+"""
+
+SQUAD = {'GKP': 2, 'DEF': 5, 'MID': 5, 'FWD': 3}
+MAX_PER_CLUB = 3
+MAX_FREE_TRANSFERS = 2
+HIT_COST = 4  # Points per transfer beyond the free transfers
+BENCH_WEIGHT = 0.1  # Value of a point on the bench, for substitutions
+
+def points_matrix(df_prediction, horizon):
+    """The players (element, web_name, position, name_own_team, now_cost) and their predicted points
+    in the next horizon rounds, with one row per element and one column per round (0 in blank rounds)
+    """
+    rounds = sorted(df_prediction['round'].dropna().unique())[:horizon]
+    df = df_prediction[df_prediction['round'].isin(rounds)]
+    points = df.pivot_table(index='element', columns='round', values='points', aggfunc='sum')
+    points = points.reindex(columns=rounds).fillna(0).astype('float64')
+    players = (df.sort_values('round').groupby('element')
+               [['web_name', 'position', 'name_own_team', 'now_cost']].last().reindex(points.index))
+    return players, points
+
+def candidate_pool(players, points, squad, pool_size):
+    """The current squad and, for each position, the pool_size players with the most points over
+    the horizon and the pool_size players with the most points per cost"""
+    if not pool_size:
+        return points.index
+    total = points.sum(axis=1)
+    keep = set(squad)
+    for _, rows in players.groupby('position').groups.items():
+        keep.update(total[rows].nlargest(pool_size).index)
+        keep.update((total[rows] / players.loc[rows, 'now_cost']).nlargest(pool_size).index)
+    return points.index[points.index.isin(keep)]
+
+def build_model(players, points, squad, budget, free_transfers=1, bench_weight=BENCH_WEIGHT):
+    """The planning MILP over the rounds (columns) of points. Each round has a squad of 15 within
+    budget and at most MAX_PER_CLUB players per club, a lineup of 11 in a valid formation and a
+    captain. Transfers change the squad between rounds; free transfers not used are rolled over
+    (up to MAX_FREE_TRANSFERS) and each further transfer costs HIT_COST points.
+    The model is built from the arrays of points, costs, positions and clubs.
+    Returns the problem and its variables, as arrays with one row per element and a column per round
+    """
+    if not 1 <= free_transfers <= MAX_FREE_TRANSFERS:
+        raise ValueError('free_transfers must be between 1 and {}, not {}'.format(MAX_FREE_TRANSFERS, free_transfers))
+    n_players, n_rounds = points.shape
+    P = points.values
+    fpl_problem = pulp.LpProblem('Planner', pulp.LpMaximize)
+    v = {name: fpl_optimise.variable_array(name, (n_players, n_rounds))
+         for name in ['squad', 'lineup', 'captain', 'transfer_in', 'transfer_out']}
+    v['free_transfers'] = fpl_optimise.variable_array('free_transfers', n_rounds, pulp.LpInteger,
+                                                      lowBound=1, upBound=MAX_FREE_TRANSFERS)
+    v['hits'] = fpl_optimise.variable_array('hits', n_rounds, pulp.LpInteger, lowBound=0)
+
+    fpl_problem += fpl_optimise.lp_sum(
+        np.concatenate([v['lineup'].ravel(), v['captain'].ravel(), v['squad'].ravel(), v['hits']]),
+        np.concatenate([(1 - bench_weight) * P.ravel(), P.ravel(), bench_weight * P.ravel(),
+                        np.full(n_rounds, -HIT_COST)]))
+
+    add = lambda terms, sense, rhs: fpl_problem.addConstraint(
+        pulp.LpConstraint(pulp.LpAffineExpression(terms), sense, rhs=rhs))
+    in_squad = points.index.isin(squad)
+    for i in range(n_players):
+        squad_i, lineup_i, captain_i = v['squad'][i], v['lineup'][i], v['captain'][i]
+        for t in range(n_rounds):
+            flow = [(squad_i[t], 1), (v['transfer_in'][i, t], -1), (v['transfer_out'][i, t], 1)]
+            if t > 0:
+                flow.append((squad_i[t - 1], -1))
+            add(flow, pulp.LpConstraintEQ, int(in_squad[i]) if t == 0 else 0)
+            add([(lineup_i[t], 1), (squad_i[t], -1)], pulp.LpConstraintLE, 0)
+            add([(captain_i[t], 1), (lineup_i[t], -1)], pulp.LpConstraintLE, 0)
+
+    cost = players['now_cost'].values
+    positions = players['position'].values
+    clubs = players['name_own_team'].values
+    for t in range(n_rounds):
+        squad_t, lineup_t = v['squad'][:, t], v['lineup'][:, t]
+        fpl_problem += fpl_optimise.lp_sum(squad_t, cost) <= budget
+        for pos, n in SQUAD.items():
+            low, high = fpl_optimise.FORMATION_RANGES[pos]
+            fpl_problem += fpl_optimise.lp_sum(squad_t[positions == pos]) == n
+            fpl_problem += fpl_optimise.lp_sum(lineup_t[positions == pos]) >= low
+            fpl_problem += fpl_optimise.lp_sum(lineup_t[positions == pos]) <= high
+        for club in np.unique(clubs):
+            fpl_problem += fpl_optimise.lp_sum(squad_t[clubs == club]) <= MAX_PER_CLUB
+        fpl_problem += fpl_optimise.lp_sum(lineup_t) == 11
+        fpl_problem += fpl_optimise.lp_sum(v['captain'][:, t]) == 1
+
+        # Free transfers: hits for transfers beyond them, one more (up to two) for the next round
+        transfers = [(x, 1) for x in v['transfer_in'][:, t]]
+        ft, hits = v['free_transfers'], v['hits']
+        if t == 0:
+            add([(ft[t], 1)], pulp.LpConstraintEQ, free_transfers)
+        else:
+            add([(ft[t], 1), (ft[t - 1], -1), (hits[t - 1], -1)] + previous_transfers, pulp.LpConstraintLE, 1)
+        add(transfers + [(ft[t], -1), (hits[t], -1)], pulp.LpConstraintLE, 0)
+        previous_transfers = transfers
+    return fpl_problem, v
+
+def warm_start(v, points, squad, plan, free_transfers=1):
+    """Set the initial values of the variables from a previous plan: the squads, lineups and captains
+    it planned for these rounds (its last round for later rounds). Returns whether any value was set
+    """
+    planned = {r['round']: r for r in (plan or {}).get('rounds', [])}
+    rounds = list(points.columns)
+    if not planned or not any(r in planned for r in rounds):
+        return False
+    last = planned[max(planned)]
+    elements = points.index
+    previous, ft = elements.isin(squad), free_transfers
+    for t, r in enumerate(rounds):
+        round_plan = planned.get(r, last)
+        current = elements.isin(round_plan['squad'])
+        values = {'squad': current, 'lineup': elements.isin(round_plan['lineup']),
+                  'captain': elements == round_plan['captain'],
+                  'transfer_in': current & ~previous, 'transfer_out': previous & ~current}
+        for name, value in values.items():
+            for x, initial in zip(v[name][:, t], value):
+                x.setInitialValue(int(initial))
+        n_transfers = int(values['transfer_in'].sum())
+        hits = max(n_transfers - ft, 0)
+        v['free_transfers'][t].setInitialValue(ft)
+        v['hits'][t].setInitialValue(hits)
+        previous, ft = current, min(max(ft - n_transfers + hits + 1, 1), MAX_FREE_TRANSFERS)
+    return True
+
+def read_plan(plan_dir, team_id):
+    try:
+        with io.open(os.path.join(plan_dir, 'plan_{}.json'.format(team_id)), encoding='utf-8') as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return None
+
+def write_plan(plan_dir, team_id, plan):
+    os.makedirs(plan_dir, exist_ok=True)
+    with io.open(os.path.join(plan_dir, 'plan_{}.json'.format(team_id)), 'w', encoding='utf-8') as outfile:
+        json.dump(plan, outfile, indent=1)
+
+def plan_transfers(df_prediction, squad, money_bank, horizon=6, free_transfers=1, pool_size=40,
+                   bench_weight=BENCH_WEIGHT, time_limit=60, previous_plan=None, **solver_options):
+    """Plan the next horizon gameweeks for squad (15 elements) with money_bank in the bank.
+    The candidates are limited to the current squad and the best players of each position
+    (pool_size=0 or None uses all players). The team value is the current cost of the squad
+    (selling prices are not available from the public API).
+    solver_options (backend, mip_rel_gap, threads) are passed to fpl_solver.solve.
+    Returns the plan: for each round the squad, lineup, captain, transfers, free transfers, hits and points
+    """
+    players, points = points_matrix(df_prediction, horizon)
+    missing = set(squad) - set(points.index)
+    if missing:
+        raise ValueError('No predictions for elements {}'.format(sorted(missing)))
+    budget = players.loc[squad, 'now_cost'].sum() + money_bank
+    pool = candidate_pool(players, points, squad, pool_size)
+    players, points = players.loc[pool], points.loc[pool]
+
+    with fpl_metrics.stage('build_model') as build:
+        fpl_problem, v = build_model(players, points, squad, budget, free_transfers, bench_weight)
+    warm = warm_start(v, points, squad, previous_plan, free_transfers)
+    with fpl_metrics.stage('solve') as solve:
+        fpl_solver.solve(fpl_problem, time_limit=time_limit, warm_start=warm, **solver_options)
+    build_time, solve_time = build['time'], solve['time']
+    if fpl_problem.sol_status not in (pulp.LpSolutionOptimal, pulp.LpSolutionIntegerFeasible):
+        raise RuntimeError('No plan found: {}'.format(pulp.LpStatus[fpl_problem.status]))
+
+    chosen = lambda name, t: [int(e) for e, x in zip(points.index, v[name][:, t]) if x.varValue > 0.5]
+    plan = {'status': pulp.LpSolution[fpl_problem.sol_status], 'objective': pulp.value(fpl_problem.objective),
+            'players': len(points), 'warm_start': warm, 'backend': fpl_solver.solve_log[-1]['backend'], 'build_time': build_time,
+            'solve_time': solve_time, 'rounds': []}
+    for t, r in enumerate(points.columns):
+        lineup = chosen('lineup', t)
+        captain = chosen('captain', t)[0]
+        plan['rounds'].append({
+            'round': int(r), 'squad': chosen('squad', t), 'lineup': lineup, 'captain': captain,
+            'in': chosen('transfer_in', t), 'out': chosen('transfer_out', t),
+            'free_transfers': int(round(v['free_transfers'][t].varValue)),
+            'hits': int(round(v['hits'][t].varValue)),
+            'points': float(points.loc[lineup, r].sum() + points.at[captain, r])})
+    return plan
+
+def print_plan(plan, df_prediction):
+    names = df_prediction.groupby('element')['web_name'].last()
+    positions = df_prediction.groupby('element')['position'].last().map(fpl_optimise.sort_order)
+    by_position = lambda elements: sorted(elements, key=lambda e: positions[e])
+    print("{} for a plan over {} players (warm start: {}), built in {:.2f}s, solved with {} in {:.2f}s".format(
+        plan['status'], plan['players'], plan['warm_start'], plan['build_time'], plan['backend'],
+        plan['solve_time']))
+    for r in plan['rounds']:
+        transfers = ', '.join('{} -> {}'.format(names[o], names[i]) for o, i in zip(by_position(r['out']), by_position(r['in'])))
+        print("GW {round}: {points:.1f} points, captain {captain}, {free_transfers} free transfer(s), "
+              "{hits} hit(s), transfers: {transfers}".format(
+                  **{**r, 'captain': names[r['captain']], 'transfers': transfers or '-'}))
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument("-i", "--team_id", type=int, dest="team_id", help="Team ID, e.g. 5977880")
+    parser.add_argument("-H", "--horizon", type=int, dest="horizon", default=6,
+                        help="Number of gameweeks to plan")
+    parser.add_argument("-f", "--free_transfers", type=int, dest="free_transfers", default=1,
+                        choices=range(1, MAX_FREE_TRANSFERS + 1),
+                        help="Free transfers available for the next gameweek")
+    parser.add_argument("-p", "--pool", type=int, dest="pool", default=40,
+                        help="Candidates per position by points and by points per cost (0 = all players)")
+    parser.add_argument("--bench_weight", type=float, dest="bench_weight", default=BENCH_WEIGHT,
+                        help="Weight of the predicted points of the bench")
+    parser.add_argument("--time_limit", type=float, dest="time_limit", default=60,
+                        help="Time limit of the solver in seconds")
+    parser.add_argument("--gap", type=float, dest="gap", default=None,
+                        help="Relative MIP gap at which to stop, e.g. 0.01")
+    parser.add_argument("--threads", type=int, dest="threads", default=None,
+                        help="Number of solver threads")
+    parser.add_argument("--solver", choices=fpl_solver.BACKENDS, dest="solver",
+                        help="MILP solver (default: the first available of highs, ortools, cbc)")
+    fpl_metrics.add_arguments(parser)
+    args = parser.parse_args()
+
+    config = configparser.ConfigParser()
+    config.read('../config/fpl-bot.ini')
+    main_schema = config.get('DATABASE', 'MAIN_SCHEMA')
+    plan_dir = os.path.join(config.get('FILES', 'STAGE_DIR'), 'plans')
+    fpl_metrics.start_run_from_args('fpl_planner', args)
+
+    conn = psycopg2.connect(
+        host=config.get('DATABASE', 'HOST'),
+        database=config.get('DATABASE', 'DB'),
+        user=config.get('DATABASE', 'USER'),
+        password=config.get('DATABASE', 'PASSWORD'))
+    with fpl_metrics.stage('load_predictions'):
+        df_prediction = fpl_optimise.load_predictions(conn, main_schema)
+    conn.close()
+
+    previous_round = int(df_prediction['round'].min() - 1) # The gameweek must be completely finished
+    squad, money_bank = fpl_optimise.get_picks(args.team_id, previous_round)
+    with fpl_metrics.stage('plan'):
+        plan = plan_transfers(df_prediction, squad, money_bank, horizon=args.horizon,
+                              free_transfers=args.free_transfers, pool_size=args.pool,
+                              bench_weight=args.bench_weight, time_limit=args.time_limit,
+                              previous_plan=read_plan(plan_dir, args.team_id), backend=args.solver,
+                              mip_rel_gap=args.gap, threads=args.threads)
+    print_plan(plan, df_prediction)
+    write_plan(plan_dir, args.team_id, plan)
+    fpl_metrics.finish_run(args.report_dir)
+
+if __name__ == '__main__':
+    sys.exit(main())
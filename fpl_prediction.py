@@ -1,98 +1,238 @@
 # -*- coding: utf-8 -*-
-import fpl_utils
+import sys
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import fpl_features
+import fpl_model
+import fpl_seasons
+import fpl_metrics
 import pandas as pd
-from sklearn.ensemble import RandomForestRegressor
-from sklearn.pipeline import Pipeline
-from sklearn.preprocessing import StandardScaler
-from sklearn import linear_model
 import configparser
+from argparse import ArgumentParser
 import psycopg2
 from psycopg2.extras import execute_values
 pd.options.mode.chained_assignment = None  # default='warn'
 
 """Create table {main_schema}.prediction with predictions for each player"""
 
-##Obtain data ********************************************************************
-config = configparser.ConfigParser()
-config.read('../config/fpl-bot.ini')
-stage_dir = config.get('FILES', 'STAGE_DIR')
-main_schema = config.get('DATABASE', 'MAIN_SCHEMA')
+# Columns of player_history needed besides the features
+COLUMNS = ['element', 'fixture', 'round', 'finished', 'minutes', 'total_points', 'position',
+           'web_name', 'team', 'name_own_team', 'was_home', 'strength_own_team', 'strength_opponent_team',
+           'value']
+# FPL has removed all the other information, so it is a bit scarce now..
+FEATURES = fpl_features.EMA_FEATURES + ['was_home','strength_own_team',
+                    'strength_opponent_team']#,'cat_cost'] #use now_cost or cat_cost?!
+#cat_cost would be fpl_utils.categorise_cost of the value column
 
-conn = psycopg2.connect(
-    host=config.get('DATABASE', 'HOST'),
-    database=config.get('DATABASE', 'DB'),
-    user=config.get('DATABASE', 'USER'),
-    password=config.get('DATABASE', 'PASSWORD'))
+POSITIONS = ['GKP','DEF','MID','FWD']
+# Weight, in matches, of the residual variance of the position in the variance of each player
+PRIOR_MATCHES = 5
 
-# TODO: Only select relevant columns
-df = pd.read_sql(f'select * from {main_schema}.player_history order by element, round', conn)
+def training_rows(df, features):
+    """Rows with all features and an outcome, in assigned rounds, where the player played"""
+    return (df[features].notnull().all(axis=1) & df['total_points'].notnull()
+            & df['round'].notnull() & (df['minutes'] != 0))
 
-##Generate features for prediction **************************************************************
-#Try to map total_cost to categories to reduce the variance
-df['cat_cost'] = df['value'].apply(fpl_utils.categorise_cost)
+def partition(df, features, history=None):
+    """Split df once into the training rows and the unfinished rows of each position.
+    The training rows of history (previous seasons, see fpl_seasons) are added to those of df
+    """
+    df['has_features'] = df[features].notnull().all(axis=1)
+    df['season_index'] = fpl_seasons.CURRENT_SEASON
+    train = training_rows(df, features)
+    unfinished = df['finished'] == False
+    if history is not None:
+        history = history[training_rows(history, features)]
+    parts = {}
+    for pos, rows in df.groupby('position').groups.items():
+        if pos in POSITIONS:
+            pos_df = df.loc[rows]
+            pos_train = pos_df[train[rows]]
+            if history is not None:
+                pos_history = history[history['position'] == pos]
+                pos_train = pd.concat([pos_history[['season_index', 'element', 'fixture', 'round',
+                                                    'total_points'] + features],
+                                       pos_train[['season_index', 'element', 'fixture', 'round',
+                                                  'total_points'] + features]], ignore_index=True)
+            parts[pos] = (pos_train.sort_values(['season_index','element','fixture']),
+                          pos_df[unfinished[rows]])
+    return parts
 
-EMA_columns=['influence', 'creativity', 'threat', 'ict_index', 'bps', 'total_points']
-# FPL has removed all the other information, so it is a bit scarce now..
-for c in EMA_columns:
-    df['EMA_'+c]=fpl_utils.EMA(df,column=c,span=2,min_periods=2,threshold_minutes=30)
-features=['EMA_'+c for c in EMA_columns] + ['was_home','strength_own_team',
-                    'strength_opponent_team']#,'cat_cost'] #use now_cost or cat_cost?!
+def residual_std(train, residuals, elements):
+    """Standard deviation of the points of each of elements around the prediction: the variance of
+    the player's residuals in the current season, shrunk towards the residual variance of the
+    position with a weight of PRIOR_MATCHES matches (just the latter for players without matches)
+    """
+    pos_var = np.mean(residuals ** 2)
+    current = train['season_index'].values == fpl_seasons.CURRENT_SEASON
+    squares = pd.Series(residuals[current] ** 2).groupby(train['element'].values[current])
+    player_var = (squares.sum() + PRIOR_MATCHES * pos_var) / (squares.size() + PRIOR_MATCHES)
+    return np.sqrt(player_var.reindex(elements).fillna(pos_var).values), np.sqrt(pos_var)
+
+def predict_position(pos, train, unfinished, features, model_dir):
+    """Train (or reuse) the model of one position and predict its unfinished matches, with the
+    standard deviation of each player's points from the residuals of the model (see residual_std).
+    Returns the predictions, how the model was obtained and the time spent in each step
+    """
+    #The models have been fine-tuned in another notebook (train_test_split etc.)
+    #Same estimator as Pipeline([StandardScaler(), Ridge(alpha=0.5)]), but can be updated incrementally
+    make_model = lambda: fpl_model.IncrementalRidge(alpha=0.5)  # May vary with the position
+    start = time.perf_counter()
+    X = train[features].values.astype('float64')
+    y = train['total_points'].values.astype('float64')
+    # Rounds of earlier seasons come first, so that a new round only adds rows to the model
+    rounds = train['season_index'].values.astype('int64') * 100 + train['round'].values
+    prediction_model, status = fpl_model.fit_cached(model_dir, pos, make_model, features,
+                                                    X, y, rounds)
+    fit_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    prediction = unfinished[['round','element','web_name','team','name_own_team','position']]
+    prediction['points'] = np.nan
+    prediction['points_std'] = np.nan
+    predict_rows = unfinished['has_features'].values  # Predict on everything that has all features
+    points_std, pos_std = residual_std(train, y - prediction_model.predict(X), prediction['element'].values)
+    if predict_rows.any():
+        prediction.loc[predict_rows, 'points'] = prediction_model.predict(
+            unfinished.loc[predict_rows, features].values.astype('float64'))
+        prediction.loc[predict_rows, 'points_std'] = points_std[predict_rows]
+    return prediction, {'position': pos, 'model': status, 'rows': len(y), 'std': pos_std,
+                        'fit': fit_time, 'predict': time.perf_counter() - start}
+
+def load_fixture_index(conn, main_schema):
+    """Number of fixtures of each team in each round (see sql/DML_fixture_index.sql)"""
+    return pd.read_sql(f"select team, round, n_fixtures from {main_schema}.fixture_index", conn)
+
+def round_predictions(prediction, fixture_index=None):
+    """Points of each element per round from the points per unfinished match, summed over the
+    fixtures of a double gameweek (and their variances, assuming independent matches). With the
+    fixture index, every round from the first predicted one gets a row, with 0 points in the blank
+    gameweeks of the element's team; n_fixtures is taken from the index (otherwise it is the number
+    of predicted matches)
+    """
+    players = prediction.groupby('element')[['web_name', 'team', 'name_own_team', 'position']].last()
+    prediction = prediction.assign(points_var=prediction['points_std'] ** 2)
+    matches = prediction.groupby(['element', 'round'])
+    rounds = pd.DataFrame({'points': matches['points'].sum(min_count=1),
+                           'points_var': matches['points_var'].sum(min_count=1),
+                           'n_fixtures': matches.size()}).reset_index()
+    rounds['round'] = rounds['round'].astype('int64')
+    if fixture_index is not None:
+        index = fixture_index[fixture_index['round'] >= rounds['round'].min()]
+        grid = players[['team']].reset_index().merge(index[['team', 'round', 'n_fixtures']], on='team')
+        rounds = grid.drop(columns='team').merge(rounds.drop(columns='n_fixtures'), on=['element', 'round'],
+                                                 how='outer')
+        rounds.loc[rounds['n_fixtures'] == 0, ['points', 'points_var']] = 0.0
+    df_prediction = (rounds.merge(players.reset_index(), on='element')
+                     .sort_values(['element', 'round'], kind='stable').reset_index(drop=True))
+    df_prediction['points_cumulative'] = df_prediction.groupby('element')['points'].cumsum()
+    df_prediction['points_std'] = np.sqrt(df_prediction['points_var'])
+    df_prediction['points_std_cumulative'] = np.sqrt(df_prediction.groupby('element')['points_var'].cumsum())
+    return df_prediction[['element', 'round', 'web_name', 'team', 'name_own_team', 'position',
+                          'n_fixtures', 'points', 'points_cumulative', 'points_std', 'points_std_cumulative']]
+
+def predict(df, features, model_dir, workers=4, history=None, fixture_index=None):
+    """Train a model per position and predict the points of each unfinished match,
+    also training on the matches of previous seasons in history (see fpl_seasons.load_history).
+    The positions are handled in parallel in a process pool (in this process if workers=1).
+    Fitted models are cached in model_dir and reused (or updated with the new rows only)
+    when the training data has not changed (or only gained new rounds).
+    Returns the points per element and round (see round_predictions)
+    """
+    pos_features = features  # May use different features for the different positions
+    parts = partition(df, features, history)
+    jobs = [(pos, train, unfinished, pos_features, model_dir)
+            for pos, (train, unfinished) in parts.items()]
+    if workers > 1:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            results = list(executor.map(predict_position, *zip(*jobs)))
+    else:
+        results = [predict_position(*job) for job in jobs]
+    for _, t in results:
+        print("{position}: {model} model on {rows} rows, residual sd {std:.2f}, fit {fit:.3f}s, predict {predict:.3f}s".format(**t))
+    fpl_metrics.note(positions=[t for _, t in results])
+
+    df_prediction = pd.concat([prediction for prediction, _ in results]).sort_index()
+    #df_prediction['value']=df_prediction['value']/10.
+
+    # Double gameweeks are summed, blank gameweeks get 0 points
+    return round_predictions(df_prediction, fixture_index)
+
+def write_predictions(conn, main_schema, df_prediction):
+    columns = ['element', 'round', 'points', 'points_cumulative', 'points_std', 'points_std_cumulative']
+    with conn.cursor() as cur:
+        cur.execute(f"truncate table {main_schema}.prediction")
+        values = df_prediction[columns].values
+        query = "INSERT INTO {}.prediction ({}) VALUES %s".format(main_schema, ','.join(columns))
+        execute_values(cur, query, values)
+        fpl_metrics.count('execute_values_rows', len(values))
+        # Committed with the rows, for the readers that cache the predictions (fpl_service)
+        cur.execute(f"insert into {main_schema}.prediction_run (n_rows) values (%s)", (len(values),))
+        cur.execute(f"analyze {main_schema}.prediction")  # For the plan of sql/DQL_predictions.sql
+    conn.commit()
+
+def run_prediction(conn, main_schema, stage_dir, seasons=(), workers=4, rebuild_features=False,
+                   backup_schema=None):
+    """Features, training data of previous seasons, prediction and writing the prediction table.
+    backup_schema holds the changes of the incremental refreshes of player_history (see fpl_features).
+    Returns the player_history frame with the features and the predictions
+    """
+    ##Features for prediction, only computed for rounds finished since the last run ******
+    with fpl_metrics.stage('features') as record:
+        df = fpl_features.load_features(conn, main_schema, COLUMNS, rebuild=rebuild_features,
+                                        backup_schema=backup_schema)
+    print("Features: {:.2f}s".format(record['time']))
+
+    ##Training data of previous seasons, from the cache in STAGE_DIR/seasons after the first run ***
+    history = None
+    if seasons:
+        with fpl_metrics.stage('seasons') as record:
+            history = fpl_seasons.load_history(
+                conn, seasons, os.path.join(stage_dir, 'seasons'),
+                columns=['element', 'fixture', 'round', 'minutes', 'total_points', 'position'] + FEATURES)
+            fpl_metrics.count('history_rows', len(history))
+        print("Previous seasons ({}): {} rows, {:.1f} MB, {:.2f}s".format(
+            ', '.join(history['season'].unique()), len(history),
+            history.memory_usage(deep=True).sum() / 1e6, record['time']))
+
+    ##Prediction **********************************************************************************
+    with fpl_metrics.stage('predict') as record:
+        df_prediction = predict(df, FEATURES, os.path.join(stage_dir, 'models'), workers=workers,
+                                history=history, fixture_index=load_fixture_index(conn, main_schema))
+    print("Prediction: {:.2f}s".format(record['time']))
+    with fpl_metrics.stage('write_predictions') as record:
+        write_predictions(conn, main_schema, df_prediction)
+    print("Writing predictions: {:.2f}s".format(record['time']))
+    return df, df_prediction
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument("--rebuild_features", action="store_true", dest="rebuild_features",
+                        help="Recompute the feature store from the whole player_history")
+    parser.add_argument("-w", "--workers", type=int, dest="workers", default=4,
+                        help="Number of processes for the per-position models (1 = no pool)")
+    fpl_metrics.add_arguments(parser)
+    args = parser.parse_args()
+
+    ##Obtain data ********************************************************************
+    config = configparser.ConfigParser()
+    config.read('../config/fpl-bot.ini')
+
+    conn = psycopg2.connect(
+        host=config.get('DATABASE', 'HOST'),
+        database=config.get('DATABASE', 'DB'),
+        user=config.get('DATABASE', 'USER'),
+        password=config.get('DATABASE', 'PASSWORD'))
+    fpl_metrics.start_run_from_args('fpl_prediction', args)
+    with fpl_metrics.stage('prediction'):
+        run_prediction(conn, config.get('DATABASE', 'MAIN_SCHEMA'), config.get('FILES', 'STAGE_DIR'),
+                       fpl_seasons.training_seasons(config), workers=args.workers,
+                       rebuild_features=args.rebuild_features,
+                       backup_schema=config.get('DATABASE', 'BACKUP_SCHEMA'))
+    conn.close()
+    fpl_metrics.finish_run(args.report_dir)
 
-##Prediction **********************************************************************************
-#Might here add more training data from previous seasons
-#The models have been fine-tuned in another notebook (train_test_split etc.)
-ridge = Pipeline([('scl', StandardScaler()),
-                  ('clf', linear_model.Ridge(alpha = 0.5))])
-
-rf = RandomForestRegressor(n_estimators=200,n_jobs=-1, max_depth=5, 
-         min_samples_leaf=100,min_samples_split=300)
-
-df_prediction=pd.DataFrame()
-for pos in ['GKP','DEF','MID','FWD']:
-    pos_features=features  # May use different features for the different positions
-    prediction_model = ridge  # May vary
-
-    df['predict']=~df[pos_features].T.isnull().any()  # True if the features are non-NaN
-    df.loc[df['total_points'].isnull(),'predict']=False  # False if total_points is Nan
-    df.loc[df['round'].isnull(),'predict']=False  # False if round is Nan (non-assigned matches)
-    df.loc[df['minutes']==0,'predict']=False # False if not played
-    X=df[(df['position']==pos) & (df['predict']==True)][pos_features].values.astype('float64')
-    y=df[(df['position']==pos) & (df['predict']==True)]['total_points'].values
-    #print('X.shape: ',X.shape)
-    #print('y.shape: ',y.shape)
-    
-    #Train:
-    prediction_model.fit(X,y)
-
-    #Predict:
-    df['prediction']=~df[pos_features].T.isnull().any() ##Predict on everything that has all features
-    #Do not include finished matches or other positions:
-    df.loc[(df['finished']!=False) | (df['position']!=pos),'prediction']=False
-    X_prediction=df[df['prediction']==True][pos_features].values
-    y_prediction=prediction_model.predict(X_prediction.astype('float64'))
-    foo=pd.DataFrame(data=y_prediction, index=df[df['prediction']==True].index)
-    df['points']=foo #Overwrite with the actual predictions
-
-    prediction=df[(df['finished']==False) & (df['position']==pos)] \
-        [['round','element','web_name','name_own_team','position','points']]
-        #'value','prediction']]
-    df_prediction=df_prediction.append(prediction)
-
-df_prediction['points_cumulative'] = df_prediction.groupby(['element'])['points']. \
-    apply(lambda x: x.cumsum())
-#df_prediction['value']=df_prediction['value']/10.
-
-#Due to potential double gameweeks, get last score from each round
-#TODO: Ensure 'prediction' are doubled for these GWs, not only 'pred_cumulative' (done below with .last())
-remaining_rounds=df_prediction['round'].unique()
-df_prediction=df_prediction.groupby(['element','round']).last().reset_index()
-# TODO: Ensure double GWs are handled correctly (does the above work?). Also check blank GWs
-
-with conn.cursor() as cur:
-    cur.execute(f"truncate table {main_schema}.prediction")
-    values = df_prediction[['element', 'round', 'points', 'points_cumulative']].values
-    columns = ['element', 'round', 'points', 'points_cumulative']
-    query = "INSERT INTO {}.prediction ({}) VALUES %s".format(main_schema, ','.join(columns))
-    execute_values(cur, query, values)
-conn.commit()
-conn.close()
+if __name__ == '__main__':
+    sys.exit(main())
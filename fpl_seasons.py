@@ -0,0 +1,138 @@
+import os
+import json
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.feather as feather
+import fpl_features
+import fpl_utils
+
+"""
+Training data from previous seasons. The player_history of each season, read from its main schema
+(e.g. fpl_2020) or from a local copy of the public historical CSV dumps (a season directory with
+gws/merged_gw.csv, players_raw.csv and teams.csv), is reduced to a typed, compact frame with
+the EMA features and cached in STAGE_DIR/seasons as an uncompressed Feather file.
+Later runs memory-map the cache instead of querying the season again (past seasons do not change;
+delete a season's file to read it again).
+Configure the seasons, oldest first, in the config file:
+[TRAINING]
+SEASONS = fpl_2019, /data/Fantasy-Premier-League/data/2020-21
+"""
+
+CACHE_VERSION = 1
+CURRENT_SEASON = 100  # season_index of the current season, after all previous seasons
+POSITIONS = ['GKP', 'DEF', 'MID', 'FWD']
+INT16_COLUMNS = ['element', 'fixture', 'round', 'minutes', 'total_points', 'bps', 'value']
+FLOAT32_COLUMNS = ['influence', 'creativity', 'threat', 'ict_index']
+INT8_COLUMNS = ['strength_own_team', 'strength_opponent_team']
+CATEGORY_COLUMNS = ['name_own_team', 'name_opponent_team']
+HISTORY_COLUMNS = (INT16_COLUMNS + FLOAT32_COLUMNS + INT8_COLUMNS + CATEGORY_COLUMNS
+                   + ['position', 'was_home'])
+
+def training_seasons(config):
+    """The SEASONS of the TRAINING section of the config, oldest first"""
+    if not config.has_option('TRAINING', 'SEASONS'):
+        return []
+    return [s.strip() for s in config.get('TRAINING', 'SEASONS').split(',') if s.strip()]
+
+def read_schema(conn, schema):
+    """Finished matches of {schema}.player_history"""
+    return pd.read_sql(f"""select {','.join(HISTORY_COLUMNS)} from {schema}.player_history
+        where finished and round is not null order by element, round""", conn)
+
+def read_csv_season(season_dir):
+    """Finished matches of a season of the historical CSV dumps, with the columns of player_history"""
+    gws = pd.read_csv(os.path.join(season_dir, 'gws', 'merged_gw.csv'), encoding='latin-1',
+                      usecols=lambda c: c in INT16_COLUMNS + FLOAT32_COLUMNS + ['GW', 'was_home', 'opponent_team'])
+    if 'round' not in gws:
+        gws['round'] = gws['GW']
+    players = pd.read_csv(os.path.join(season_dir, 'players_raw.csv'), encoding='latin-1',
+                          usecols=['id', 'element_type', 'team'])
+    teams = pd.read_csv(os.path.join(season_dir, 'teams.csv'), encoding='latin-1',
+                        usecols=['id', 'short_name', 'strength']).set_index('id')
+    element = players.set_index('id').reindex(gws['element'])
+    gws['position'] = element['element_type'].map(dict(enumerate(POSITIONS, start=1))).values
+    gws['name_own_team'] = teams['short_name'].reindex(element['team']).values
+    gws['strength_own_team'] = teams['strength'].reindex(element['team']).values
+    gws['name_opponent_team'] = teams['short_name'].reindex(gws['opponent_team']).values
+    gws['strength_opponent_team'] = teams['strength'].reindex(gws['opponent_team']).values
+    gws['was_home'] = gws['was_home'].astype(str).str.lower() == 'true'
+    gws = gws[gws['round'].notnull()].sort_values(['element', 'round'], kind='stable')
+    return gws[HISTORY_COLUMNS].reset_index(drop=True)
+
+def compact(df, season):
+    """df with small dtypes: int16/int8 (float32 where there are nulls), float32 and categories"""
+    out = pd.DataFrame({'season': season}, index=df.index)
+    for columns, dtype in ((INT16_COLUMNS, 'int16'), (INT8_COLUMNS, 'int8')):
+        for c in columns:
+            out[c] = df[c].astype(dtype if df[c].notnull().all() else 'float32')
+    for c in FLOAT32_COLUMNS + fpl_features.EMA_FEATURES:
+        out[c] = df[c].astype('float32')
+    out['was_home'] = df['was_home'].astype(bool)
+    out['position'] = pd.Categorical(df['position'], categories=POSITIONS)
+    for c in CATEGORY_COLUMNS:
+        out[c] = df[c].astype('category')
+    out['season'] = out['season'].astype('category')
+    return out
+
+def cache_key():
+    """Cached seasons are rebuilt when the columns or the EMA features change"""
+    return json.dumps({'version': CACHE_VERSION, 'columns': HISTORY_COLUMNS,
+                       'ema_columns': fpl_features.EMA_COLUMNS, 'ema_params': fpl_features.EMA_PARAMS},
+                      sort_keys=True).encode()
+
+def cache_path(cache_dir, season):
+    return os.path.join(cache_dir, os.path.basename(os.path.normpath(season)) + '.feather')
+
+def build_season(conn, season):
+    """Read a season (a schema name or a CSV dump directory) and add its EMA features"""
+    if os.path.isdir(season):
+        df = read_csv_season(season)
+    else:
+        df = read_schema(conn, season)
+    features = fpl_utils.EMA_features(df, fpl_features.EMA_COLUMNS, **fpl_features.EMA_PARAMS)
+    return compact(pd.concat([df, features], axis=1), os.path.basename(os.path.normpath(season)))
+
+def write_cache(path, df):
+    """Uncompressed and in a single record batch, so the file can be memory-mapped without copies"""
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    table = table.replace_schema_metadata({**table.schema.metadata, b'fpl_seasons': cache_key()})
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    feather.write_feather(table, path + '.tmp', compression='uncompressed',
+                          chunksize=max(len(df), 1))
+    os.replace(path + '.tmp', path)
+
+def read_cache(path, columns=None):
+    """The cached season, memory-mapped, or None if it is missing or out of date"""
+    try:
+        table = feather.read_table(path, columns=columns, memory_map=True)
+    except (FileNotFoundError, pa.ArrowInvalid):
+        return None
+    if (table.schema.metadata or {}).get(b'fpl_seasons') != cache_key():
+        return None
+    return table.to_pandas(split_blocks=True)
+
+def load_history(conn, seasons, cache_dir, columns=None):
+    """The finished matches of the seasons (oldest first) in one compact frame, sorted on
+    season_index, element, round, with the EMA features of fpl_features.
+    Each season is read once and then served from its cache in cache_dir.
+    Element ids are only unique within a season (season_index).
+    """
+    if columns is not None:
+        columns = list(dict.fromkeys(['season'] + list(columns)))
+    frames = []
+    for season_index, season in enumerate(seasons):
+        path = cache_path(cache_dir, season)
+        df = read_cache(path, columns)
+        if df is None:
+            write_cache(path, build_season(conn, season))
+            df = read_cache(path, columns)
+        df['season_index'] = np.int8(season_index)
+        frames.append(df)
+    if not frames:
+        return None
+    history = pd.concat(frames, ignore_index=True)
+    for c in ['season', 'name_own_team', 'name_opponent_team']:  # Union of the categories
+        if c in history and history[c].dtype != 'category':
+            history[c] = history[c].astype('category')
+    return history
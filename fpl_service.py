@@ -0,0 +1,281 @@
+import sys
+import json
+import time
+import threading
+import traceback
+from collections import OrderedDict
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlsplit, parse_qs
+from argparse import ArgumentParser
+import numpy as np
+import psycopg2
+import requests
+import fpl_bot
+import fpl_optimise
+import fpl_simulation
+import fpl_solver
+import import_data
+
+"""
+A local HTTP service for what-if questions on a team, answered from predictions kept in memory:
+
+    python fpl_service.py --port 8000
+    curl 'localhost:8000/lineup?team_id=5977880&n_round=3'
+    curl 'localhost:8000/transfers?team_id=5977880&n_transfers=2&n_round=3&sell=308'
+
+The predictions are read once and split by round ahead; they are read again when fpl_prediction.py
+has rewritten the prediction table (a new row in prediction_run, checked at most every
+--check_interval seconds). The picks of each team and gameweek are cached for --picks_ttl seconds.
+
+Parameters of /lineup and /transfers (lists are comma-separated element ids):
+    team_id        team whose picks of the last finished gameweek make the squad, or
+    squad, bank    the 15 elements of a squad and the money in the bank instead of the picks
+    n_round        rounds ahead to predict (default 1)
+    n_transfers    transfers to suggest (/transfers, default 1)
+    exclude        players that neither play nor can be bought (e.g. injured)
+    sell           players sold beforehand: their price goes to the bank and they cannot be bought back
+    quantile       maximise this quantile of the simulated points instead of the expected points
+/status gives the prediction run in memory and the counters of the caches.
+"""
+
+class TTLCache:
+    """Values that expire ttl seconds after they were loaded, with at most maxsize entries (the
+    oldest are evicted first). Thread-safe; a missing key is loaded by load(key) outside the lock
+    """
+    def __init__(self, ttl, maxsize=1024, clock=time.monotonic):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self.clock = clock
+        self.entries = OrderedDict()  # key -> (expires, value), oldest first
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def evict(self, now):
+        # Every entry lives ttl seconds, so the expired ones are at the front
+        while self.entries and (next(iter(self.entries.values()))[0] <= now or len(self.entries) > self.maxsize):
+            self.entries.popitem(last=False)
+
+    def get(self, key, load):
+        with self.lock:
+            now = self.clock()
+            self.evict(now)
+            if key in self.entries:
+                self.hits += 1
+                return self.entries[key][1]
+            self.misses += 1
+        value = load(key)
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = (self.clock() + self.ttl, value)
+            self.evict(self.clock())
+        return value
+
+    def stats(self):
+        with self.lock:
+            return {'size': len(self.entries), 'hits': self.hits, 'misses': self.misses}
+
+class PredictionStore:
+    """The frame of fpl_optimise.load_predictions and its rows for each round ahead, read again when
+    the prediction table has been rewritten. connect() opens a connection to the database; the
+    connection is opened again after an error
+    """
+    def __init__(self, connect, main_schema, check_interval=1.0):
+        self.connect = connect
+        self.main_schema = main_schema
+        self.check_interval = check_interval
+        self.lock = threading.Lock()
+        self.conn = None
+        self.checked = -np.inf
+        self.run_id = None
+        self.df_prediction = None
+        self.rounds = {}
+        self.n_loads = 0
+
+    def refresh(self):
+        try:
+            if self.conn is None:
+                self.conn = self.connect()
+            run_id = fpl_optimise.prediction_run(self.conn, self.main_schema)
+            if self.df_prediction is None or run_id != self.run_id:
+                start = time.perf_counter()
+                df_prediction = fpl_optimise.load_predictions(self.conn, self.main_schema)
+                # The requests read these frames without a lock: they are replaced, never modified
+                self.rounds = {int(n): df for n, df in df_prediction.groupby('next_fixture')}
+                self.df_prediction, self.run_id = df_prediction, run_id
+                self.n_loads += 1
+                print("Loaded {} predictions of run {} in {:.2f}s".format(len(df_prediction), run_id,
+                                                                           time.perf_counter() - start))
+            self.conn.rollback()  # Do not stay idle in a transaction
+        except psycopg2.Error:
+            if self.conn is not None:
+                self.conn.close()
+            self.conn = None
+            if self.df_prediction is None:
+                raise
+            traceback.print_exc()  # Keep answering from the predictions in memory
+
+    def get(self):
+        """The prediction run id, the frame and the frames of each round ahead"""
+        with self.lock:
+            if time.monotonic() - self.checked >= self.check_interval:
+                self.refresh()
+                self.checked = time.monotonic()
+            return self.run_id, self.df_prediction, self.rounds
+
+class Service:
+    """The answers of the HTTP API, from the predictions of store and the picks of the FPL API at base_url"""
+    def __init__(self, store, base_url=fpl_optimise.FPL_API, picks_ttl=600, backend=None,
+                 n_samples=fpl_simulation.N_SAMPLES):
+        self.store = store
+        self.base_url = base_url
+        self.backend = backend
+        self.n_samples = n_samples
+        self.session = import_data.make_session()
+        self.picks = TTLCache(picks_ttl)
+
+    def get_picks(self, team_id, gameweek):
+        return self.picks.get((team_id, gameweek), lambda key: fpl_optimise.get_picks(
+            key[0], key[1], self.base_url, self.session))
+
+    def scenario(self, params):
+        """The frame of the round asked for without the excluded and sold players, the rest of the
+        squad and the money in the bank"""
+        run_id, df_prediction, rounds = self.store.get()
+        n_round = int(params.get('n_round', 1))
+        if n_round not in rounds:
+            raise ValueError('n_round must be between 1 and {}'.format(len(rounds)))
+        gameweek = int(df_prediction['round'].min() - 1)  # The last finished gameweek
+        if 'squad' in params:
+            squad, bank = element_list(params['squad']), float(params.get('bank', 0))
+        elif 'team_id' in params:
+            squad, bank = self.get_picks(int(params['team_id']), gameweek)
+        else:
+            raise ValueError('team_id or squad is required')
+        exclude, sell = element_list(params.get('exclude')), element_list(params.get('sell'))
+        df_round = rounds[n_round]
+        sold = df_round[df_round.element.isin(sell) & df_round.element.isin(squad)]
+        bank = round(bank + sold.now_cost.sum(), 1)
+        df_round = df_round[~df_round.element.isin(exclude + sell)]
+        squad = [e for e in squad if e not in exclude and e not in sell]
+        quantile = fpl_simulation.quantile_value(params['quantile']) if 'quantile' in params else None
+        return {'prediction_run': run_id, 'gameweek': gameweek, 'n_round': n_round, 'bank': bank,
+                'quantile': quantile, 'sold': records(sold[fpl_optimise.SHOW_COLUMNS])}, df_round, squad
+
+    def lineup(self, params):
+        result, df_round, squad = self.scenario(params)
+        my_team = df_round[df_round.element.isin(squad)]
+        my_team['points_cumulative'] = my_team['points_cumulative'].fillna(0)
+        selected, formation, points, scores = fpl_optimise.best_lineup(my_team, result['quantile'], self.n_samples)
+        if not np.isfinite(points):
+            raise ValueError('No lineup of the squad fits any formation')
+        result.update({'formation': formation, 'points': float(points),
+                       'formation_scores': formation_dict(scores),
+                       'lineup': records(my_team[selected][fpl_optimise.SHOW_COLUMNS]),
+                       'bench': records(my_team[~selected][fpl_optimise.SHOW_COLUMNS])})
+        return result
+
+    def transfers(self, params):
+        result, df_round, squad = self.scenario(params)
+        n_transfers = int(params.get('n_transfers', 1))
+        team = fpl_optimise.optimise_team(df_round, squad, result['bank'], n_transfers, result['n_round'],
+                                          self.backend, result['quantile'], self.n_samples)
+        if not np.isfinite(team['points']):
+            raise ValueError('No lineup of the squad fits any formation')
+        lineup, new_team = team['lineup'], team['new_team']
+        result.update({'formation': team['formation'], 'points': float(team['points']),
+                       'formation_scores': formation_dict(team['formation_scores'].values()),
+                       'lineup': records(lineup), 'bench': records(team['bench']),
+                       'transfers_out': records(lineup[~lineup.element.isin(new_team.element)]),
+                       'transfers_in': records(new_team[~new_team.element.isin(lineup.element)]),
+                       'new_points': float(team['new_points']), 'new_team': records(new_team)})
+        return result
+
+    def status(self, params):
+        run_id, df_prediction, rounds = self.store.get()
+        return {'prediction_run': run_id, 'loads': self.store.n_loads, 'players': len(rounds.get(1, ())),
+                'rounds': [int(df_prediction['round'].min()), int(df_prediction['round'].max())],
+                'picks_cache': self.picks.stats()}
+
+def element_list(value):
+    """'1,2,3' -> [1, 2, 3]"""
+    return [int(e) for e in value.split(',') if e.strip()] if value else []
+
+def records(df):
+    return json.loads(df.to_json(orient='records'))
+
+def formation_dict(scores):
+    """The points of each formation, None for the formations that the squad cannot play"""
+    return {f: float(s) if np.isfinite(s) else None for f, s in zip(fpl_optimise.POSSIBLE_FORMATIONS, scores)}
+
+def make_server(service, host='127.0.0.1', port=8000, verbose=True):
+    """A threading HTTP server answering GET /lineup, /transfers and /status as JSON. Call
+    serve_forever() to run it; port 0 picks a free port (server.server_address)
+    """
+    routes = {'/lineup': service.lineup, '/transfers': service.transfers, '/status': service.status}
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            url = urlsplit(self.path)
+            start = time.perf_counter()
+            status = 200
+            try:
+                if url.path not in routes:
+                    status, body = 404, {'error': 'Unknown path {}, use one of {}'.format(url.path, ', '.join(routes))}
+                else:
+                    params = {k: v[-1] for k, v in parse_qs(url.query).items()}
+                    body = routes[url.path](params)
+                    body['time'] = time.perf_counter() - start
+            except (ValueError, KeyError) as e:
+                status, body = 400, {'error': str(e)}
+            except requests.RequestException as e:  # The FPL API
+                status, body = 502, {'error': repr(e)}
+            except Exception as e:
+                traceback.print_exc()
+                status, body = 500, {'error': repr(e)}
+            data = json.dumps(body).encode()
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def log_message(self, *args):
+            if verbose:
+                super().log_message(*args)
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    server.daemon_threads = True
+    return server
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument("--host", dest="host", default='127.0.0.1', help="Address to listen on")
+    parser.add_argument("-p", "--port", type=int, dest="port", default=8000, help="Port to listen on")
+    parser.add_argument("--base_url", dest="base_url", default=fpl_optimise.FPL_API,
+                        help="API base url, e.g. a local stub server")
+    parser.add_argument("--picks_ttl", type=float, dest="picks_ttl", default=600,
+                        help="Seconds to keep the picks of a team before fetching them again")
+    parser.add_argument("--check_interval", type=float, dest="check_interval", default=1.0,
+                        help="Seconds between the checks for new predictions")
+    parser.add_argument("--solver", choices=fpl_solver.BACKENDS, dest="solver",
+                        help="MILP solver (default: the first available of highs, ortools, cbc)")
+    parser.add_argument("--samples", type=int, dest="samples", default=fpl_simulation.N_SAMPLES,
+                        help="Number of simulations of the squad for the quantile parameter")
+    args = parser.parse_args()
+
+    config = fpl_bot.read_config()
+    store = PredictionStore(lambda: fpl_bot.connect(config), config.get('DATABASE', 'MAIN_SCHEMA'),
+                            args.check_interval)
+    store.get()  # Fail early without predictions
+    service = Service(store, args.base_url, args.picks_ttl, args.solver, args.samples)
+    server = make_server(service, args.host, args.port)
+    print("Serving on http://{}:{}".format(*server.server_address))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.server_close()
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,49 @@
+from statistics import NormalDist
+import numpy as np
+
+"""
+Monte-Carlo simulation of the points of many players at once, from the predicted points and their
+standard deviation (points_std of fpl_prediction, from the residuals of the models).
+The points of each player are normal around the prediction and independent of the other players,
+so a lineup's points in each sample are a row sum of the samples of its players.
+"""
+
+N_SAMPLES = 10000
+
+def simulate(mean, std, n_samples=N_SAMPLES, seed=0):
+    """n_samples draws of the points of every player, an array of shape (n_samples, len(mean)).
+    Missing means and standard deviations count as 0. Drawn in float32: 10000 samples of 700
+    players take about 0.1s and 28 MB
+    """
+    mean = np.nan_to_num(np.asarray(mean, dtype='float32'))
+    std = np.nan_to_num(np.asarray(std, dtype='float32'))
+    samples = np.random.default_rng(seed).standard_normal((n_samples, len(mean)), dtype=np.float32)
+    samples *= std
+    samples += mean
+    return samples
+
+def quantile_value(value):
+    """float(value), which must be strictly between 0 and 1 (the normal distribution has no 0 or 1
+    quantile). Also the type of the --quantile arguments"""
+    quantile = float(value)
+    if not 0 < quantile < 1:
+        raise ValueError('quantile must be between 0 and 1 (exclusive), not {}'.format(value))
+    return quantile
+
+def quantile_points(mean, std, quantile):
+    """The quantile of each player's points (exact for the normal distribution of simulate)"""
+    std = np.nan_to_num(np.asarray(std, dtype='float64'))
+    return np.asarray(mean, dtype='float64') + NormalDist().inv_cdf(quantile_value(quantile)) * std
+
+def sample_quantile(totals, quantile):
+    """The quantile of each row of totals, as np.quantile(totals, quantile, axis=1) (linear
+    interpolation), from a single partition of the rows at the upper of the two ranks used: about
+    10x faster than np.quantile's sort on the 550 x 10000 totals of the lineups of a squad
+    """
+    n = totals.shape[1]
+    h = quantile * (n - 1)
+    hi = min(int(np.floor(h)) + 1, n - 1)
+    part = np.partition(totals, hi, axis=1)
+    upper = part[:, hi]
+    lower = part[:, :hi].max(axis=1) if h < hi else upper  # The largest value before rank hi
+    return lower + (h - np.floor(h)) * (upper - lower)
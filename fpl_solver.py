@@ -0,0 +1,191 @@
+import time
+from collections import deque
+import numpy as np
+import pulp
+import fpl_metrics
+try:
+    import highspy
+except ImportError:  # pip install highspy
+    highspy = None
+try:
+    from ortools.linear_solver import pywraplp
+except ImportError:  # pip install ortools
+    pywraplp = None
+
+"""
+Solve PuLP problems in this process with HiGHS (highspy) or OR-Tools instead of writing an MPS file
+and running the CBC executable, which dominates the run time of small problems. CBC is the fallback
+when neither is installed. Every solve is recorded in solve_log and in the run report of fpl_metrics.
+"""
+
+BACKENDS = ['highs', 'ortools', 'cbc']  # In order of preference
+solve_log = deque(maxlen=1000)  # The latest solves, bounded for the daemon and fpl_service
+
+def available_backends():
+    return [b for b in BACKENDS if (b != 'highs' or highspy is not None)
+            and (b != 'ortools' or pywraplp is not None)]
+
+def matrix_form(fpl_problem):
+    """The variables of fpl_problem and its objective, bounds and constraint rows as arrays"""
+    variables = fpl_problem.variables()
+    column = {v.name: j for j, v in enumerate(variables)}
+    cost = np.zeros(len(variables))
+    for v, c in fpl_problem.objective.items():
+        cost[column[v.name]] = c
+    lower = np.array([-np.inf if v.lowBound is None else v.lowBound for v in variables], dtype='float64')
+    upper = np.array([np.inf if v.upBound is None else v.upBound for v in variables], dtype='float64')
+    integer = np.array([v.cat == pulp.LpInteger for v in variables])
+    start, index, value, row_lower, row_upper = [0], [], [], [], []
+    for constraint in fpl_problem.constraints.values():
+        for v, c in constraint.items():
+            index.append(column[v.name])
+            value.append(c)
+        start.append(len(index))
+        rhs = -constraint.constant
+        row_lower.append(rhs if constraint.sense != pulp.LpConstraintLE else -np.inf)
+        row_upper.append(rhs if constraint.sense != pulp.LpConstraintGE else np.inf)
+    return {'variables': variables, 'cost': cost, 'lower': lower, 'upper': upper, 'integer': integer,
+            'start': np.array(start), 'index': np.array(index, dtype='int64'),
+            'value': np.array(value, dtype='float64'),
+            'row_lower': np.array(row_lower, dtype='float64'), 'row_upper': np.array(row_upper, dtype='float64')}
+
+def set_solution(fpl_problem, variables, values, status, sol_status):
+    """Write the values of the solution to the variables; without values (no solution found) the
+    values of an earlier solve or warm start are cleared"""
+    if values is None:
+        values = [None] * len(variables)
+    for v, x in zip(variables, values):
+        v.varValue = round(x) if v.cat == pulp.LpInteger and x is not None else x
+    fpl_problem.status = status
+    fpl_problem.sol_status = sol_status
+
+def solve_highs(fpl_problem, time_limit=None, mip_rel_gap=None, threads=None, warm_start=False, msg=False):
+    m = matrix_form(fpl_problem)
+    lp = highspy.HighsLp()
+    lp.num_col_ = len(m['cost'])
+    lp.num_row_ = len(m['row_lower'])
+    lp.col_cost_ = m['cost']
+    lp.col_lower_ = np.where(np.isinf(m['lower']), -highspy.kHighsInf, m['lower'])
+    lp.col_upper_ = np.where(np.isinf(m['upper']), highspy.kHighsInf, m['upper'])
+    lp.row_lower_ = np.where(np.isinf(m['row_lower']), -highspy.kHighsInf, m['row_lower'])
+    lp.row_upper_ = np.where(np.isinf(m['row_upper']), highspy.kHighsInf, m['row_upper'])
+    lp.a_matrix_.format_ = highspy.MatrixFormat.kRowwise
+    lp.a_matrix_.num_col_ = lp.num_col_
+    lp.a_matrix_.num_row_ = lp.num_row_
+    lp.a_matrix_.start_ = m['start']
+    lp.a_matrix_.index_ = m['index']
+    lp.a_matrix_.value_ = m['value']
+    lp.integrality_ = [highspy.HighsVarType.kInteger if i else highspy.HighsVarType.kContinuous
+                       for i in m['integer']]
+    lp.offset_ = fpl_problem.objective.constant
+    if fpl_problem.sense == pulp.LpMaximize:
+        lp.sense_ = highspy.ObjSense.kMaximize
+
+    h = highspy.Highs()
+    h.setOptionValue('output_flag', bool(msg))
+    if time_limit is not None:
+        h.setOptionValue('time_limit', float(time_limit))
+    if mip_rel_gap is not None:
+        h.setOptionValue('mip_rel_gap', float(mip_rel_gap))
+    if threads is not None:
+        h.setOptionValue('threads', int(threads))
+    h.passModel(lp)
+    if warm_start and all(v.varValue is not None for v in m['variables']):
+        solution = highspy.HighsSolution()
+        solution.col_value = [v.varValue for v in m['variables']]
+        solution.value_valid = True
+        h.setSolution(solution)
+    h.run()
+
+    model_status = h.getModelStatus()
+    has_solution = h.getInfo().primal_solution_status == highspy.kSolutionStatusFeasible
+    if model_status == highspy.HighsModelStatus.kOptimal:
+        status, sol_status = pulp.LpStatusOptimal, pulp.LpSolutionOptimal
+    elif model_status == highspy.HighsModelStatus.kInfeasible:
+        status, sol_status = pulp.LpStatusInfeasible, pulp.LpSolutionInfeasible
+    elif model_status in (highspy.HighsModelStatus.kUnbounded, highspy.HighsModelStatus.kUnboundedOrInfeasible):
+        status, sol_status = pulp.LpStatusUnbounded, pulp.LpSolutionUnbounded
+    elif has_solution:  # e.g. stopped at the time limit
+        status, sol_status = pulp.LpStatusOptimal, pulp.LpSolutionIntegerFeasible
+    else:
+        status, sol_status = pulp.LpStatusNotSolved, pulp.LpSolutionNoSolutionFound
+    if has_solution:
+        set_solution(fpl_problem, m['variables'], h.getSolution().col_value, status, sol_status)
+    else:
+        set_solution(fpl_problem, m['variables'], None, status, sol_status)
+    return status
+
+def solve_ortools(fpl_problem, time_limit=None, mip_rel_gap=None, threads=None, warm_start=False,
+                  msg=False, engine='SCIP'):
+    m = matrix_form(fpl_problem)
+    solver = pywraplp.Solver.CreateSolver(engine)
+    infinity = solver.infinity()
+    x = [solver.IntVar(lo, up, v.name) if integer else solver.NumVar(lo, up, v.name)
+         for v, lo, up, integer in zip(m['variables'], np.nan_to_num(m['lower'], neginf=-infinity),
+                                       np.nan_to_num(m['upper'], posinf=infinity), m['integer'])]
+    for i in range(len(m['row_lower'])):
+        row = solver.RowConstraint(max(m['row_lower'][i], -infinity), min(m['row_upper'][i], infinity), '')
+        for j in range(m['start'][i], m['start'][i + 1]):
+            row.SetCoefficient(x[m['index'][j]], m['value'][j])
+    objective = solver.Objective()
+    for xj, c in zip(x, m['cost']):
+        objective.SetCoefficient(xj, c)
+    objective.SetOffset(fpl_problem.objective.constant)
+    if fpl_problem.sense == pulp.LpMaximize:
+        objective.SetMaximization()
+    if time_limit is not None:
+        solver.SetTimeLimit(int(time_limit * 1000))
+    if threads is not None:
+        solver.SetNumThreads(int(threads))
+    if warm_start and all(v.varValue is not None for v in m['variables']):
+        solver.SetHint(x, [v.varValue for v in m['variables']])
+    if msg:
+        solver.EnableOutput()
+    parameters = pywraplp.MPSolverParameters()
+    if mip_rel_gap is not None:
+        parameters.SetDoubleParam(parameters.RELATIVE_MIP_GAP, mip_rel_gap)
+    result = solver.Solve(parameters)
+
+    if result == pywraplp.Solver.OPTIMAL:
+        status, sol_status = pulp.LpStatusOptimal, pulp.LpSolutionOptimal
+    elif result == pywraplp.Solver.FEASIBLE:
+        status, sol_status = pulp.LpStatusOptimal, pulp.LpSolutionIntegerFeasible
+    elif result == pywraplp.Solver.INFEASIBLE:
+        status, sol_status = pulp.LpStatusInfeasible, pulp.LpSolutionInfeasible
+    elif result == pywraplp.Solver.UNBOUNDED:
+        status, sol_status = pulp.LpStatusUnbounded, pulp.LpSolutionUnbounded
+    else:
+        status, sol_status = pulp.LpStatusNotSolved, pulp.LpSolutionNoSolutionFound
+    if sol_status in (pulp.LpSolutionOptimal, pulp.LpSolutionIntegerFeasible):
+        set_solution(fpl_problem, m['variables'], [xj.solution_value() for xj in x], status, sol_status)
+    else:
+        set_solution(fpl_problem, m['variables'], None, status, sol_status)
+    return status
+
+def solve_cbc(fpl_problem, time_limit=None, mip_rel_gap=None, threads=None, warm_start=False, msg=False):
+    return fpl_problem.solve(pulp.PULP_CBC_CMD(msg=msg, timeLimit=time_limit, gapRel=mip_rel_gap,
+                                               threads=threads, warmStart=warm_start))
+
+SOLVERS = {'highs': solve_highs, 'ortools': solve_ortools, 'cbc': solve_cbc}
+
+def solve(fpl_problem, backend=None, time_limit=None, mip_rel_gap=None, threads=None,
+          warm_start=False, msg=False):
+    """Solve fpl_problem with backend (the first available of BACKENDS if None), with an optional
+    time limit in seconds, relative MIP gap and number of threads. warm_start uses the initial
+    values of the variables (setInitialValue) as a starting solution.
+    Sets the values of the variables and the status of fpl_problem like fpl_problem.solve().
+    Returns the status and appends the backend, status, time and stage of the solve to solve_log
+    """
+    backend = backend or available_backends()[0]
+    if backend not in available_backends():
+        raise ValueError('Solver backend {} is not available, use one of {}'.format(
+            backend, available_backends()))
+    start = time.perf_counter()
+    status = SOLVERS[backend](fpl_problem, time_limit=time_limit, mip_rel_gap=mip_rel_gap,
+                              threads=threads, warm_start=warm_start, msg=msg)
+    entry = {'problem': fpl_problem.name, 'backend': backend, 'status': pulp.LpSolution[fpl_problem.sol_status],
+             'variables': fpl_problem.numVariables(), 'constraints': fpl_problem.numConstraints(),
+             'time': time.perf_counter() - start, 'stage': fpl_metrics.current_stage()}
+    solve_log.append(entry)
+    fpl_metrics.add_solve(entry)
+    return status
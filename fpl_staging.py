@@ -0,0 +1,70 @@
+import os
+import re
+import gzip
+import json
+try:
+    import orjson
+except ImportError:  # pip install orjson (json is about 3x slower on the element-summaries)
+    orjson = None
+
+"""
+The staged element-summaries: a single gzip file of newline-delimited JSON in the stage directory,
+one line per player
+
+    {"element":1,"sha1":"<sha1 of the API response>","summary":<the API response>}
+
+written by import_data.py and streamed line by line into COPY by populate_tables.py, so neither
+holds more than one player in memory. The element and sha1 come first, so the index of the file
+is read without parsing the summaries.
+"""
+
+SUMMARIES = 'element_summaries.ndjson.gz'
+LINE_PREFIX = re.compile(rb'\{"element":(\d+),"sha1":"(\w*)"')
+
+loads = orjson.loads if orjson is not None else json.loads
+
+def summary_line(element, sha1, content):
+    """A line of the file for the raw JSON content of an element-summary"""
+    # Newlines can only be whitespace in JSON (they are escaped in strings)
+    content = content.strip().replace(b'\r', b' ').replace(b'\n', b' ')
+    return b'{"element":%d,"sha1":"%s","summary":%s}\n' % (element, sha1.encode(), content)
+
+def staged_lines(stage_dir):
+    """Yield (element, sha1, line) for each line of the file, without parsing the summaries"""
+    try:
+        f = gzip.open(os.path.join(stage_dir, SUMMARIES), 'rb')
+    except FileNotFoundError:
+        return
+    with f:
+        for line in f:
+            m = LINE_PREFIX.match(line)
+            yield int(m.group(1)), m.group(2).decode(), line
+
+def summary_index(stage_dir):
+    """{element: sha1} of the staged element-summaries"""
+    return {element: sha1 for element, sha1, _ in staged_lines(stage_dir)}
+
+def read_summaries(stage_dir):
+    """Yield (element, summary) for each staged element-summary, in the order of the file"""
+    for element, _, line in staged_lines(stage_dir):
+        yield element, loads(line)['summary']
+
+def write_summaries(stage_dir, fetched, compresslevel=6):
+    """Write the (element, sha1, content) of fetched to the file, followed by the staged lines of the
+    other players, and replace the file once done. fetched can be a generator: lines are written as
+    they come. Returns the number of lines written
+    """
+    path = os.path.join(stage_dir, SUMMARIES)
+    written = set()
+    with open(path + '.tmp', 'wb') as raw, \
+            gzip.GzipFile(fileobj=raw, mode='wb', compresslevel=compresslevel, mtime=0) as out:
+        for element, sha1, content in fetched:
+            out.write(summary_line(element, sha1, content))
+            written.add(element)
+        n_kept = 0
+        for element, _, line in staged_lines(stage_dir):
+            if element not in written:
+                out.write(line)
+                n_kept += 1
+    os.replace(path + '.tmp', path)
+    return len(written) + n_kept
@@ -0,0 +1,67 @@
+import os
+import re
+import json
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+import fpl_optimise
+import fpl_staging
+
+"""Stand-ins of the FPL API and squads for the tests and benchmark.py, e.g. with the synthetic
+seasons of fpl_synthetic"""
+
+def serve_directory(directory, picks=None):
+    """A local stand-in of the FPL API serving the files and element-summaries of a stage directory,
+    and the picks of {(team_id, event): picks response}. Returns the server (call shutdown() when
+    done; server.paths lists the paths requested) and its base url
+    """
+    summaries = {element: json.dumps(summary).encode()
+                 for element, summary in fpl_staging.read_summaries(directory)}
+    picks = {key: json.dumps(value).encode() for key, value in (picks or {}).items()}
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            self.server.paths.append(self.path)
+            m = re.fullmatch(r'/(bootstrap-static|fixtures|element-summary/(\d+)|entry/(\d+)/event/(\d+)/picks)/',
+                             self.path)
+            filename = m and {'bootstrap-static': 'bootstrap_static.json', 'fixtures': 'fixtures.json'}.get(
+                m.group(1))
+            if m and m.group(2):
+                data = summaries.get(int(m.group(2)))
+            elif m and m.group(3):
+                data = picks.get((int(m.group(3)), int(m.group(4))))
+            elif filename and os.path.exists(os.path.join(directory, filename)):
+                with open(os.path.join(directory, filename), 'rb') as f:
+                    data = f.read()
+            else:
+                data = None
+            if data is None:
+                self.send_error(404)
+                return
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler, bind_and_activate=False)
+    server.request_queue_size = 64  # The default backlog of 5 drops the connections of concurrent workers
+    server.paths = []
+    server.server_bind()
+    server.server_activate()
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, 'http://127.0.0.1:{}'.format(server.server_address[1])
+
+def cheapest_squad(df_prediction):
+    """A valid squad (2 GKP, 5 DEF, 5 MID, 3 FWD, at most 3 per club) of the cheapest players"""
+    players = df_prediction.drop_duplicates('element').sort_values(['now_cost', 'element'])
+    need = {'GKP': 2, 'DEF': 5, 'MID': 5, 'FWD': 3}
+    clubs, squad = {}, []
+    for element, position, club in players[['element', 'position', 'name_own_team']].values:
+        if need.get(position) and clubs.get(club, 0) < fpl_optimise.MAX_PER_CLUB:
+            need[position] -= 1
+            clubs[club] = clubs.get(club, 0) + 1
+            squad.append(int(element))
+    return squad
@@ -0,0 +1,279 @@
+import os
+import io
+import csv
+import json
+import random
+import hashlib
+from datetime import datetime, timedelta
+import fpl_staging
+
+"""Generate synthetic FPL data in the same format as the API, e.g. for benchmarking"""
+
+POSITION_SHARES = {1: 0.12, 2: 0.35, 3: 0.39, 4: 0.14}  # GKP, DEF, MID, FWD
+TEAM_NAMES = ['ARS', 'AVL', 'BOU', 'BRE', 'BHA', 'CHE', 'CRY', 'EVE', 'FUL', 'LEE',
+              'LEI', 'LIV', 'MCI', 'MUN', 'NEW', 'NFO', 'SOU', 'TOT', 'WHU', 'WOL']
+
+def schedule(n_teams=20):
+    """Double round-robin with the circle method: a list of rounds with (home, away) team ids"""
+    teams = list(range(1, n_teams + 1))
+    rounds = []
+    for _ in range(n_teams - 1):
+        rounds.append([(teams[i], teams[n_teams - 1 - i]) for i in range(n_teams // 2)])
+        teams = [teams[0]] + [teams[-1]] + teams[1:-1]
+    return rounds + [[(a, h) for h, a in r] for r in rounds]
+
+def make_teams(rng, n_teams=20):
+    teams = []
+    for i in range(1, n_teams + 1):
+        strength = rng.randint(2, 5)
+        teams.append({'id': i, 'code': i, 'draw': 0, 'form': None, 'loss': 0,
+                      'name': 'Team {}'.format(i), 'played': 0, 'points': 0, 'position': 0,
+                      'short_name': TEAM_NAMES[(i - 1) % len(TEAM_NAMES)], 'strength': strength,
+                      'team_division': None, 'unavailable': False, 'win': 0,
+                      'strength_overall_home': 1000 + 50 * strength,
+                      'strength_overall_away': 1000 + 50 * strength,
+                      'strength_attack_home': 1000 + 50 * strength,
+                      'strength_attack_away': 1000 + 50 * strength,
+                      'strength_defence_home': 1000 + 50 * strength,
+                      'strength_defence_away': 1000 + 50 * strength,
+                      'pulse_id': i})
+    return teams
+
+def make_element_types():
+    names = {1: ('Goalkeeper', 'GKP', 2, 1, 1), 2: ('Defender', 'DEF', 5, 3, 5),
+             3: ('Midfielder', 'MID', 5, 2, 5), 4: ('Forward', 'FWD', 3, 1, 3)}
+    return [{'id': i, 'plural_name': name + 's', 'plural_name_short': short,
+             'singular_name': name, 'singular_name_short': short, 'squad_select': select,
+             'squad_min_play': min_play, 'squad_max_play': max_play,
+             'ui_shirt_specific': i == 1, 'sub_positions_locked': [12] if i == 1 else [],
+             'element_count': 0}
+            for i, (name, short, select, min_play, max_play) in names.items()]
+
+def make_fixtures(n_teams=20, n_played=10, start=datetime(2022, 8, 5, 19), n_postponed=0):
+    """The first n_postponed matches of round n_played + 2 are played in round n_played + 4 instead,
+    a blank and a double gameweek for their teams"""
+    fixtures = []
+    for event, matches in enumerate(schedule(n_teams), start=1):
+        kickoff = start + timedelta(days=7 * (event - 1))
+        for home, away in matches:
+            fixture_id = len(fixtures) + 1
+            finished = event <= n_played
+            fixtures.append({'code': 2292800 + fixture_id, 'event': event, 'finished': finished,
+                             'finished_provisional': finished, 'id': fixture_id,
+                             'kickoff_time': kickoff.strftime('%Y-%m-%dT%H:%M:%SZ'),
+                             'minutes': 90 if finished else 0, 'provisional_start_time': False,
+                             'started': finished, 'team_a': away,
+                             'team_a_score': 1 if finished else None, 'team_h': home,
+                             'team_h_score': 2 if finished else None, 'stats': [],
+                             'team_h_difficulty': 3, 'team_a_difficulty': 3,
+                             'pulse_id': 74900 + fixture_id})
+    postponed = [f for f in fixtures if f['event'] == n_played + 2][:n_postponed]
+    for f in postponed if n_played + 4 <= len(schedule(n_teams)) else []:
+        f['event'] = n_played + 4
+        f['kickoff_time'] = (start + timedelta(days=7 * (n_played + 3) + 1)).strftime('%Y-%m-%dT%H:%M:%SZ')
+    return fixtures
+
+def make_elements(rng, n_players=700, n_teams=20):
+    elements = []
+    for element_type, share in POSITION_SHARES.items():
+        for _ in range(round(share * n_players)):
+            element_id = len(elements) + 1
+            now_cost = rng.randint(40, 130) if element_type > 1 else rng.randint(40, 60)
+            elements.append({'id': element_id, 'code': 100000 + element_id,
+                             'element_type': element_type, 'team': rng.randint(1, n_teams),
+                             'first_name': 'Player', 'second_name': str(element_id),
+                             'web_name': 'Player {}'.format(element_id), 'now_cost': now_cost,
+                             'event_points': 0, 'minutes': 0, 'transfers_in_event': 0,
+                             'status': 'a', 'news': '', 'special': False, 'in_dreamteam': False})
+    return elements[:n_players]
+
+def make_history(rng, element, fixture, was_home, played):
+    """One row of element-summary['history'] for a finished fixture"""
+    minutes = rng.choice([0, 0, 20, 60, 90, 90, 90]) if played else 0
+    total_points = (rng.randint(1, 13) if minutes >= 60 else int(minutes > 0))
+    influence = round(rng.uniform(0, 60), 1) if minutes else 0.0
+    creativity = round(rng.uniform(0, 50), 1) if minutes else 0.0
+    threat = round(rng.uniform(0, 70), 1) if minutes else 0.0
+    return {'element': element['id'], 'fixture': fixture['id'],
+            'opponent_team': fixture['team_a'] if was_home else fixture['team_h'],
+            'total_points': total_points, 'was_home': was_home,
+            'kickoff_time': fixture['kickoff_time'], 'team_h_score': fixture['team_h_score'],
+            'team_a_score': fixture['team_a_score'], 'round': fixture['event'],
+            'minutes': minutes, 'goals_scored': int(total_points > 8), 'assists': 0,
+            'clean_sheets': 0, 'goals_conceded': 1, 'own_goals': 0, 'penalties_saved': 0,
+            'penalties_missed': 0, 'yellow_cards': 0, 'red_cards': 0, 'saves': 0,
+            'bonus': max(total_points - 10, 0), 'bps': rng.randint(0, 40) if minutes else 0,
+            'influence': '{:.1f}'.format(influence), 'creativity': '{:.1f}'.format(creativity),
+            'threat': '{:.1f}'.format(threat),
+            'ict_index': '{:.1f}'.format((influence + creativity + threat) / 10),
+            'value': element['now_cost'], 'transfers_balance': rng.randint(-5000, 5000),
+            'selected': rng.randint(0, 500000), 'transfers_in': rng.randint(0, 5000),
+            'transfers_out': rng.randint(0, 5000)}
+
+def make_element_summary(rng, element, fixtures):
+    """Outcomes are drawn for every fixture, so a player's history does not depend on how many
+    rounds have been played"""
+    history, future = [], []
+    for fixture in fixtures:
+        if element['team'] not in (fixture['team_h'], fixture['team_a']):
+            continue
+        was_home = fixture['team_h'] == element['team']
+        played = make_history(rng, element, fixture, was_home, rng.random() < 0.8)
+        if fixture['finished']:
+            history.append(played)
+        else:
+            future.append({'id': fixture['id'], 'code': fixture['code'],
+                           'team_h': fixture['team_h'], 'team_a': fixture['team_a'],
+                           'event': fixture['event'], 'finished': False, 'minutes': 0,
+                           'provisional_start_time': False,
+                           'kickoff_time': fixture['kickoff_time'], 'event_name':
+                           'Gameweek {}'.format(fixture['event']), 'is_home': was_home,
+                           'difficulty': 3})
+    return {'fixtures': future, 'history': history, 'history_past': []}
+
+def make_season(n_players=700, n_played=10, seed=0, n_postponed=0):
+    """bootstrap-static, fixtures and the element-summary of each player of one season"""
+    rng = random.Random(seed)
+    fixtures = make_fixtures(n_played=n_played, n_postponed=n_postponed)
+    elements = make_elements(rng, n_players)
+    bootstrap_static = {'teams': make_teams(rng), 'elements': elements,
+                        'element_types': make_element_types()}
+    summaries = {element['id']: make_element_summary(random.Random(seed * 100003 + element['id']),
+                                                     element, fixtures)
+                 for element in elements}
+    return bootstrap_static, fixtures, summaries
+
+def write_stage_dir(stage_dir, n_players=700, n_played=10, seed=0, n_postponed=0):
+    """Write bootstrap_static.json, fixtures.json and the element-summaries (see fpl_staging)"""
+    bootstrap_static, fixtures, summaries = make_season(n_players, n_played, seed, n_postponed)
+    os.makedirs(stage_dir, exist_ok=True)
+    with io.open(os.path.join(stage_dir, 'bootstrap_static.json'), 'w') as outfile:
+        json.dump(bootstrap_static, outfile)
+    with io.open(os.path.join(stage_dir, 'fixtures.json'), 'w') as outfile:
+        json.dump(fixtures, outfile)
+    contents = ((element_id, json.dumps(summary).encode()) for element_id, summary in summaries.items())
+    fpl_staging.write_summaries(stage_dir, ((element_id, hashlib.sha1(content).hexdigest(), content)
+                                            for element_id, content in contents))
+
+def write_csv(path, columns, rows):
+    with io.open(path, 'w', newline='', encoding='latin-1') as outfile:
+        writer = csv.DictWriter(outfile, columns, extrasaction='ignore')
+        writer.writeheader()
+        writer.writerows(rows)
+
+def write_csv_season(season_dir, n_players=700, seed=0):
+    """Write a finished season in the layout of the public historical CSV dumps read by
+    fpl_seasons: gws/merged_gw.csv, players_raw.csv and teams.csv"""
+    bootstrap_static, _, summaries = make_season(n_players, n_played=38, seed=seed)
+    os.makedirs(os.path.join(season_dir, 'gws'), exist_ok=True)
+    write_csv(os.path.join(season_dir, 'teams.csv'), ['id', 'name', 'short_name', 'strength'],
+              bootstrap_static['teams'])
+    write_csv(os.path.join(season_dir, 'players_raw.csv'),
+              ['id', 'first_name', 'second_name', 'web_name', 'element_type', 'team', 'now_cost'],
+              bootstrap_static['elements'])
+    rows = [dict(row, GW=row['round']) for summary in summaries.values() for row in summary['history']]
+    write_csv(os.path.join(season_dir, 'gws', 'merged_gw.csv'),
+              ['element', 'fixture', 'opponent_team', 'total_points', 'was_home', 'kickoff_time', 'GW',
+               'minutes', 'goals_scored', 'assists', 'bps', 'influence', 'creativity', 'threat',
+               'ict_index', 'value'],
+              sorted(rows, key=lambda row: (row['GW'], row['element'])))
+
+def write_seasons(base_dir, n_seasons=1, n_players=700, n_played=10, seed=0, n_postponed=0):
+    """The current season as a stage directory (base_dir/stage) and the n_seasons - 1 seasons before
+    it as historical CSV dumps (base_dir/2020-21, ...). Returns the stage directory and the season
+    directories, oldest first"""
+    first_year = 2022 - (n_seasons - 1)
+    season_dirs = []
+    for i in range(n_seasons - 1):
+        season_dir = os.path.join(base_dir, '{}-{:02d}'.format(first_year + i, (first_year + i + 1) % 100))
+        write_csv_season(season_dir, n_players, seed=seed + 1 + i)
+        season_dirs.append(season_dir)
+    stage_dir = os.path.join(base_dir, 'stage')
+    write_stage_dir(stage_dir, n_players, n_played, seed=seed, n_postponed=n_postponed)
+    return stage_dir, season_dirs
+
+def stage_player_history(stage_dir):
+    """The player_history frame that populate_tables builds from the files in stage_dir
+    (see sql/DML_player_history.sql), without Postgres, sorted on element, round"""
+    import pandas as pd
+    import populate_tables
+    with io.open(os.path.join(stage_dir, 'bootstrap_static.json'), encoding='utf-8') as f:
+        bootstrap_static = json.loads(f.read())
+    with io.open(os.path.join(stage_dir, 'fixtures.json'), encoding='utf-8') as f:
+        fixtures = pd.DataFrame(json.loads(f.read()))
+    df = pd.DataFrame(list(populate_tables.player_history_rows(stage_dir)),
+                      columns=populate_tables.ddl_columns('stg_player_history'))
+    for c in ['influence', 'creativity', 'threat', 'ict_index']:
+        df[c] = pd.to_numeric(df[c])
+    elements = pd.DataFrame(bootstrap_static['elements'])[['id', 'web_name', 'team', 'element_type']]
+    teams = pd.DataFrame(bootstrap_static['teams']).set_index('id')
+    positions = pd.DataFrame(bootstrap_static['element_types']).set_index('id')['singular_name_short']
+    df = df.merge(elements.rename(columns={'id': 'element'}), on='element')
+    df['position'] = positions.reindex(df.pop('element_type')).values
+    df['name_own_team'] = teams['short_name'].reindex(df['team']).values
+    df['strength_own_team'] = teams['strength'].reindex(df['team']).values
+    df['name_opponent_team'] = teams['short_name'].reindex(df['opponent_team']).values
+    df['strength_opponent_team'] = teams['strength'].reindex(df['opponent_team']).values
+    df['finished'] = fixtures.set_index('id')['finished'].reindex(df['fixture']).values.astype(bool)
+    return df.sort_values(['element', 'round'], kind='stable').reset_index(drop=True)
+
+def stage_fixture_index(stage_dir):
+    """The fixture_index table that populate_tables builds from the files in stage_dir
+    (see sql/DML_fixture_index.sql), without Postgres, sorted on team, round"""
+    import pandas as pd
+    with io.open(os.path.join(stage_dir, 'bootstrap_static.json'), encoding='utf-8') as f:
+        teams = pd.DataFrame(json.loads(f.read())['teams']).set_index('id')
+    with io.open(os.path.join(stage_dir, 'fixtures.json'), encoding='utf-8') as f:
+        fixtures = pd.DataFrame(json.loads(f.read()))
+    columns = ['id', 'event', 'kickoff_time', 'team', 'opponent', 'difficulty']
+    sides = pd.concat([
+        fixtures.rename(columns={'team_h': 'team', 'team_a': 'opponent', 'team_h_difficulty': 'difficulty'})[columns],
+        fixtures.rename(columns={'team_a': 'team', 'team_h': 'opponent', 'team_a_difficulty': 'difficulty'})[columns]])
+    sides = sides.dropna(subset=['event']).sort_values(['kickoff_time', 'id'])
+    sides['opponent_strength'] = teams['strength'].reindex(sides['opponent']).values
+    by_round = sides.groupby(['team', 'event'])
+    index = pd.DataFrame({'n_fixtures': by_round.size(), 'opponents': by_round['opponent'].agg(list),
+                          'opponent_strength': by_round['opponent_strength'].mean(),
+                          'difficulty': by_round['difficulty'].mean()})
+    grid = pd.MultiIndex.from_product([sorted(teams.index), range(1, int(fixtures['event'].max()) + 1)],
+                                      names=['team', 'round'])
+    index = index.reindex(grid)
+    index['n_fixtures'] = index['n_fixtures'].fillna(0).astype('int64')
+    index['opponents'] = [x if isinstance(x, list) else [] for x in index['opponents']]
+    return index.reset_index()
+
+def player_history_frame(n_players=700, n_seasons=1, n_rounds=38, n_played=None, seed=0):
+    """A player_history-like dataframe sorted on element, round. Rounds of later seasons
+    continue the numbering of earlier ones; rounds after n_played have no outcomes yet.
+    """
+    import numpy as np
+    import pandas as pd
+    rng = np.random.default_rng(seed)
+    n_total = n_seasons * n_rounds
+    n_played = n_total if n_played is None else n_played
+    element = np.repeat(np.arange(1, n_players + 1), n_total)
+    round_ = np.tile(np.arange(1, n_total + 1), n_players)
+    n = len(element)
+    minutes = rng.choice([0, 0, 20, 60, 90, 90, 90], size=n).astype('float64')
+    played = minutes > 0
+    df = pd.DataFrame({
+        'element': element,
+        'round': round_,
+        'minutes': minutes,
+        'total_points': np.where(minutes >= 60, rng.integers(1, 14, n), played.astype(int)),
+        'influence': np.round(rng.uniform(0, 60, n), 1) * played,
+        'creativity': np.round(rng.uniform(0, 50, n), 1) * played,
+        'threat': np.round(rng.uniform(0, 70, n), 1) * played,
+        'bps': rng.integers(0, 40, n) * played,
+        'value': np.repeat(rng.integers(40, 130, n_players), n_total),
+        'was_home': rng.random(n) < 0.5,
+        'strength_own_team': np.repeat(rng.integers(2, 6, n_players), n_total),
+        'strength_opponent_team': rng.integers(2, 6, n),
+        'position': np.repeat(rng.choice(['GKP', 'DEF', 'MID', 'FWD'], n_players,
+                                         p=list(POSITION_SHARES.values())), n_total)})
+    df['ict_index'] = np.round((df['influence'] + df['creativity'] + df['threat']) / 10, 1)
+    future = df['round'] > n_played
+    df['finished'] = ~future
+    df.loc[future, ['minutes', 'total_points', 'influence', 'creativity', 'threat', 'bps',
+                    'ict_index']] = np.nan
+    return df
@@ -1,6 +1,5 @@
 import pandas as pd
 import numpy as np
-import matplotlib.pyplot as plt
 
 """Util functions for the various fpl scripts"""
 
@@ -14,13 +13,124 @@ def EMA(df, column, span, min_periods, threshold_minutes):
     span, min_periods:
     threshold_minutes: minumum number of minutes played to be included in the average
     """
-    df['EMA_column']=(df[df.minutes>threshold_minutes].groupby('element')[column]
-                 .apply(lambda x: x.ewm(span=span,min_periods=min_periods,ignore_na=True)
-                 .mean()))
-    df['EMA_column']=df.groupby('element').ffill()['EMA_column'] #Replace nan which were due to minutes>threshold_minutes
-    df['EMA_column']=df.groupby('element').shift(1)['EMA_column'] #Then shift within the groups
-    
-    return df['EMA_column']
+    return EMA_features(df, [column], span, min_periods, threshold_minutes)['EMA_' + column]
+
+
+def EMA_features(df, columns, span, min_periods, threshold_minutes, state=None, return_state=False):
+    """Returns a dataframe with the column 'EMA_'+c for each c in columns, identical to
+    EMA(df, c, ...) but with all columns computed in one pass over the element-sorted arrays:
+    the EMA over rows with minutes>threshold_minutes, forward filled and shifted by one
+    within each element. Note that df must be sorted on element, round
+    Parameters
+    ----------
+    state: dataframe returned by a previous call with return_state=True. The EMAs then continue
+        from that call, so df only needs to hold the rows that came after it
+    return_state: also return the state after the last row of each element in df, with one row
+        per element and feature (weighted_avg, old_wt, nobs, last_value)
+    """
+    features = ['EMA_' + c for c in columns]
+    element = df['element'].to_numpy()
+    values = df[columns].to_numpy(dtype='float64')
+    included = (df['minutes'] > threshold_minutes).to_numpy()
+    starts = _group_starts(element)
+    group = np.cumsum(starts) - 1
+    elements = element[starts]
+    init = _initial_state(elements, features, state)
+    ema, final = _ewm_mean(group, values, included, span, min_periods, init)
+    ema = _group_ffill(group, ema, init['last_value'])
+    result = pd.DataFrame(_group_shift(group, ema, init['last_value']), index=df.index,
+                          columns=features)
+    if not return_state:
+        return result
+    final['last_value'] = ema[np.r_[np.flatnonzero(starts)[1:] - 1, len(element) - 1]] \
+        if len(element) else ema
+    state = pd.DataFrame({'element': np.repeat(elements, len(features)),
+                          'feature': np.tile(features, len(elements))})
+    for k, v in final.items():
+        state[k] = v.ravel()
+    return result, state
+
+
+def _group_starts(element):
+    """True where a new element starts in an element-sorted array"""
+    return np.r_[True, element[1:] != element[:-1]] if len(element) else np.zeros(0, dtype=bool)
+
+
+def _initial_state(elements, features, state):
+    """State arrays (element x feature) to start the EMAs from, empty unless given in state"""
+    shape = (len(elements), len(features))
+    init = {'weighted_avg': np.full(shape, np.nan), 'old_wt': np.ones(shape),
+            'nobs': np.zeros(shape, dtype=np.int64), 'last_value': np.full(shape, np.nan)}
+    if state is not None and len(state) > 0:
+        rows = pd.Index(elements).get_indexer(state['element'])
+        cols = pd.Index(features).get_indexer(state['feature'])
+        known = (rows >= 0) & (cols >= 0)
+        for k in init:
+            init[k][rows[known], cols[known]] = state[k].to_numpy()[known]
+    return init
+
+
+def _ewm_mean(group, values, included, span, min_periods, init):
+    """ewm(span, min_periods, ignore_na=True).mean() of each column within each group, over
+    the included rows only (NaN elsewhere), starting from the state in init. Uses the same
+    recurrence and floating point operations as pandas, but steps through the k-th included
+    row of all groups at once, so the Python loop runs over the longest history rather than
+    over groups. Returns the means and the final state of the recurrence.
+    """
+    weighted_avg = init['weighted_avg'].copy()
+    old_wt = init['old_wt'].copy()
+    nobs = init['nobs'].copy()
+    final = {'weighted_avg': weighted_avg, 'old_wt': old_wt, 'nobs': nobs}
+    out = np.full(values.shape, np.nan)
+    rows = np.flatnonzero(included)
+    if len(rows) == 0:
+        return out, final
+    starts = _group_starts(group[rows])
+    step = np.arange(len(rows)) - np.flatnonzero(starts)[np.cumsum(starts) - 1]
+    order = np.argsort(step, kind='stable')
+    bounds = np.searchsorted(step[order], np.arange(step.max() + 2))
+
+    com = (span - 1) / 2.0
+    alpha = 1. / (1. + com)
+    old_wt_factor = 1. - alpha
+    new_wt = 1.  # adjust=True
+    minp = max(min_periods, 1)
+
+    for k in range(len(bounds) - 1):
+        r = rows[order[bounds[k]:bounds[k + 1]]]
+        g = group[r]
+        cur = values[r]
+        is_observation = ~np.isnan(cur)
+        avg, wt, n = weighted_avg[g], old_wt[g], nobs[g] + is_observation
+        # With an empty state this is also pandas' first step: the average starts at cur
+        has_avg = ~np.isnan(avg)
+        update = has_avg & is_observation
+        wt = np.where(update, wt * old_wt_factor, wt)
+        new_avg = ((wt * avg) + (new_wt * cur)) / (wt + new_wt)
+        avg = np.where(update & (avg != cur), new_avg, avg)
+        wt = np.where(update, wt + new_wt, wt)
+        avg = np.where(~has_avg & is_observation, cur, avg)
+        weighted_avg[g], old_wt[g], nobs[g] = avg, wt, n
+        out[r] = np.where(n >= minp, avg, np.nan)
+    return out, final
+
+
+def _group_ffill(group, values, init):
+    """Forward fill NaN in each column within each group, from init before the first value"""
+    position = np.arange(len(group))
+    group_start = np.flatnonzero(_group_starts(group))[group]
+    last_valid = np.maximum.accumulate(np.where(np.isnan(values), -1, position[:, None]), axis=0)
+    filled = np.take_along_axis(values, np.maximum(last_valid, 0), axis=0)
+    return np.where(last_valid >= group_start[:, None], filled, init[group])
+
+
+def _group_shift(group, values, init):
+    """Shift each column by one row within each group, with init in the first row"""
+    shifted = np.full(values.shape, np.nan)
+    shifted[1:] = values[:-1]
+    starts = _group_starts(group)
+    shifted[starts] = init[group[starts]]
+    return shifted
 
 
 def preprocess_data(df, bootstrap_static):
@@ -64,6 +174,7 @@ def categorise_cost(row):
 
 def plot_y_predicted_vs_y_true(y_predicted,y_true,model_title):
     """Scatter plot of y_predicted vs y_true"""
+    import matplotlib.pyplot as plt  # Only imported when plotting, it takes longer than pandas
     ymin=np.ceil(min(min(y_true), min(y_predicted)))
     ymax=np.ceil(max(max(y_true), max(y_predicted)))
     plt.plot([0, 25], [0, 25], color='r', linestyle='-', linewidth=2)
@@ -1,41 +1,262 @@
 import os
 import sys
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import io
 import json
+import time
+import hashlib
 import configparser
+from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor
+import fpl_metrics
+import fpl_staging
 
 """Import data from the FPL API to the staging area"""
 
-config = configparser.ConfigParser()
-config.read('../config/fpl-bot.ini')
+FPL_API = 'https://fantasy.premierleague.com/api'
+MANIFEST = 'manifest.json'  # Validators and content hashes of the staged files and element-summaries
+# Fields in bootstrap_static['elements'] that change when a player's element-summary changes
+CHANGE_FIELDS = ['event_points', 'minutes', 'transfers_in_event', 'now_cost']
+FIXTURE_FIELDS = ['event', 'kickoff_time', 'team_h', 'team_a', 'finished']
 
-stage_dir = config.get('FILES', 'STAGE_DIR')
+def make_session(max_workers=8, retries=3, backoff_factor=0.5):
+    """Return a session whose single keep-alive connection pool is shared by all worker threads.
+    Failed requests (connection errors, 429 and 5xx) are retried with exponential backoff.
+    """
+    session = requests.Session()
+    retry = Retry(total=retries, backoff_factor=backoff_factor,
+                  status_forcelist=[429, 500, 502, 503, 504])
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max_workers, max_retries=retry)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
 
-def get_static_data(stage_dir):
-    r=requests.get('https://fantasy.premierleague.com/api/bootstrap-static/').json()
-    with io.open(os.path.join(stage_dir,'bootstrap_static.json'), 'w') as outfile:
-        json.dump(r, outfile)
+def read_manifest(stage_dir):
+    """The manifest holds the validators and content hash of each staged file ('files') and
+    element-summary ('summaries', by element id), and hashes of the bootstrap elements and
+    fixtures from the last run ('elements', 'fixtures')
+    """
+    manifest = {'files': {}, 'summaries': {}, 'elements': {}, 'fixtures': {}}
+    try:
+        with io.open(os.path.join(stage_dir, MANIFEST), encoding='utf-8') as f:
+            manifest.update(json.loads(f.read()))
+    except FileNotFoundError:
+        pass
+    return manifest
 
-def get_fixtures(stage_dir):
-    r=requests.get('https://fantasy.premierleague.com/api/fixtures/').json()
-    with io.open(os.path.join(stage_dir,'fixtures.json'), 'w') as outfile:
-        json.dump(r, outfile)
+def write_manifest(stage_dir, manifest):
+    path = os.path.join(stage_dir, MANIFEST)
+    with io.open(path + '.tmp', 'w', encoding='utf-8') as outfile:
+        json.dump(manifest, outfile)
+    os.replace(path + '.tmp', path)
 
-def get_individual_player_data(player_id, stage_dir):
-    r = requests.get(f'https://fantasy.premierleague.com/api/element-summary/{player_id}/').json()
-    with io.open(os.path.join(stage_dir,'player_id_{}.json'.format(player_id)), 'w') as outfile:
-        json.dump(r, outfile)
+def content_hash(data):
+    return hashlib.sha1(data).hexdigest()
+
+def file_hash(path):
+    try:
+        with io.open(path, 'rb') as f:
+            return content_hash(f.read())
+    except FileNotFoundError:
+        return None
+
+def request(session, url, cached=None, staged_hash=None, timeout=30):
+    """GET url. If the staged copy still matches the hash from its last download (staged_hash),
+    the stored validators are sent as If-None-Match/If-Modified-Since.
+    Returns a dict with the status code, elapsed time, size, whether the content differs from the
+    staged copy, the manifest entry to store and the content (None for a 304 response).
+    """
+    headers = {}
+    if cached and staged_hash == cached.get('sha1'):
+        if cached.get('etag'):
+            headers['If-None-Match'] = cached['etag']
+        if cached.get('last_modified'):
+            headers['If-Modified-Since'] = cached['last_modified']
+    start = time.perf_counter()
+    r = session.get(url, headers=headers, timeout=timeout)
+    if r.status_code == 304:
+        return {'status': 304, 'elapsed': time.perf_counter() - start, 'changed': False,
+                'bytes': 0, 'entry': cached, 'content': None}
+    r.raise_for_status()
+    sha1 = content_hash(r.content)
+    entry = {'etag': r.headers.get('ETag'), 'last_modified': r.headers.get('Last-Modified'),
+             'sha1': sha1}
+    return {'status': r.status_code, 'elapsed': time.perf_counter() - start,
+            'changed': staged_hash != sha1, 'bytes': len(r.content), 'entry': entry,
+            'content': r.content}
+
+def fetch(session, url, path, cached=None, timeout=30):
+    """Download url to path (see request). A 304 response, or a 200 response with the same
+    content hash as before, leaves the file untouched.
+    """
+    result = request(session, url, cached, file_hash(path), timeout)
+    content = result.pop('content')
+    if result['changed']:
+        with io.open(path, 'wb') as outfile:
+            outfile.write(content)
+    return result
+
+def fetch_all(session, jobs, stage_dir, max_workers=8):
+    """Fetch (url, filename) jobs concurrently into stage_dir, at most max_workers at a time.
+    Returns a list with the timing of each request.
+    """
+    manifest = read_manifest(stage_dir)
+
+    def run(job):
+        url, filename = job
+        result = fetch(session, url, os.path.join(stage_dir, filename),
+                       manifest['files'].get(filename))
+        result['url'] = url
+        result['filename'] = filename
+        return result
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        results = list(executor.map(run, jobs))
+    for result in results:
+        manifest['files'][result['filename']] = result['entry']
+    write_manifest(stage_dir, manifest)
+    count_requests(results)
+    return results
+
+def count_requests(results):
+    fpl_metrics.count('http_requests', len(results))
+    fpl_metrics.count('http_not_modified', sum(1 for r in results if r['status'] == 304))
+    fpl_metrics.count('http_bytes', sum(r['bytes'] for r in results))
+    fpl_metrics.count('files_changed', sum(1 for r in results if r['changed']))
+
+def element_hashes(bootstrap_static):
+    """Hash of the per-player fields in bootstrap_static that move when a player's history does"""
+    return {str(e['id']): content_hash(json.dumps([e.get(f) for f in CHANGE_FIELDS]).encode())
+            for e in bootstrap_static['elements']}
+
+def fixture_hashes(fixtures):
+    return {str(f['id']): content_hash(json.dumps([f.get(c) for c in FIXTURE_FIELDS]).encode())
+            for f in fixtures}
+
+def changed_players(manifest, bootstrap_static, fixtures, stage_dir):
+    """Return the ids of players whose element-summary should be downloaded again: players whose
+    CHANGE_FIELDS moved since the last run, players of teams with a new or rescheduled fixture,
+    and players whose staged element-summary or manifest entry is missing (e.g. a stage directory of
+    an earlier version) or whose staged element-summary does not match the hash in the manifest.
+    """
+    old_elements = manifest.get('elements', {})
+    new_elements = element_hashes(bootstrap_static)
+    old_fixtures = manifest.get('fixtures', {})
+    changed_teams = set()
+    for f in fixtures:
+        if old_fixtures.get(str(f['id'])) != fixture_hashes([f])[str(f['id'])]:
+            changed_teams.update([f['team_h'], f['team_a']])
+    staged = fpl_staging.summary_index(stage_dir)
+    player_ids = []
+    for e in bootstrap_static['elements']:
+        cached = manifest['summaries'].get(str(e['id']))
+        if (old_elements.get(str(e['id'])) != new_elements[str(e['id'])]
+                or e['team'] in changed_teams
+                or cached is None or e['id'] not in staged
+                or staged[e['id']] != cached.get('sha1')):
+            player_ids.append(e['id'])
+    return player_ids
+
+def print_timings(results):
+    n_skipped = sum(1 for r in results if r['status'] == 304)
+    n_changed = sum(1 for r in results if r['changed'])
+    elapsed = sorted(r['elapsed'] for r in results)
+    if not elapsed:
+        return
+    print("Fetched {} files ({} changed), skipped {} unchanged (304)".format(
+        len(results) - n_skipped, n_changed, n_skipped))
+    print("Request time: mean {:.3f}s, median {:.3f}s, max {:.3f}s".format(
+        sum(elapsed) / len(elapsed), elapsed[len(elapsed) // 2], elapsed[-1]))
+
+def get_static_data(session, stage_dir, base_url=FPL_API):
+    return fetch_all(session, [(f'{base_url}/bootstrap-static/', 'bootstrap_static.json')], stage_dir)
+
+def get_fixtures(session, stage_dir, base_url=FPL_API):
+    return fetch_all(session, [(f'{base_url}/fixtures/', 'fixtures.json')], stage_dir)
+
+def get_player_data(session, player_ids, stage_dir, base_url=FPL_API, max_workers=8):
+    """Fetch the element-summaries concurrently into the staged element-summaries (see fpl_staging).
+    Each response is written to the new file as it comes in, in the order of player_ids, and the
+    players that were not fetched or did not change (304) keep their staged line.
+    Returns a list with the timing of each request.
+    """
+    manifest = read_manifest(stage_dir)
+    staged = fpl_staging.summary_index(stage_dir)
+    results = []
+
+    def run(player_id):
+        result = request(session, f'{base_url}/element-summary/{player_id}/',
+                         manifest['summaries'].get(str(player_id)), staged.get(player_id))
+        result['element'] = player_id
+        return result
+
+    def fetched(executor):
+        for result in executor.map(run, player_ids):
+            content = result.pop('content')
+            results.append(result)
+            if content is not None:
+                yield result['element'], result['entry']['sha1'], content
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        n_staged = fpl_staging.write_summaries(stage_dir, fetched(executor))
+    for result in results:
+        manifest['summaries'][str(result['element'])] = result['entry']
+    write_manifest(stage_dir, manifest)
+    count_requests(results)
+    fpl_metrics.count('summaries_staged', n_staged)
+    return results
+
+def run_import(stage_dir, workers=8, base_url=FPL_API, incremental=False):
+    """Download bootstrap-static, fixtures and the element-summaries to stage_dir.
+    Returns the result of each request (see fetch)
+    """
+    start = time.perf_counter()
+    session = make_session(max_workers=workers)
+    with fpl_metrics.stage('static'):
+        results = get_static_data(session, stage_dir, base_url)
+        results += get_fixtures(session, stage_dir, base_url)
+        with io.open(os.path.join(stage_dir,'bootstrap_static.json'), encoding='utf-8') as f:
+            bootstrap_static = json.loads(f.read())
+        with io.open(os.path.join(stage_dir,'fixtures.json'), encoding='utf-8') as f:
+            fixtures = json.loads(f.read())
+    manifest = read_manifest(stage_dir)
+    if incremental:
+        player_ids = changed_players(manifest, bootstrap_static, fixtures, stage_dir)
+        print("Incremental: {} of {} players changed".format(len(player_ids),
+                                                            len(bootstrap_static['elements'])))
+    else:
+        player_ids = [e['id'] for e in bootstrap_static['elements']]
+    with fpl_metrics.stage('players'):
+        results += get_player_data(session, player_ids, stage_dir, base_url, max_workers=workers)
+    # Only remember the snapshot once all element-summaries are staged
+    manifest = read_manifest(stage_dir)
+    manifest['elements'] = element_hashes(bootstrap_static)
+    manifest['fixtures'] = fixture_hashes(fixtures)
+    write_manifest(stage_dir, manifest)
+    print_timings(results)
+    print("Total time: {:.1f}s".format(time.perf_counter() - start))
+    return results
 
 def main():
-    get_static_data(stage_dir)
-    get_fixtures(stage_dir)
-    with io.open(os.path.join(stage_dir,'bootstrap_static.json'), encoding='utf-8') as f:
-        bootstrap_static = json.loads(f.read())
-    n_players = len(bootstrap_static['elements'])
-    for player_id in range(1, n_players):
-        get_individual_player_data(player_id, stage_dir)
+    parser = ArgumentParser()
+    parser.add_argument("-w", "--workers", type=int, dest="workers", default=8,
+                        help="Number of concurrent requests")
+    parser.add_argument("--base_url", dest="base_url", default=FPL_API,
+                        help="API base url, e.g. a local stub server")
+    parser.add_argument("--incremental", action="store_true", dest="incremental",
+                        help="Only download element-summaries for players that changed since the last run")
+    fpl_metrics.add_arguments(parser)
+    args = parser.parse_args()
+
+    config = configparser.ConfigParser()
+    config.read('../config/fpl-bot.ini')
+    fpl_metrics.start_run_from_args('import_data', args)
+    with fpl_metrics.stage('import'):
+        run_import(config.get('FILES', 'STAGE_DIR'), workers=args.workers, base_url=args.base_url,
+                   incremental=args.incremental)
+    fpl_metrics.finish_run(args.report_dir)
 
 if __name__ == '__main__':
     sys.exit(main())
-
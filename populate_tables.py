@@ -1,114 +1,197 @@
 import os
+import sys
 import psycopg2
-from psycopg2.extras import execute_values
 import configparser
+from argparse import ArgumentParser
+import csv
 import io
 import json
 import re
+import fpl_metrics
+import fpl_staging
 
 """
-Populate database tables from files in the staging area with truncate and fill strategy
+Populate database tables from files in the staging area with truncate and fill strategy,
+or with --incremental, upsert only the rows of the main table whose staged values changed
 """
 
-config = configparser.ConfigParser()
-config.read('../config/fpl-bot.ini')
-stage_dir = config.get('FILES', 'STAGE_DIR')
-stg_schema = config.get('DATABASE', 'STAGE_SCHEMA')
-main_schema = config.get('DATABASE', 'MAIN_SCHEMA')
-backup_schema = config.get('DATABASE', 'BACKUP_SCHEMA')
-
-conn = psycopg2.connect(
-    host=config.get('DATABASE', 'HOST'),
-    database=config.get('DATABASE', 'DB'),
-    user=config.get('DATABASE', 'USER'),
-    password=config.get('DATABASE', 'PASSWORD'))
-
-cur = conn.cursor()
-
-with io.open(os.path.join(stage_dir,'bootstrap_static.json'), encoding='utf-8') as data_file:
-    bootstrap_static = json.loads(data_file.read())
-
-with io.open(os.path.join(stage_dir,'fixtures.json'), encoding='utf-8') as data_file:
-    fixtures = json.loads(data_file.read())
-
-# Truncate tables
-for table in ['stg_element_types', 'stg_fixtures', 'stg_player_static', 'stg_player_history',
-                'stg_teams']:
-    cur.execute(f"TRUNCATE TABLE {stg_schema}.{table}")
-    
-
-# stg_teams
-teams = bootstrap_static['teams']
-columns = teams[0].keys()
-values =  [list(x.values()) for x in teams]
-query = "INSERT INTO {}.stg_teams ({}) VALUES %s".format(stg_schema, ','.join(columns))
-#print(query)
-execute_values(cur, query, values)
-
-# stg_player_static
-player_static = bootstrap_static['elements']
-columns = player_static[0].keys()
-values = [list(x.values()) for x in player_static]
-query = "INSERT INTO {}.stg_player_static ({}) VALUES %s".format(stg_schema, ','.join(columns))
-execute_values(cur, query, values)
-
-# stg_element_types
-element_types = bootstrap_static['element_types']
-columns = element_types[0].keys()
-values =  [list(x.values()) for x in element_types]
-query = "INSERT INTO {}.stg_element_types ({}) VALUES %s".format(stg_schema, ','.join(columns))
-execute_values(cur, query, values)
-
-# stg_fixtures (don't include stats for now)
-columns = list(fixtures[0].keys())
-columns.remove('stats')
-values =  [list({i:x[i] for i in x if i!='stats'}.values()) for x in fixtures]
-query = "INSERT INTO {}.stg_fixtures ({}) VALUES %s".format(stg_schema, ','.join(columns))
-execute_values(cur, query, values)
-
-# stg_player_history
-for player_file in os.listdir(stage_dir):
-    m = re.search(r'player_id_[0-9]+.json', player_file)
-    if m:
-        with io.open(os.path.join(stage_dir,player_file), encoding='utf-8') as f:
-            player = json.loads(f.read())
+DDL_FILE = 'sql/DDL_create_tables.sql'
+STAGE_TABLES = ['stg_element_types', 'stg_fixtures', 'stg_player_static', 'stg_player_history',
+                'stg_teams']
+
+def ddl_columns(table, ddl_file=DDL_FILE):
+    """Return the column names of table (e.g. 'stg_player_history') in the order of the DDL"""
+    with io.open(ddl_file, encoding='utf-8') as f:
+        ddl = f.read()
+    m = re.search(r'CREATE TABLE \w+\.{}\s*\((.*?)\n\);'.format(table), ddl, re.DOTALL)
+    if m is None:
+        raise ValueError(f'Table {table} not found in {ddl_file}')
+    columns = []
+    for line in m.group(1).split('\n'):
+        line = line.strip()
+        if line and not line.startswith(('PRIMARY KEY', '--')):
+            columns.append(line.split()[0])
+    return columns
+
+class CsvStream:
+    """A file to COPY from that formats the rows (dicts) as CSV while COPY reads it, so that only
+    one read of CSV is held in memory. Keys missing from a row are NULL, other keys are ignored.
+    """
+    def __init__(self, rows, columns):
+        self.rows = iter(rows)
+        self.columns = columns
+        self.buf = io.StringIO()
+        self.writer = csv.writer(self.buf)
+        self.n_rows = 0
+        self.n_bytes = 0
+
+    def read(self, size=-1):
+        for row in self.rows:
+            self.writer.writerow([r'\N' if row.get(c) is None else row[c] for c in self.columns])
+            self.n_rows += 1
+            if 0 <= size <= self.buf.tell():
+                break
+        data = self.buf.getvalue()
+        if 0 <= size < len(data):
+            data, rest = data[:size], data[size:]
+        else:
+            rest = ''
+        self.buf.seek(0)
+        self.buf.truncate()
+        self.buf.write(rest)
+        self.n_bytes += len(data)
+        return data
+
+def copy_rows(cur, table, columns, rows, size=1 << 16):
+    """Send rows (an iterable of dicts) with COPY, streamed in reads of about size characters.
+    Keys missing from a row are loaded as NULL, keys not in columns are ignored.
+    """
+    # Includes reading the staged element-summaries for stg_player_history
+    with fpl_metrics.stage('copy ' + table.split('.')[-1]):
+        stream = CsvStream(rows, columns)
+        cur.copy_expert("COPY {} ({}) FROM STDIN WITH (FORMAT csv, NULL '\\N')".format(
+            table, ','.join(columns)), stream, size)
+        fpl_metrics.count('copy_rows', stream.n_rows)
+        fpl_metrics.count('copy_bytes', stream.n_bytes)
+
+def player_history_rows(stage_dir):
+    """Yield the history and the future fixtures of every staged player, one player at a time"""
+    for _, player in fpl_staging.read_summaries(stage_dir):
         history = player['history']
-        try:
-            columns = history[0].keys()
-        except IndexError:  # No history for this player
+        if len(history) == 0:  # No history for this player
             continue
-        values =  [list(x.values()) for x in history]
-        query = "INSERT INTO {}.stg_player_history ({}) VALUES %s".format(stg_schema, ','.join(columns))
-        execute_values(cur, query, values)
+        yield from history
         # Add future fixtures
-        fixtures = player['fixtures']
-        if len(fixtures) > 0:
-            included_fixtures = [d['fixture'] for d in history]
-            future_fixtures = []
-            for f in fixtures:
-                if f['id'] not in included_fixtures:  # Some fixtures might overlap
-                    future_fixtures.append({
-                              'element': history[0]['element'],
-                              'fixture': f['id'],
-                              'round': f['event'],
-                              'opponent_team': f['team_a'] if f['is_home'] else f['team_h'],
-                              'kickoff_time': f['kickoff_time'],
-                              'was_home': f['is_home']})
-            columns = future_fixtures[0].keys()
-            values = [list(x.values()) for x in future_fixtures]
-            query = "INSERT INTO {}.stg_player_history ({}) VALUES %s".format(stg_schema, ','.join(columns))
-            execute_values(cur, query, values)
-
-# Populate tables in the main schema
-# First take a backup of existing table (just in case stage data is erroneous), then truncate, then fill
-cur.execute(f"truncate table {backup_schema}.player_history")
-cur.execute(f"insert into {backup_schema}.player_history select * from {main_schema}.player_history")
-cur.execute(f"truncate table {main_schema}.player_history")
-with io.open('sql/DML_player_history.sql', encoding='utf-8') as f:
-    sql_query = f.read().replace('\n', ' ')
-    sql_query = sql_query.replace('{stg_schema}', stg_schema)
-    sql_query = sql_query.replace('{main_schema}', main_schema)
-cur.execute(sql_query)
-
-conn.commit()
-conn.close()
+        included_fixtures = {d['fixture'] for d in history}  # Some fixtures might overlap
+        for f in player['fixtures']:
+            if f['id'] not in included_fixtures:
+                yield {'element': history[0]['element'],
+                       'fixture': f['id'],
+                       'round': f['event'],
+                       'opponent_team': f['team_a'] if f['is_home'] else f['team_h'],
+                       'kickoff_time': f['kickoff_time'],
+                       'was_home': f['is_home']}
+
+def load_stage(cur, stage_dir, stg_schema):
+    """Truncate the staging tables and fill them from the files in stage_dir (see fpl_staging)"""
+    with io.open(os.path.join(stage_dir,'bootstrap_static.json'), encoding='utf-8') as data_file:
+        bootstrap_static = json.loads(data_file.read())
+    with io.open(os.path.join(stage_dir,'fixtures.json'), encoding='utf-8') as data_file:
+        fixtures = json.loads(data_file.read())
+
+    for table in STAGE_TABLES:
+        cur.execute(f"TRUNCATE TABLE {stg_schema}.{table}")
+
+    copy_rows(cur, f'{stg_schema}.stg_teams', ddl_columns('stg_teams'), bootstrap_static['teams'])
+    copy_rows(cur, f'{stg_schema}.stg_player_static', ddl_columns('stg_player_static'),
+              bootstrap_static['elements'])
+    copy_rows(cur, f'{stg_schema}.stg_element_types', ddl_columns('stg_element_types'),
+              bootstrap_static['element_types'])
+    # stg_fixtures (stats is not in the table for now)
+    copy_rows(cur, f'{stg_schema}.stg_fixtures', ddl_columns('stg_fixtures'), fixtures)
+    copy_rows(cur, f'{stg_schema}.stg_player_history', ddl_columns('stg_player_history'),
+              player_history_rows(stage_dir))
+
+def read_sql(sql_file, **placeholders):
+    """Read a query from sql/ and fill in the {placeholders}"""
+    with io.open(sql_file, encoding='utf-8') as f:
+        sql_query = f.read().replace('\n', ' ')
+    for placeholder, value in placeholders.items():
+        sql_query = sql_query.replace('{' + placeholder + '}', value)
+    return sql_query
+
+def populate_main(cur, stg_schema, main_schema, backup_schema):
+    """Populate tables in the main schema.
+    First take a backup of existing table (just in case stage data is erroneous), then truncate, then fill
+    """
+    cur.execute(f"truncate table {backup_schema}.player_history")
+    cur.execute(f"insert into {backup_schema}.player_history select * from {main_schema}.player_history")
+    cur.execute(f"truncate table {main_schema}.player_history")
+    cur.execute(read_sql('sql/DML_player_history.sql', stg_schema=stg_schema, main_schema=main_schema))
+
+def populate_main_incremental(cur, stg_schema, main_schema, backup_schema):
+    """Upsert the staged rows that differ from the main table (ignoring time_inserted), and delete
+    the rows of the staged players that are no longer staged (e.g. the fixtures of a former club),
+    so that the main table ends up as after a full refresh.
+    The previous version of each updated or deleted row, and each inserted row, is kept in
+    {backup_schema}.player_history_changes under the run_id of this refresh.
+    Returns (run_id, number of inserted rows, number of updated rows, number of deleted rows)
+    """
+    cur.execute(f"insert into {backup_schema}.refresh_run default values returning run_id")
+    run_id = cur.fetchone()[0]
+    cur.execute(read_sql('sql/DML_player_history_upsert.sql', stg_schema=stg_schema,
+                         main_schema=main_schema, backup_schema=backup_schema, run_id=str(run_id)))
+    operations = [row[0] for row in cur.fetchall()]
+    n_inserted, n_updated, n_deleted = [operations.count(o) for o in ('insert', 'update', 'delete')]
+    cur.execute(f"update {backup_schema}.refresh_run set n_inserted = %s, n_updated = %s, n_deleted = %s "
+                "where run_id = %s", (n_inserted, n_updated, n_deleted, run_id))
+    return run_id, n_inserted, n_updated, n_deleted
+
+def run_populate(conn, stage_dir, stg_schema, main_schema, backup_schema, incremental=False):
+    """Load the staged files into the staging tables and fill (or upsert into) the main tables"""
+    with conn.cursor() as cur:
+        with fpl_metrics.stage('load_stage'):
+            load_stage(cur, stage_dir, stg_schema)
+        with fpl_metrics.stage('populate_main'):
+            if incremental:
+                run_id, n_inserted, n_updated, n_deleted = populate_main_incremental(cur, stg_schema, main_schema,
+                                                                                     backup_schema)
+                print("Refresh {}: {} rows inserted, {} rows updated, {} rows deleted".format(
+                    run_id, n_inserted, n_updated, n_deleted))
+                fpl_metrics.note(inserted=n_inserted, updated=n_updated, deleted=n_deleted)
+            else:
+                populate_main(cur, stg_schema, main_schema, backup_schema)
+        with fpl_metrics.stage('fixture_index'):
+            # Fixtures per team and round (blank and double gameweeks) for fpl_prediction and fpl_optimise
+            cur.execute(read_sql('sql/DML_fixture_index.sql', stg_schema=stg_schema, main_schema=main_schema))
+        with fpl_metrics.stage('analyze'):
+            # Indexes of the prediction query, and fresh statistics after the bulk load so that they are used
+            cur.execute(read_sql('sql/DDL_create_indexes.sql', main_schema=main_schema))
+            cur.execute(f"analyze {main_schema}.player_history")
+    conn.commit()
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument("--incremental", action="store_true", dest="incremental",
+                        help="Upsert changed rows instead of truncating and filling the main table")
+    fpl_metrics.add_arguments(parser)
+    args = parser.parse_args()
+
+    config = configparser.ConfigParser()
+    config.read('../config/fpl-bot.ini')
+
+    conn = psycopg2.connect(
+        host=config.get('DATABASE', 'HOST'),
+        database=config.get('DATABASE', 'DB'),
+        user=config.get('DATABASE', 'USER'),
+        password=config.get('DATABASE', 'PASSWORD'))
+    fpl_metrics.start_run_from_args('populate_tables', args)
+    with fpl_metrics.stage('populate'):
+        run_populate(conn, config.get('FILES', 'STAGE_DIR'), config.get('DATABASE', 'STAGE_SCHEMA'),
+                     config.get('DATABASE', 'MAIN_SCHEMA'), config.get('DATABASE', 'BACKUP_SCHEMA'),
+                     incremental=args.incremental)
+    conn.close()
+    fpl_metrics.finish_run(args.report_dir)
+
+if __name__ == '__main__':
+    sys.exit(main())
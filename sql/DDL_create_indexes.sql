@@ -0,0 +1,7 @@
+CREATE INDEX IF NOT EXISTS player_history_element_round_idx
+  ON {main_schema}.player_history ("element", round);
+DROP INDEX IF EXISTS {main_schema}.player_history_latest_value_idx;
+CREATE INDEX IF NOT EXISTS player_history_latest_idx
+  ON {main_schema}.player_history ("element", round DESC)
+  INCLUDE (value, team, "position", web_name, name_own_team)
+  WHERE value IS NOT NULL;
@@ -205,6 +205,7 @@ CREATE TABLE fpl_2021.player_history (
     time_inserted           timestamptz,
     PRIMARY KEY (element, fixture)
 );
+-- Indexes on (element, round) are in sql/DDL_create_indexes.sql, created by populate_tables.py
 
 -- Should be identical as fpl_2021.player_history
 CREATE TABLE backup.player_history (
@@ -297,10 +298,116 @@ CREATE TABLE backup.player_history (
     PRIMARY KEY (element, fixture)
 );
 
+-- One row per incremental refresh of fpl_2021.player_history
+CREATE TABLE backup.refresh_run (
+    run_id                  serial primary key,
+    started                 timestamptz default now(),
+    n_inserted              int,
+    n_updated               int,
+    n_deleted               int
+);
+
+-- Rows touched by an incremental refresh: the previous version of updated and deleted rows and the new inserted rows
+CREATE TABLE backup.player_history_changes (
+    run_id                  int references backup.refresh_run,
+    operation               varchar(6),
+    element                 int,
+    fixture                 int,
+    opponent_team           int,
+    total_points            int,
+    was_home                boolean,
+    kickoff_time            timestamptz,
+    team_h_score            int,
+    team_a_score            int,
+    round                   int,
+    minutes                 int,
+    goals_scored            int,
+    assists                 int,
+    clean_sheets            int,
+    goals_conceded          int,
+    own_goals               int,
+    penalties_saved         int,
+    penalties_missed        int,
+    yellow_cards            int,
+    red_cards               int,
+    saves                   int,
+    bonus                   int,
+    bps                     int,
+    influence               numeric,
+    creativity              numeric,
+    threat                  numeric,
+    ict_index               numeric,
+    value                   int,
+    transfers_balance       int,
+    selected                int,
+    transfers_in            int,
+    transfers_out           int,
+    web_name                varchar(255),
+    team                    int,
+    position                varchar(3),
+    name_own_team           varchar(3),
+    strength_own_team       int,
+    name_opponent_team      varchar(3),
+    strength_opponent_team  int,
+    finished                boolean NOT NULL,
+    time_inserted           timestamptz,
+    PRIMARY KEY (run_id, element, fixture)
+);
+
 CREATE TABLE fpl_2021.prediction (
     element                 int,
     round                   int,
     points                  numeric,
     points_cumulative       numeric,
+    points_std              numeric,
+    points_std_cumulative   numeric,
     PRIMARY KEY (element, round)
 );
+
+-- A row per rewrite of the prediction table by fpl_prediction.py, so that fpl_service.py knows when to reload it
+CREATE TABLE fpl_2021.prediction_run (
+    run_id                  serial primary key,
+    written                 timestamptz default now(),
+    n_rows                  int
+);
+
+-- Fixtures of each team in each round, built from stg_fixtures by populate_tables.py (sql/DML_fixture_index.sql):
+-- n_fixtures is 0 in a blank gameweek and 2 in a double gameweek
+CREATE TABLE fpl_2021.fixture_index (
+    team                    int,
+    round                   int,
+    n_fixtures              int,
+    opponents               int[],
+    opponent_strength       numeric,
+    difficulty              numeric,
+    PRIMARY KEY (team, round)
+);
+
+-- Feature store of fpl_prediction.py: EMA features of finished matches
+CREATE TABLE fpl_2021.player_features (
+    element                 int,
+    fixture                 int,
+    ema_influence           double precision,
+    ema_creativity          double precision,
+    ema_threat              double precision,
+    ema_ict_index           double precision,
+    ema_bps                 double precision,
+    ema_total_points        double precision,
+    PRIMARY KEY (element, fixture)
+);
+
+-- State of the EMA recurrence of each player and feature after its last stored match
+CREATE TABLE fpl_2021.feature_state (
+    element                 int,
+    feature                 varchar(30),
+    weighted_avg            double precision,
+    old_wt                  double precision,
+    nobs                    int,
+    last_value              double precision,
+    PRIMARY KEY (element, feature)
+);
+
+-- Last incremental refresh of player_history (backup.refresh_run) whose changes the feature store has taken into account
+CREATE TABLE fpl_2021.feature_refresh (
+    run_id                  int
+);
@@ -0,0 +1,104 @@
+-- Bring a database created with an earlier version of sql/DDL_create_tables.sql up to date
+-- (psql -f sql/DDL_upgrade.sql; every statement can be run again).
+-- The tables added since the first version, as in sql/DDL_create_tables.sql:
+
+CREATE TABLE IF NOT EXISTS backup.refresh_run (
+    run_id                  serial primary key,
+    started                 timestamptz default now(),
+    n_inserted              int,
+    n_updated               int,
+    n_deleted               int
+);
+
+CREATE TABLE IF NOT EXISTS backup.player_history_changes (
+    run_id                  int references backup.refresh_run,
+    operation               varchar(6),
+    element                 int,
+    fixture                 int,
+    opponent_team           int,
+    total_points            int,
+    was_home                boolean,
+    kickoff_time            timestamptz,
+    team_h_score            int,
+    team_a_score            int,
+    round                   int,
+    minutes                 int,
+    goals_scored            int,
+    assists                 int,
+    clean_sheets            int,
+    goals_conceded          int,
+    own_goals               int,
+    penalties_saved         int,
+    penalties_missed        int,
+    yellow_cards            int,
+    red_cards               int,
+    saves                   int,
+    bonus                   int,
+    bps                     int,
+    influence               numeric,
+    creativity              numeric,
+    threat                  numeric,
+    ict_index               numeric,
+    value                   int,
+    transfers_balance       int,
+    selected                int,
+    transfers_in            int,
+    transfers_out           int,
+    web_name                varchar(255),
+    team                    int,
+    position                varchar(3),
+    name_own_team           varchar(3),
+    strength_own_team       int,
+    name_opponent_team      varchar(3),
+    strength_opponent_team  int,
+    finished                boolean NOT NULL,
+    time_inserted           timestamptz,
+    PRIMARY KEY (run_id, element, fixture)
+);
+
+CREATE TABLE IF NOT EXISTS fpl_2021.prediction_run (
+    run_id                  serial primary key,
+    written                 timestamptz default now(),
+    n_rows                  int
+);
+
+CREATE TABLE IF NOT EXISTS fpl_2021.fixture_index (
+    team                    int,
+    round                   int,
+    n_fixtures              int,
+    opponents               int[],
+    opponent_strength       numeric,
+    difficulty              numeric,
+    PRIMARY KEY (team, round)
+);
+
+CREATE TABLE IF NOT EXISTS fpl_2021.player_features (
+    element                 int,
+    fixture                 int,
+    ema_influence           double precision,
+    ema_creativity          double precision,
+    ema_threat              double precision,
+    ema_ict_index           double precision,
+    ema_bps                 double precision,
+    ema_total_points        double precision,
+    PRIMARY KEY (element, fixture)
+);
+
+CREATE TABLE IF NOT EXISTS fpl_2021.feature_state (
+    element                 int,
+    feature                 varchar(30),
+    weighted_avg            double precision,
+    old_wt                  double precision,
+    nobs                    int,
+    last_value              double precision,
+    PRIMARY KEY (element, feature)
+);
+
+CREATE TABLE IF NOT EXISTS fpl_2021.feature_refresh (
+    run_id                  int
+);
+
+-- Columns added to existing tables
+ALTER TABLE backup.refresh_run ADD COLUMN IF NOT EXISTS n_deleted int;
+ALTER TABLE fpl_2021.prediction ADD COLUMN IF NOT EXISTS points_std numeric;
+ALTER TABLE fpl_2021.prediction ADD COLUMN IF NOT EXISTS points_std_cumulative numeric;
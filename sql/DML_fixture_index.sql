@@ -0,0 +1,20 @@
+TRUNCATE TABLE {main_schema}.fixture_index;
+WITH team_fixtures AS (
+  SELECT id, event, kickoff_time, team_h AS team, team_a AS opponent, team_h_difficulty AS difficulty
+  FROM {stg_schema}.stg_fixtures
+  UNION ALL
+  SELECT id, event, kickoff_time, team_a AS team, team_h AS opponent, team_a_difficulty AS difficulty
+  FROM {stg_schema}.stg_fixtures
+)
+INSERT INTO {main_schema}.fixture_index
+SELECT
+  t.id AS team, r.round,
+  count(tf.id) AS n_fixtures,
+  coalesce(array_agg(tf.opponent ORDER BY tf.kickoff_time, tf.id) FILTER (WHERE tf.id IS NOT NULL), '{}') AS opponents,
+  avg(opp.strength) AS opponent_strength,
+  avg(tf.difficulty) AS difficulty
+FROM {stg_schema}.stg_teams t
+  CROSS JOIN generate_series(1, (SELECT max(event) FROM {stg_schema}.stg_fixtures)) AS r(round)
+  LEFT JOIN team_fixtures tf ON tf.team = t.id AND tf.event = r.round
+  LEFT JOIN {stg_schema}.stg_teams opp ON opp.id = tf.opponent
+GROUP BY t.id, r.round
@@ -0,0 +1,99 @@
+WITH stage_data AS (
+  SELECT
+    sph.*,
+    sps.web_name, sps.team,
+    et.singular_name_short AS position,
+    own_team.short_name AS name_own_team, own_team.strength AS strength_own_team,
+    opp_team.short_name AS name_opponent_team, opp_team.strength AS strength_opponent_team,
+    sf.finished,
+    now() AS time_inserted
+  FROM {stg_schema}.stg_player_history sph
+    JOIN {stg_schema}.stg_player_static sps ON sph."element" = sps.id
+    JOIN {stg_schema}.stg_teams own_team ON sps.team = own_team.id
+    JOIN {stg_schema}.stg_teams opp_team ON sph.opponent_team = opp_team.id
+    JOIN {stg_schema}.stg_element_types et ON et.id = sps.element_type
+    JOIN {stg_schema}.stg_fixtures sf ON sph.fixture = sf.id
+),
+changed AS (
+  SELECT s.*, m."element" IS NULL AS is_new
+  FROM stage_data s
+    LEFT JOIN {main_schema}.player_history m ON m."element" = s."element" AND m.fixture = s.fixture
+  WHERE m."element" IS NULL
+    OR to_jsonb(s) - 'time_inserted' IS DISTINCT FROM to_jsonb(m) - 'time_inserted'
+),
+deleted AS (
+  DELETE FROM {main_schema}.player_history m
+  WHERE m."element" IN (SELECT DISTINCT "element" FROM {stg_schema}.stg_player_history)
+    AND NOT EXISTS (SELECT 1 FROM stage_data s WHERE s."element" = m."element" AND s.fixture = m.fixture)
+  RETURNING m.*
+),
+audit AS (
+  INSERT INTO {backup_schema}.player_history_changes
+  SELECT {run_id}, 'delete', d.* FROM deleted d
+  UNION ALL
+  SELECT {run_id}, 'update', m.*
+  FROM {main_schema}.player_history m
+    JOIN changed c ON m."element" = c."element" AND m.fixture = c.fixture
+  WHERE NOT c.is_new
+  UNION ALL
+  SELECT {run_id}, 'insert', element, fixture, opponent_team, total_points, was_home, kickoff_time, team_h_score,
+    team_a_score, round, minutes, goals_scored, assists, clean_sheets, goals_conceded,
+    own_goals, penalties_saved, penalties_missed, yellow_cards, red_cards, saves, bonus, bps,
+    influence, creativity, threat, ict_index, value, transfers_balance, selected,
+    transfers_in, transfers_out, web_name, team, position, name_own_team, strength_own_team,
+    name_opponent_team, strength_opponent_team, finished, time_inserted
+  FROM changed WHERE is_new
+),
+upserted AS (
+INSERT INTO {main_schema}.player_history
+SELECT element, fixture, opponent_team, total_points, was_home, kickoff_time, team_h_score,
+    team_a_score, round, minutes, goals_scored, assists, clean_sheets, goals_conceded,
+    own_goals, penalties_saved, penalties_missed, yellow_cards, red_cards, saves, bonus, bps,
+    influence, creativity, threat, ict_index, value, transfers_balance, selected,
+    transfers_in, transfers_out, web_name, team, position, name_own_team, strength_own_team,
+    name_opponent_team, strength_opponent_team, finished, time_inserted
+FROM changed
+ON CONFLICT ("element", fixture) DO UPDATE SET
+  opponent_team = EXCLUDED.opponent_team,
+  total_points = EXCLUDED.total_points,
+  was_home = EXCLUDED.was_home,
+  kickoff_time = EXCLUDED.kickoff_time,
+  team_h_score = EXCLUDED.team_h_score,
+  team_a_score = EXCLUDED.team_a_score,
+  round = EXCLUDED.round,
+  minutes = EXCLUDED.minutes,
+  goals_scored = EXCLUDED.goals_scored,
+  assists = EXCLUDED.assists,
+  clean_sheets = EXCLUDED.clean_sheets,
+  goals_conceded = EXCLUDED.goals_conceded,
+  own_goals = EXCLUDED.own_goals,
+  penalties_saved = EXCLUDED.penalties_saved,
+  penalties_missed = EXCLUDED.penalties_missed,
+  yellow_cards = EXCLUDED.yellow_cards,
+  red_cards = EXCLUDED.red_cards,
+  saves = EXCLUDED.saves,
+  bonus = EXCLUDED.bonus,
+  bps = EXCLUDED.bps,
+  influence = EXCLUDED.influence,
+  creativity = EXCLUDED.creativity,
+  threat = EXCLUDED.threat,
+  ict_index = EXCLUDED.ict_index,
+  value = EXCLUDED.value,
+  transfers_balance = EXCLUDED.transfers_balance,
+  selected = EXCLUDED.selected,
+  transfers_in = EXCLUDED.transfers_in,
+  transfers_out = EXCLUDED.transfers_out,
+  web_name = EXCLUDED.web_name,
+  team = EXCLUDED.team,
+  position = EXCLUDED.position,
+  name_own_team = EXCLUDED.name_own_team,
+  strength_own_team = EXCLUDED.strength_own_team,
+  name_opponent_team = EXCLUDED.name_opponent_team,
+  strength_opponent_team = EXCLUDED.strength_opponent_team,
+  finished = EXCLUDED.finished,
+  time_inserted = EXCLUDED.time_inserted
+RETURNING (xmax = 0) AS inserted
+)
+SELECT CASE WHEN inserted THEN 'insert' ELSE 'update' END FROM upserted
+UNION ALL
+SELECT 'delete' FROM deleted
@@ -0,0 +1,13 @@
+WITH latest AS (
+  SELECT e."element", l.value, l.team, l."position", l.web_name, l.name_own_team
+  FROM (SELECT DISTINCT "element" FROM {main_schema}.prediction) e
+    CROSS JOIN LATERAL (
+      SELECT value, team, "position", web_name, name_own_team FROM {main_schema}.player_history ph
+      WHERE ph."element" = e."element" AND ph.value IS NOT NULL
+      ORDER BY ph.round DESC
+      LIMIT 1) l
+)
+SELECT p.*, l."position", l.web_name, l.name_own_team, l.value/10.0 AS now_cost, fi.n_fixtures
+FROM {main_schema}.prediction p
+  JOIN latest l ON l."element" = p."element"
+  LEFT JOIN {main_schema}.fixture_index fi ON fi.team = l.team AND fi.round = p.round
@@ -0,0 +1,89 @@
+import unittest
+import numpy as np
+import fpl_optimise
+import fpl_solver
+
+"""
+Tests of the lineup selection: select_lineup and formation_scores against every lineup of the squad
+(fpl_optimise.lineup_matrix) and the MILP of select_lineup_milp on each available solver.
+    python -m unittest test_fpl_optimise
+"""
+
+SQUAD_POSITIONS = np.repeat(fpl_optimise.POSITIONS, [2, 5, 5, 3])
+
+def random_squads(n_squads, positions=SQUAD_POSITIONS, seed=0):
+    """Points of n_squads squads with the given positions, one row per squad"""
+    rng = np.random.default_rng(seed)
+    return np.round(rng.gamma(2.0, 3.0, size=(n_squads, len(positions))), 1)
+
+def enumerated_scores(points, positions):
+    """The highest points of each formation, from the points of every lineup in it"""
+    lineups, formation_index = fpl_optimise.lineup_matrix(positions)
+    scores = np.full(len(fpl_optimise.POSSIBLE_FORMATIONS), -np.inf)
+    np.maximum.at(scores, formation_index, lineups.astype('float64') @ points)
+    return scores
+
+def formation_of(selected, positions):
+    return '-'.join(str(int((positions[selected] == pos).sum())) for pos in fpl_optimise.POSITIONS)
+
+class TestSelectLineup(unittest.TestCase):
+    def check_lineup(self, points, positions):
+        """select_lineup and select_lineup_milp give a lineup of the best formation"""
+        scores = enumerated_scores(points, positions)
+        np.testing.assert_allclose(fpl_optimise.formation_scores(points, positions), scores)
+        selected, formation, score = fpl_optimise.select_lineup(points, positions)
+        self.assertAlmostEqual(score, scores.max())
+        self.assertAlmostEqual(points[selected].sum(), score)
+        self.assertEqual(formation_of(selected, positions), formation)
+        self.assertAlmostEqual(scores[fpl_optimise.POSSIBLE_FORMATIONS.index(formation)], score)
+        for backend in fpl_solver.available_backends():
+            selected, formation, score = fpl_optimise.select_lineup_milp(points, positions, backend=backend)
+            self.assertAlmostEqual(score, scores.max(), msg=backend)
+            self.assertAlmostEqual(points[selected].sum(), score, msg=backend)
+            self.assertEqual(formation_of(selected, positions), formation, msg=backend)
+            self.assertIn(formation, fpl_optimise.POSSIBLE_FORMATIONS, msg=backend)
+
+    def test_fixed_squad(self):
+        points = np.array([6, 2, 5, 4, 3, 1, 1, 9, 8, 7, 2, 1, 10, 3, 2], dtype='float64')
+        selected, formation, score = fpl_optimise.select_lineup(points, SQUAD_POSITIONS)
+        self.assertEqual((formation, score), ('1-3-4-3', 59))
+        self.assertEqual(list(np.flatnonzero(selected)), [0, 2, 3, 4, 7, 8, 9, 10, 12, 13, 14])
+        self.check_lineup(points, SQUAD_POSITIONS)
+
+    def test_equal_scores(self):
+        # Every formation scores the same: the last one is chosen, as the previous loop over formations
+        selected, formation, score = fpl_optimise.select_lineup(np.ones(15), SQUAD_POSITIONS)
+        self.assertEqual((formation, score), (fpl_optimise.POSSIBLE_FORMATIONS[-1], 11))
+        self.assertEqual(selected.sum(), 11)
+
+    def test_random_squads(self):
+        points = random_squads(20)
+        for squad in points:
+            self.check_lineup(squad, SQUAD_POSITIONS)
+        # One row of scores per squad at once
+        np.testing.assert_allclose(fpl_optimise.formation_scores(points, SQUAD_POSITIONS),
+                                   [fpl_optimise.formation_scores(squad, SQUAD_POSITIONS) for squad in points])
+
+    def test_squads_without_some_formations(self):
+        # 3 DEF and 2 FWD: only 1-3-5-2 is left; 4 DEF and 1 FWD: only 1-4-5-1
+        for counts, formation in [([1, 3, 6, 2], '1-3-5-2'), ([2, 4, 5, 1], '1-4-5-1')]:
+            positions = np.repeat(fpl_optimise.POSITIONS, counts)
+            points = random_squads(5, positions, seed=1)
+            for squad in points:
+                scores = fpl_optimise.formation_scores(squad, positions)
+                self.assertEqual([f for f, s in zip(fpl_optimise.POSSIBLE_FORMATIONS, scores) if np.isfinite(s)],
+                                 [formation])
+                self.check_lineup(squad, positions)
+
+    def test_squad_without_any_formation(self):
+        positions = np.repeat(fpl_optimise.POSITIONS, [2, 2, 5, 3])  # Too few defenders
+        points = random_squads(1, positions)[0]
+        self.assertTrue(np.isneginf(fpl_optimise.formation_scores(points, positions)).all())
+        selected, formation, score = fpl_optimise.select_lineup(points, positions)
+        self.assertTrue(np.isneginf(score))
+        for backend in fpl_solver.available_backends():
+            with self.assertRaises(ValueError, msg=backend):
+                fpl_optimise.select_lineup_milp(points, positions, backend=backend)
+
+if __name__ == '__main__':
+    unittest.main()
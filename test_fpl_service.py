@@ -0,0 +1,205 @@
+import tempfile
+import threading
+import unittest
+import numpy as np
+import pandas as pd
+import requests
+import fpl_optimise
+import fpl_service
+import fpl_stubs
+
+"""
+Tests of fpl_service without a database: a stub prediction store with a fixed frame and a stand-in
+of the FPL API (fpl_stubs.serve_directory) serving the picks of one team.
+    python -m unittest test_fpl_service
+"""
+
+TEAM_ID = 1
+FIRST_ROUND = 12
+
+def prediction_frame(n_players=60, n_rounds=3, seed=0):
+    """A frame like fpl_optimise.load_predictions for n_players random players"""
+    rng = np.random.default_rng(seed)
+    players = pd.DataFrame({'element': np.arange(1, n_players + 1),
+                            'position': np.resize(fpl_optimise.POSITIONS, n_players),
+                            'name_own_team': ['T{}'.format(i % 20) for i in range(n_players)],
+                            'now_cost': np.round(rng.uniform(4, 12, n_players), 1)})
+    players['web_name'] = 'Player ' + players['element'].astype(str)
+    df = players.loc[players.index.repeat(n_rounds)].reset_index(drop=True)
+    df['round'] = np.tile(FIRST_ROUND + np.arange(n_rounds), n_players)
+    df['points'] = np.round(rng.gamma(2.0, 2.0, len(df)), 1)
+    df['points_std'] = 2.0
+    df = df.sort_values(['element', 'round']).reset_index(drop=True)
+    df['points_cumulative'] = df.groupby('element')['points'].cumsum()
+    df['points_std_cumulative'] = np.sqrt((df['points_std'] ** 2).groupby(df['element']).cumsum())
+    df['n_fixtures'] = 1
+    df['next_fixture'] = fpl_optimise.rounds_ahead(df['round'])
+    return df
+
+class StubStore:
+    """The interface of fpl_service.PredictionStore on a fixed frame"""
+    def __init__(self, df_prediction, run_id=7):
+        self.run_id, self.df_prediction, self.n_loads = run_id, df_prediction, 1
+        self.rounds = {int(n): df for n, df in df_prediction.groupby('next_fixture')}
+
+    def get(self):
+        return self.run_id, self.df_prediction, self.rounds
+
+class TestTTLCache(unittest.TestCase):
+    def setUp(self):
+        self.now = 0.0
+        self.cache = fpl_service.TTLCache(ttl=10, maxsize=2, clock=lambda: self.now)
+
+    def test_hits_and_expiry(self):
+        loads = []
+        def load(key):
+            loads.append(key)
+            return str(key)
+        self.assertEqual(self.cache.get(1, load), '1')
+        self.now = 9.9
+        self.assertEqual(self.cache.get(1, load), '1')
+        self.assertEqual(loads, [1])
+        self.now = 10.0
+        self.assertEqual(self.cache.get(1, load), '1')
+        self.assertEqual(loads, [1, 1])
+        self.assertEqual(self.cache.stats(), {'size': 1, 'hits': 1, 'misses': 2})
+
+    def test_eviction_of_the_oldest(self):
+        for key in (1, 2, 3):
+            self.cache.get(key, str)
+        self.assertEqual(list(self.cache.entries), [2, 3])
+        self.cache.get(2, lambda key: 'reloaded')
+        self.assertEqual(self.cache.stats(), {'size': 2, 'hits': 1, 'misses': 3})
+
+    def test_failed_load_is_not_cached(self):
+        def fail(key):
+            raise requests.ConnectionError('down')
+        with self.assertRaises(requests.ConnectionError):
+            self.cache.get(1, fail)
+        self.assertEqual(self.cache.get(1, str), '1')
+        self.assertEqual(self.cache.stats()['misses'], 2)
+
+class ServiceTestCase(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.df_prediction = prediction_frame()
+        cls.squad = fpl_stubs.cheapest_squad(cls.df_prediction)
+        picks = {(TEAM_ID, FIRST_ROUND - 1): {'picks': [{'element': e} for e in cls.squad],
+                                                'entry_history': {'bank': 15}}}
+        cls.stage_dir = tempfile.TemporaryDirectory()  # No element-summaries to serve
+        cls.stub, cls.base_url = fpl_stubs.serve_directory(cls.stage_dir.name, picks)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.stub.shutdown()
+        cls.stub.server_close()
+        cls.stage_dir.cleanup()
+
+    def setUp(self):
+        del self.stub.paths[:]
+        self.service = fpl_service.Service(StubStore(self.df_prediction), self.base_url, picks_ttl=60)
+
+    def tearDown(self):
+        self.service.session.close()
+
+    def cost(self, element):
+        return float(self.df_prediction.loc[self.df_prediction.element == element, 'now_cost'].iloc[0])
+
+class TestScenario(ServiceTestCase):
+    def test_picks_are_fetched_once(self):
+        for _ in range(3):
+            result, df_round, squad = self.service.scenario({'team_id': str(TEAM_ID), 'n_round': '2'})
+        self.assertEqual(squad, self.squad)
+        self.assertEqual(result['bank'], 1.5)
+        self.assertEqual((result['gameweek'], result['n_round'], result['prediction_run']), (FIRST_ROUND - 1, 2, 7))
+        self.assertTrue((df_round['round'] == FIRST_ROUND + 1).all())
+        self.assertEqual(self.stub.paths, ['/entry/{}/event/{}/picks/'.format(TEAM_ID, FIRST_ROUND - 1)])
+
+    def test_sell_and_exclude(self):
+        sold, excluded = self.squad[0], self.squad[1]
+        result, df_round, squad = self.service.scenario({'team_id': str(TEAM_ID), 'sell': str(sold),
+                                                         'exclude': str(excluded)})
+        self.assertEqual(squad, self.squad[2:])
+        self.assertEqual(result['bank'], round(1.5 + self.cost(sold), 1))
+        self.assertEqual([p['element'] for p in result['sold']], [sold])
+        self.assertFalse(df_round.element.isin([sold, excluded]).any())
+
+    def test_squad_and_bank(self):
+        not_owned = int(self.df_prediction.element[~self.df_prediction.element.isin(self.squad)].iloc[0])
+        result, df_round, squad = self.service.scenario({
+            'squad': ','.join(map(str, self.squad)), 'bank': '2.5', 'sell': '{},{}'.format(self.squad[0], not_owned)})
+        self.assertEqual(squad, self.squad[1:])
+        self.assertEqual(result['bank'], round(2.5 + self.cost(self.squad[0]), 1))  # Only owned players are sold
+        self.assertFalse(df_round.element.isin([not_owned]).any())
+        self.assertEqual(self.stub.paths, [])
+
+    def test_invalid_parameters(self):
+        with self.assertRaises(ValueError):
+            self.service.scenario({})
+        with self.assertRaises(ValueError):
+            self.service.scenario({'team_id': str(TEAM_ID), 'n_round': '4'})
+        for quantile in ['0', '1', '1.5', 'nan']:
+            with self.assertRaises(ValueError):
+                self.service.scenario({'team_id': str(TEAM_ID), 'quantile': quantile})
+        self.assertEqual(self.service.scenario({'team_id': str(TEAM_ID), 'quantile': '0.2'})[0]['quantile'], 0.2)
+
+class TestServer(ServiceTestCase):
+    def setUp(self):
+        super().setUp()
+        self.server = fpl_service.make_server(self.service, port=0, verbose=False)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.url = 'http://127.0.0.1:{}'.format(self.server.server_address[1])
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        super().tearDown()
+
+    def get(self, path, **params):
+        response = requests.get(self.url + path, params=params)
+        return response.status_code, response.json()
+
+    def test_status(self):
+        status, body = self.get('/status')
+        self.assertEqual(status, 200)
+        self.assertEqual((body['prediction_run'], body['players'], body['rounds']), (7, 60, [FIRST_ROUND, FIRST_ROUND + 2]))
+
+    def test_lineup(self):
+        status, body = self.get('/lineup', team_id=TEAM_ID, n_round=3)
+        self.assertEqual(status, 200)
+        my_team = self.df_prediction[self.df_prediction.element.isin(self.squad) & (self.df_prediction.next_fixture == 3)]
+        selected, formation, points = fpl_optimise.select_lineup(my_team.points_cumulative, my_team.position)
+        self.assertEqual(body['formation'], formation)
+        self.assertAlmostEqual(body['points'], points)
+        self.assertEqual(sorted(p['element'] for p in body['lineup']), sorted(my_team.element[selected]))
+        self.assertEqual(len(body['bench']), 4)
+
+    def test_transfers(self):
+        status, body = self.get('/transfers', team_id=TEAM_ID, n_transfers=2, n_round=2)
+        self.assertEqual(status, 200)
+        expected = fpl_optimise.optimise_team(self.df_prediction, self.squad, 1.5, 2, 2)
+        self.assertAlmostEqual(body['new_points'], expected['new_points'])
+        self.assertEqual(sorted(p['element'] for p in body['new_team']), sorted(expected['new_team'].element))
+        self.assertLessEqual(len(body['transfers_in']), 2)
+        self.assertEqual(len(body['transfers_in']), len(body['transfers_out']))
+
+    def test_errors(self):
+        status, body = self.get('/nope')
+        self.assertEqual(status, 404)
+        self.assertIn('/lineup', body['error'])
+        for params in [{}, {'team_id': TEAM_ID, 'n_round': 9}, {'team_id': 'x'}]:
+            status, body = self.get('/lineup', **params)
+            self.assertEqual(status, 400, params)
+        status, body = self.get('/lineup', squad=','.join(map(str, self.squad)), sell=','.join(map(str, self.squad[:5])))
+        self.assertEqual(status, 400)  # Too few players left for a lineup
+        status, body = self.get('/transfers', team_id=TEAM_ID, sell=','.join(map(str, self.squad[:5])))
+        self.assertEqual(status, 400)  # No team of 11 with a single transfer
+        self.assertIn('No team found', body['error'])
+        status, body = self.get('/lineup', team_id=TEAM_ID, quantile=1)
+        self.assertEqual(status, 400)
+        self.assertIn('quantile', body['error'])
+        status, body = self.get('/transfers', team_id=TEAM_ID + 1)  # The FPL API has no picks for this team
+        self.assertEqual(status, 502)
+
+if __name__ == '__main__':
+    unittest.main()
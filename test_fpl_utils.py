@@ -0,0 +1,75 @@
+import unittest
+import numpy as np
+import pandas as pd
+import fpl_utils
+
+"""
+Tests of the EMA features of fpl_utils against values worked out by hand, with span=2 (each new
+value weighs 3 times the average so far), min_periods=2 and threshold_minutes=30.
+    python -m unittest test_fpl_utils
+"""
+
+PARAMS = {'span': 2, 'min_periods': 2, 'threshold_minutes': 30}
+nan = np.nan
+
+def history():
+    """Element 1 has a match of 10 minutes and a missing value, element 2 a match of exactly
+    30 minutes, element 3 a single match"""
+    return pd.DataFrame({'element': [1, 1, 1, 1, 1, 2, 2, 2, 3],
+                         'round': [1, 2, 3, 4, 5, 1, 2, 3, 1],
+                         'minutes': [90, 90, 10, 90, 90, 90, 30, 45, 90],
+                         'bps': [4, 8, 100, 20, nan, 6, 3, 10, 5],
+                         'influence': [8, 16, 200, 40, 2, 12, 6, 20, 10]})
+
+# The EMA up to the previous match: (4 + 3*8)/4 = 7, (4*7 + 9*20)/13 = 16; (8 + 3*16)/4 = 14,
+# (4*14 + 9*40)/13 = 32. A missing value keeps the average, a new element starts over
+EXPECTED = pd.DataFrame({'EMA_bps': [nan, nan, 7, 7, 16, nan, nan, nan, nan],
+                         'EMA_influence': [nan, nan, 14, 14, 32, nan, nan, nan, nan]})
+
+class TestEMAFeatures(unittest.TestCase):
+    def test_expected_features(self):
+        df = history()
+        pd.testing.assert_frame_equal(fpl_utils.EMA_features(df, ['bps', 'influence'], **PARAMS), EXPECTED)
+        pd.testing.assert_series_equal(fpl_utils.EMA(df, 'bps', **PARAMS), EXPECTED['EMA_bps'])
+
+    def test_index_is_kept(self):
+        df = history()
+        df.index = df.index * 10 + 3
+        result = fpl_utils.EMA_features(df, ['bps', 'influence'], **PARAMS)
+        pd.testing.assert_frame_equal(result, EXPECTED.set_index(df.index))
+
+    def test_state_after_the_last_match(self):
+        result, state = fpl_utils.EMA_features(history(), ['bps', 'influence'], return_state=True, **PARAMS)
+        state = state.set_index(['element', 'feature'])
+        # The features of the next match: element 1 had 16 bps and (13/27*32 + 2)/(13/27 + 1) = 11.75 influence
+        self.assertAlmostEqual(state.loc[(1, 'EMA_bps'), 'last_value'], 16)
+        self.assertAlmostEqual(state.loc[(1, 'EMA_influence'), 'last_value'], 11.75)
+        self.assertAlmostEqual(state.loc[(2, 'EMA_bps'), 'last_value'], 9)  # (6 + 3*10)/4
+        self.assertTrue(np.isnan(state.loc[(3, 'EMA_bps'), 'last_value']))
+        self.assertEqual(list(state.loc[1, 'nobs']), [3, 4])
+        self.assertEqual(list(state.loc[2, 'nobs']), [2, 2])
+
+    def test_continue_from_state(self):
+        # As fpl_features: the matches after the first split continue from the state of the earlier ones,
+        # also for a player without earlier matches (element 3) or with none after them
+        df = history()
+        features = ['bps', 'influence']
+        for split in [df['round'] <= 2, df['round'] <= 3, df['element'] == 2]:
+            first, state = fpl_utils.EMA_features(df[split], features, return_state=True, **PARAMS)
+            second = fpl_utils.EMA_features(df[~split], features, state=state, **PARAMS)
+            pd.testing.assert_frame_equal(pd.concat([first, second]).sort_index(), EXPECTED)
+
+    def test_seasons(self):
+        # Each season is computed on its own (fpl_seasons): a player's EMA does not carry over
+        df = history()
+        seasons = pd.concat([df, df.assign(element=df['element'] + 100)], ignore_index=True)
+        result = fpl_utils.EMA_features(seasons, ['bps', 'influence'], **PARAMS)
+        pd.testing.assert_frame_equal(result, pd.concat([EXPECTED, EXPECTED], ignore_index=True))
+
+    def test_empty(self):
+        df = history().iloc[:0]
+        result, state = fpl_utils.EMA_features(df, ['bps'], return_state=True, **PARAMS)
+        self.assertEqual((len(result), len(state)), (0, 0))
+
+if __name__ == '__main__':
+    unittest.main()